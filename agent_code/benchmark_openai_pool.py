@@ -0,0 +1,146 @@
+"""
+Measure the TLS handshakes saved by the pooled OpenAI clients against a local HTTPS stand-in.
+
+Usage: python -m agent_code.benchmark_openai_pool --calls 200 --rtt 0.02
+
+The stand-in speaks HTTPS with a throwaway self-signed certificate (made with the openssl
+command line) and answers every embeddings request at once. Each new connection waits two
+simulated round trips, for the TCP and TLS 1.3 handshakes over a real network, and every
+request waits one round trip. The same sequence of embedding calls is made with a new
+client per call, as `get_embedding` used to, and with a client built like the pooled
+clients of supportbot.clients.openai.openai_client, synchronous and async.
+Each run reports the time per call and the number of TLS handshakes the server saw.
+"""
+import argparse
+import asyncio
+import json
+import os
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+from openai import (AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient,
+                    OpenAI)
+
+from supportbot.clients.openai.openai_client import _limits, _timeout
+
+
+class FakeOpenAIServer:
+    def __init__(self, rtt: float, certificate: str, key: str) -> None:
+        self.rtt = rtt
+        self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.ssl_context.load_cert_chain(certificate, key)
+        self.handshakes = 0
+        self.requests = 0
+        self.port = None
+        self._ready = threading.Event()
+
+    def start(self) -> str:
+        threading.Thread(target=lambda: asyncio.run(self._serve()), daemon=True).start()
+        self._ready.wait()
+        return f"https://127.0.0.1:{self.port}/v1"
+
+    async def _serve(self) -> None:
+        server = await asyncio.start_server(self._handle, "127.0.0.1", 0, ssl=self.ssl_context)
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # The TLS handshake is done by now; the simulated round trips of the TCP and TLS handshakes
+        # are added before the connection's first answer, which is when the client waits for them.
+        self.handshakes += 1
+        try:
+            await asyncio.sleep(2 * self.rtt)
+            while True:
+                head = (await reader.readuntil(b"\r\n\r\n")).decode()
+                content_length = 0
+                for line in head.split("\r\n"):
+                    if line.lower().startswith("content-length:"):
+                        content_length = int(line.split(":", 1)[1])
+                request = json.loads(await reader.readexactly(content_length))
+                self.requests += 1
+                await asyncio.sleep(self.rtt)
+                body = json.dumps({
+                    "object": "list",
+                    "model": request["model"],
+                    "data": [{"object": "embedding", "index": 0, "embedding": [0.0] * 1536}],
+                    "usage": {"prompt_tokens": 1, "total_tokens": 1},
+                }).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            writer.close()
+
+
+def make_certificate(directory: str) -> tuple[str, str]:
+    certificate, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+            "-keyout", key, "-out", certificate, "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+        ],
+        check=True,
+        capture_output=True
+    )
+    return certificate, key
+
+
+def report(name: str, elapsed: float, calls: int, server: FakeOpenAIServer, handshakes_before: int) -> None:
+    print(f"  {name:<24} {elapsed * 1000 / calls:6.1f}ms per call  TLS handshakes={server.handshakes - handshakes_before}")
+
+
+def run_sync(url: str, verify: ssl.SSLContext, calls: int, server: FakeOpenAIServer) -> None:
+    handshakes_before, started_at = server.handshakes, time.monotonic()
+    for _ in range(calls):
+        with OpenAI(api_key="benchmark", base_url=url, http_client=DefaultHttpxClient(verify=verify)) as client:
+            client.embeddings.create(input=["question"], model="text-embedding-3-small")
+    report("sync, client per call", time.monotonic() - started_at, calls, server, handshakes_before)
+
+    handshakes_before, started_at = server.handshakes, time.monotonic()
+    client = OpenAI(api_key="benchmark", base_url=url, timeout=_timeout(), http_client=DefaultHttpxClient(limits=_limits(), timeout=_timeout(), verify=verify))
+    for _ in range(calls):
+        client.embeddings.create(input=["question"], model="text-embedding-3-small")
+    report("sync, pooled client", time.monotonic() - started_at, calls, server, handshakes_before)
+    client.close()
+
+
+async def run_async(url: str, verify: ssl.SSLContext, calls: int, server: FakeOpenAIServer) -> None:
+    handshakes_before, started_at = server.handshakes, time.monotonic()
+    for _ in range(calls):
+        async with AsyncOpenAI(api_key="benchmark", base_url=url, http_client=DefaultAsyncHttpxClient(verify=verify)) as client:
+            await client.embeddings.create(input=["question"], model="text-embedding-3-small")
+    report("async, client per call", time.monotonic() - started_at, calls, server, handshakes_before)
+
+    handshakes_before, started_at = server.handshakes, time.monotonic()
+    client = AsyncOpenAI(api_key="benchmark", base_url=url, timeout=_timeout(), http_client=DefaultAsyncHttpxClient(limits=_limits(), timeout=_timeout(), verify=verify))
+    for _ in range(calls):
+        await client.embeddings.create(input=["question"], model="text-embedding-3-small")
+    report("async, pooled client", time.monotonic() - started_at, calls, server, handshakes_before)
+    await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--rtt", type=float, default=0.02, help="Simulated network round trip in seconds")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        certificate, key = make_certificate(directory)
+        server = FakeOpenAIServer(args.rtt, certificate, key)
+        url = server.start()
+        verify = ssl.create_default_context(cafile=certificate)
+        print(f"{args.calls} sequential embedding calls, {args.rtt * 1000:.0f}ms round trip")
+        run_sync(url, verify, args.calls, server)
+        asyncio.run(run_async(url, verify, args.calls, server))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmark the deadlines, hedged retries and circuit breaker of the OpenAI calls against a fake upstream.
+
+Usage: python -m agent_code.benchmark_resilience --calls 2000 --stall-rate 0.03
+
+The fake upstream answers after a log-normal latency, and a fraction of its requests stall
+for several seconds, like an overloaded API replica. Each configuration serves the same
+sequence of calls, a few at a time, and reports the latency percentiles seen by the
+callers and the number of upstream requests. The outage run makes every request stall
+and shows the breaker turning the waits into immediate fallbacks.
+"""
+import argparse
+import asyncio
+import time
+
+import numpy as np
+
+from supportbot.clients.openai.resilience import (CircuitBreaker,
+                                                  ResilientCall,
+                                                  UpstreamUnavailable)
+
+
+class FakeUpstream:
+    def __init__(self, median: float, stall_rate: float, stall: float, seed: int = 0) -> None:
+        self.median = median
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.rng = np.random.default_rng(seed)
+        self.requests = 0
+
+    async def request(self) -> str:
+        self.requests += 1
+        latency = self.median * float(self.rng.lognormal(0, 0.3))
+        if self.rng.random() < self.stall_rate:
+            latency += self.stall
+        await asyncio.sleep(latency)
+        return "answer"
+
+
+async def run(call: ResilientCall, upstream: FakeUpstream, calls: int, concurrency: int) -> tuple[np.ndarray, int]:
+    latencies, fallbacks = [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal fallbacks
+        async with semaphore:
+            started_at = time.monotonic()
+            try:
+                await call.call(upstream.request)
+            except UpstreamUnavailable:
+                fallbacks += 1
+            latencies.append(time.monotonic() - started_at)
+
+    await asyncio.gather(*(one() for _ in range(calls)))
+    return np.asarray(latencies), fallbacks
+
+
+def report(name: str, latencies: np.ndarray, fallbacks: int, upstream: FakeUpstream) -> None:
+    p50, p95, p99 = (np.quantile(latencies, q) * 1000 for q in (0.5, 0.95, 0.99))
+    print(
+        f"  {name:<22} p50={p50:7.0f}ms  p95={p95:7.0f}ms  p99={p99:7.0f}ms  "
+        f"max={latencies.max() * 1000:7.0f}ms  upstream requests={upstream.requests}  fallbacks={fallbacks}"
+    )
+
+
+async def main_async(args) -> None:
+    print(f"{args.calls} calls, median {args.median * 1000:.0f}ms, {args.stall_rate:.0%} stalls of {args.stall:.1f}s")
+    configurations = [
+        ("no deadline", dict(deadline=3600, hedge=False)),
+        ("deadline", dict(deadline=args.deadline, hedge=False)),
+        ("deadline + hedging", dict(deadline=args.deadline, hedge=True)),
+    ]
+    for name, options in configurations:
+        upstream = FakeUpstream(args.median, args.stall_rate, args.stall)
+        # The breaker is kept out of these runs so that only the deadline and the hedge differ.
+        call = ResilientCall(name, breaker=CircuitBreaker(failure_threshold=10**9), **options)
+        latencies, fallbacks = await run(call, upstream, args.calls, args.concurrency)
+        report(name, latencies, fallbacks, upstream)
+
+    print("outage: every request stalls")
+    for name, threshold in [("deadline only", 10**9), ("deadline + breaker", 5)]:
+        upstream = FakeUpstream(args.median, 1.0, args.stall)
+        call = ResilientCall(name, deadline=args.deadline, breaker=CircuitBreaker(failure_threshold=threshold, reset_timeout=60))
+        latencies, fallbacks = await run(call, upstream, args.calls // 10, args.concurrency)
+        report(name, latencies, fallbacks, upstream)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--median", type=float, default=0.05, help="Median upstream latency in seconds")
+    parser.add_argument("--stall-rate", type=float, default=0.03, help="Fraction of requests that stall")
+    parser.add_argument("--stall", type=float, default=2.0, help="Extra latency of a stalled request in seconds")
+    parser.add_argument("--deadline", type=float, default=1.0, help="Deadline of a call in seconds")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Benchmark the retrieval indexes and embedding storages against the exact float32 scan on synthetic corpora.
+
+Usage: python -m agent_code.benchmark_retrieval --sizes 10000,100000,1000000 --dim 256 --storages float16,int8
+
+The hybrid benchmark gives every synthetic chunk an error code and a metric name, and asks
+for one of them; a hit means the chunk holding that identifier is among the top k.
+
+The synthetic embeddings spread their signal evenly over all dimensions, so the two-stage
+recall is a lower bound: text-embedding-3 vectors front-load it into the leading dimensions.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from supportbot.retrieval.embedding_index import (EmbeddingIndex,
+                                                  hybrid_search,
+                                                  normalize_rows)
+from supportbot.retrieval.ivf_index import IVFIndex
+from supportbot.retrieval.lexical_index import LexicalIndex
+from supportbot.retrieval.two_stage_index import TwoStageIndex
+
+
+def make_corpus(size: int, dim: int, rng: np.random.Generator, n_topics: int = 1000) -> np.ndarray:
+    # Real chunk embeddings cluster by topic, so sample around random topic centres instead of uniformly.
+    topics = rng.standard_normal((n_topics, dim), dtype=np.float32)
+    corpus = topics[rng.integers(0, n_topics, size=size)]
+    corpus += 1.0 * rng.standard_normal((size, dim), dtype=np.float32)
+    return corpus
+
+
+def make_queries(corpus: np.ndarray, n_queries: int, rng: np.random.Generator) -> np.ndarray:
+    queries = corpus[rng.integers(0, corpus.shape[0], size=n_queries)].copy()
+    queries += 1.0 * rng.standard_normal(queries.shape, dtype=np.float32)
+    return queries
+
+
+def run_queries(index: EmbeddingIndex, queries: np.ndarray, k: int) -> tuple[list[set[str]], float]:
+    start = time.perf_counter()
+    results = [{scored_chunk.chunk for scored_chunk in index.search(query, k=k)} for query in queries]
+    latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    return results, latency_ms
+
+
+def recall_at_k(results: list[set[str]], exact_results: list[set[str]], k: int) -> float:
+    return float(np.mean([len(result & exact) / k for result, exact in zip(results, exact_results)]))
+
+
+def benchmark_ivf(index: EmbeddingIndex, queries: np.ndarray, exact_results: list[set[str]], k: int, nprobes: list[int]) -> None:
+    start = time.perf_counter()
+    ivf_index = IVFIndex.build(index)
+    print(f"  ivf build: {time.perf_counter() - start:.1f}s ({ivf_index.centroids.shape[0]} lists)")
+    for nprobe in nprobes:
+        ivf_index.nprobe = nprobe
+        results, latency_ms = run_queries(ivf_index, queries, k)
+        print(f"  ivf nprobe={nprobe:<4} {latency_ms:8.2f} ms/query  recall@{k}={recall_at_k(results, exact_results, k):.3f}")
+
+
+def benchmark_storage(index: EmbeddingIndex, queries: np.ndarray, exact_results: list[set[str]], k: int, storages: list[str]) -> None:
+    for storage in storages:
+        quantized_index = index.quantized(storage)
+        results, latency_ms = run_queries(quantized_index, queries, k)
+        print(
+            f"  {storage:<8} {quantized_index.nbytes / 2**20:8.1f} MB  {latency_ms:8.2f} ms/query  "
+            f"recall@{k}={recall_at_k(results, exact_results, k):.3f}"
+        )
+
+
+def benchmark_two_stage(index: EmbeddingIndex, queries: np.ndarray, exact_results: list[set[str]], k: int, prefix_dims: int, pool_sizes: list[int]) -> None:
+    start = time.perf_counter()
+    two_stage_index = TwoStageIndex.from_index(index, prefix_dims=prefix_dims)
+    print(f"  two-stage build: {time.perf_counter() - start:.1f}s ({prefix_dims} prefix dims)")
+    for pool_size in pool_sizes:
+        two_stage_index.pool_size = pool_size
+        results, latency_ms = run_queries(two_stage_index, queries, k)
+        print(f"  two-stage pool={pool_size:<5} {latency_ms:8.2f} ms/query  recall@{k}={recall_at_k(results, exact_results, k):.3f}")
+
+
+WORDS = "the a user dashboard error metric query when how to fix why is my data missing slow chart bot ticket".split()
+
+
+def make_doc_texts(size: int, rng: np.random.Generator) -> list[str]:
+    words = np.asarray(WORDS)
+    return [
+        f"{' '.join(rng.choice(words, size=30))} error E{code} on metric m_{metric}_daily"
+        for code, metric in zip(rng.choice(10**7, size=size, replace=False), rng.integers(0, size, size=size))
+    ]
+
+
+def benchmark_hybrid(index: EmbeddingIndex, queries: np.ndarray, k: int, rng: np.random.Generator) -> None:
+    texts = make_doc_texts(len(index), rng)
+    start = time.perf_counter()
+    index.chunks = texts
+    index.lexical = LexicalIndex.build(texts)
+    print(f"  lexical build: {time.perf_counter() - start:.1f}s ({index.lexical.nbytes / 2**20:.1f} MB)")
+    targets = rng.integers(0, len(index), size=len(queries))
+    # The question embedding is only loosely related to the chunk, as for a short identifier lookup.
+    query_vectors = normalize_rows(index.embeddings(targets) + 3.0 * rng.standard_normal((len(targets), index.dimension), dtype=np.float32))
+    query_texts = [f"why is my query failing with {texts[target].rsplit(' error ', 1)[1].split(' on ')[0]}" for target in targets]
+    for name, search in [
+        ("dense", lambda vector, text: index.search_batch(vector[None, :], k=k)[0]),
+        ("hybrid", lambda vector, text: hybrid_search(index, vector, text, k=k)),
+    ]:
+        start = time.perf_counter()
+        hits = [target in {scored_chunk.row for scored_chunk in search(vector, text)} for vector, text, target in zip(query_vectors, query_texts, targets)]
+        latency_ms = (time.perf_counter() - start) * 1000 / len(targets)
+        print(f"  {name:<6} {latency_ms:8.2f} ms/query  hit@{k}={np.mean(hits):.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="Comma separated corpus sizes")
+    parser.add_argument("--dim", type=int, default=256, help="Embedding dimension (1536 for text-embedding-3-small needs ~6 GB per 1M rows)")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--nprobes", default="1,4,8,16,32")
+    parser.add_argument("--prefix-dims", type=int, default=64, help="Leading dimensions scanned by the two-stage index")
+    parser.add_argument("--pool-sizes", default="50,100,200,500", help="Comma separated two-stage candidate pool sizes")
+    parser.add_argument("--hybrid", action="store_true", help="Also benchmark keyword lookups with the hybrid search")
+    parser.add_argument("--storages", default="float16,int8", help="Comma separated embedding storages compared to float32")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for size in map(int, args.sizes.split(",")):
+        print(f"corpus size={size} dim={args.dim}")
+        corpus = make_corpus(size, args.dim, rng)
+        queries = make_queries(corpus, args.queries, rng)
+        index = EmbeddingIndex([str(row) for row in range(size)], corpus)
+        del corpus
+        exact_results, exact_latency_ms = run_queries(index, queries, args.k)
+        print(f"  exact float32 {index.nbytes / 2**20:8.1f} MB  {exact_latency_ms:8.2f} ms/query")
+        benchmark_storage(index, queries, exact_results, args.k, args.storages.split(","))
+        benchmark_two_stage(index, queries, exact_results, args.k, args.prefix_dims, list(map(int, args.pool_sizes.split(","))))
+        benchmark_ivf(index, queries, exact_results, args.k, list(map(int, args.nprobes.split(","))))
+        if args.hybrid:
+            benchmark_hybrid(index, queries, args.k, rng)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Compare the rolling conversation embedding with an embedding of the joined history on a real corpus.
+
+Usage: python -m agent_code.compare_conversation_context --table crawled_url_chunks --conversations 100
+
+Consecutive chunks of a table come from the same page, so each simulated conversation is a
+run of consecutive chunks used as its turns, and a hit means the chunk that follows them is
+among the top k results of the conversation context. The turns themselves are excluded from
+the search. The joined history is embedded with the OpenAI API, as `send_message` used to do;
+the rolling context reuses the chunk embeddings already stored in the table.
+"""
+import argparse
+
+import numpy as np
+
+from agent_utils import get_embeddings
+from supportbot.retrieval.conversation_context import (ConversationTurn,
+                                                       context_embedding)
+from supportbot.retrieval.corpus_loader import load_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--table", default="crawled_url_chunks")
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--turns", type=int, default=5, help="Turns in the context window, as message_history_size")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--decays", default="0.5,0.7,1.0", help="Comma separated rolling average decays")
+    args = parser.parse_args()
+
+    index = load_index(args.table)
+    rng = np.random.default_rng(0)
+    starts = rng.choice(len(index) - args.turns, size=min(args.conversations, len(index) - args.turns), replace=False)
+    all_rows = np.arange(len(index))
+    joined_texts = ["\n".join(index.chunks[start + turn] for turn in range(args.turns)) for start in starts]
+    joined_embeddings = get_embeddings(joined_texts)
+    if joined_embeddings is None:
+        raise SystemExit("Could not embed the joined histories.")
+
+    def evaluate(context_vectors) -> tuple[float, list[set[int]]]:
+        hits, results = [], []
+        for start, vector in zip(starts, context_vectors):
+            allowed_rows = np.setdiff1d(all_rows, np.arange(start, start + args.turns))
+            rows = {scored_chunk.row for scored_chunk in index.search(vector, k=args.k, allowed_rows=allowed_rows)}
+            hits.append(start + args.turns in rows)
+            results.append(rows)
+        return float(np.mean(hits)), results
+
+    joined_hit_rate, joined_results = evaluate(joined_embeddings)
+    print(f"{len(starts)} conversations of {args.turns} turns from {args.table} ({len(index)} chunks)")
+    print(f"  joined history  hit@{args.k}={joined_hit_rate:.3f}")
+    for decay in map(float, args.decays.split(",")):
+        rolling_vectors = [
+            context_embedding([
+                ConversationTurn(question=index.chunks[row], answer="", embedding=index.embeddings(np.array([row]))[0])
+                for row in range(start, start + args.turns)
+            ], decay=decay)
+            for start in starts
+        ]
+        hit_rate, results = evaluate(rolling_vectors)
+        overlap = np.mean([len(result & joined) / args.k for result, joined in zip(results, joined_results)])
+        print(f"  rolling decay={decay:<4} hit@{args.k}={hit_rate:.3f}  overlap@{args.k} with joined={overlap:.3f}")
+
+
+if __name__ == "__main__":
+    main()
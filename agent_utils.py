@@ -1,111 +1,539 @@
+import asyncio
 import logging
+import os
+import threading
+from typing import Awaitable, Callable
 
-from openai import OpenAI
-from scipy.spatial.distance import cosine
-from supabase import create_client
+import numpy as np
 
-from config import OPEN_AI_API_KEY, SUPABASE_KEY, SUPABASE_URL
+from config import (ACCESS_FILTER_ENABLED, ANN_MIN_CORPUS_SIZE,
+                    ANSWER_CACHE_ENABLED, ANSWER_CACHE_SIZE,
+                    ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL,
+                    BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT,
+                    COMPLETION_DEADLINE, CONVERSATION_EMBEDDING_DECAY,
+                    CORPUS_EMBEDDING_STORAGE, CORPUS_RETRIEVAL_INDEX,
+                    EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_SIZE,
+                    EMBEDDING_DEADLINE, EMBEDDING_STORAGE, FALLBACK_SNIPPETS,
+                    HEDGE_PERCENTILE, HEDGE_REQUESTS, HYBRID_POOL_SIZE,
+                    IVF_INDEX_DIR, IVF_NPROBE, LEXICAL_MAX_CANDIDATES,
+                    LEXICAL_RARE_FRACTION, LEXICAL_SEARCH_ENABLED,
+                    PROMPT_DUPLICATE_THRESHOLD, PROMPT_MESSAGE_TOKEN_BUDGET,
+                    PROMPT_RELEVANCE_WEIGHT, PROMPT_TOKEN_BUDGET,
+                    PROMPT_WORKERS, RETRIEVAL_INDEX, RETRIEVAL_WORKERS,
+                    SNAPSHOT_DIR, TWO_STAGE_POOL_SIZE, TWO_STAGE_PREFIX_DIMS)
 from supportbot.clients.crawl.dataclasses import ChunkAndEmbedding
 from supportbot.clients.messages.dataclasses import Message
+from supportbot.clients.openai.answer_cache import (AnswerCache,
+                                                    context_fingerprint)
+from supportbot.clients.openai.embedding_cache import EmbeddingCache
+from supportbot.clients.openai.openai_client import (get_async_openai_client,
+                                                     get_openai_client)
+from supportbot.clients.openai.prompt_builder import PromptStats, build_prompt
+from supportbot.clients.openai.resilience import (CircuitBreaker,
+                                                  ResilientCall,
+                                                  UpstreamUnavailable)
+from supportbot.clients.openai.single_flight import (SingleFlight,
+                                                     normalize_text)
+from supportbot.metrics import StageTimer, register_stats
+from supportbot.retrieval.conversation_context import (ConversationTurn,
+                                                       context_embedding,
+                                                       pending_turns)
+from supportbot.retrieval.conversation_memory import ChatConversation
+from supportbot.retrieval.corpus_loader import (MEMBER_COLUMNS, load_index,
+                                                partition_name)
+from supportbot.retrieval.dataclasses import ScoredChunk
+from supportbot.retrieval.embedding_index import (EmbeddingIndex,
+                                                  hybrid_search_stats,
+                                                  search_many)
+from supportbot.retrieval.ivf_index import IVFIndex
+from supportbot.retrieval.lexical_index import LexicalIndex
+from supportbot.retrieval.snapshot import (index_params, load_snapshot,
+                                           save_snapshot)
+from supportbot.retrieval.two_stage_index import TwoStageIndex
+from supportbot.workers import WorkerPool
 
 logger = logging.getLogger(__name__)
 
+register_stats("hybrid_search", hybrid_search_stats)
+embedding_flight = SingleFlight()
+register_stats("embedding_single_flight", embedding_flight.stats)
+completion_flight = SingleFlight()
+register_stats("completion_single_flight", completion_flight.stats)
+embedding_call = ResilientCall(
+    "embeddings",
+    deadline=EMBEDDING_DEADLINE,
+    hedge=HEDGE_REQUESTS,
+    hedge_percentile=HEDGE_PERCENTILE,
+    breaker=CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+)
+register_stats("embedding_calls", embedding_call.stats)
+completion_call = ResilientCall(
+    "completions",
+    deadline=COMPLETION_DEADLINE,
+    hedge=HEDGE_REQUESTS,
+    hedge_percentile=HEDGE_PERCENTILE,
+    breaker=CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+)
+register_stats("completion_calls", completion_call.stats)
+_prompt_counts = {"prompts": 0, "tokens": 0, "max_tokens": 0, "duplicate_chunks": 0, "chunks_over_budget": 0}
+register_stats("prompts", lambda: dict(_prompt_counts))
+
+# The caches and pools are created on first use: spawned prompt workers import this module again
+# through main, and must not each open the embedding cache and start its writer thread.
+_embedding_cache: EmbeddingCache | None = None
+_answer_cache: AnswerCache | None = None
+_retrieval_pool: WorkerPool | None = None
+_prompt_pool: WorkerPool | None = None
+_singletons_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    global _embedding_cache
+    if _embedding_cache is None:
+        with _singletons_lock:
+            if _embedding_cache is None:
+                _embedding_cache = EmbeddingCache(max_entries=EMBEDDING_CACHE_SIZE, path=EMBEDDING_CACHE_PATH)
+                register_stats("embedding_cache", _embedding_cache.stats)
+    return _embedding_cache
+
+
+def get_answer_cache() -> AnswerCache:
+    global _answer_cache
+    if _answer_cache is None:
+        with _singletons_lock:
+            if _answer_cache is None:
+                _answer_cache = AnswerCache(max_entries=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, threshold=ANSWER_CACHE_THRESHOLD)
+                register_stats("answer_cache", _answer_cache.stats)
+    return _answer_cache
+
+
+def get_retrieval_pool() -> WorkerPool:
+    global _retrieval_pool
+    if _retrieval_pool is None:
+        with _singletons_lock:
+            if _retrieval_pool is None:
+                _retrieval_pool = WorkerPool("retrieval", RETRIEVAL_WORKERS)
+                register_stats("retrieval_pool", _retrieval_pool.stats)
+    return _retrieval_pool
+
+
+def get_prompt_pool() -> WorkerPool:
+    """
+    Return the pool prompts are built in; without prompt worker processes, the retrieval pool.
+    """
+    global _prompt_pool
+    if PROMPT_WORKERS <= 0:
+        return get_retrieval_pool()
+    if _prompt_pool is None:
+        with _singletons_lock:
+            if _prompt_pool is None:
+                _prompt_pool = WorkerPool("prompt", PROMPT_WORKERS, processes=True)
+                register_stats("prompt_pool", _prompt_pool.stats)
+    return _prompt_pool
 
 def get_embedding(text, model="text-embedding-3-small"):
-    client = OpenAI(api_key=OPEN_AI_API_KEY)
+    embeddings = get_embeddings([text], model=model)
+    return embeddings[0] if embeddings else None
+
+
+def get_embeddings(texts: list[str], model: str = "text-embedding-3-small") -> list[list[float]] | None:
+    """
+    Embed several texts with a single API request, skipping the texts already in the cache.
+    Args:
+        texts (list[str]): The texts to embed.
+        model (str): The embedding model to use.
+    Returns:
+        list[list[float]] | None: One embedding per text, in input order, or None on error.
+    """
+    # The scripts calling this store the embeddings as JSON, so cached arrays become lists here.
+    embeddings = [get_embedding_cache().get(text, model) for text in texts]
+    embeddings = [None if embedding is None else embedding.tolist() for embedding in embeddings]
+    missing_positions = [position for position, embedding in enumerate(embeddings) if embedding is None]
+    if not missing_positions:
+        return embeddings
+    client = get_openai_client()
     try:
         response = client.embeddings.create(
-            input=text,
+            input=[texts[position] for position in missing_positions],
             model=model
         )
         # time.sleep(1)  # Uncomment if you need to add a delay
-        return response.data[0].embedding
     except Exception as e:
         logger.error(f"Error getting embedding: {str(e)}")
         return None
+    return _fill_embeddings(texts, embeddings, missing_positions, response, model)
+
+
+async def aget_embeddings(texts: list[str], model: str = "text-embedding-3-small") -> list[np.ndarray] | None:
+    """
+    Async version of `get_embeddings` for the bot's event loop.
+    Args:
+        texts (list[str]): The texts to embed.
+        model (str): The embedding model to use.
+    Returns:
+        list[np.ndarray] | None: One float32 embedding per text, in input order, or None on error.
+    """
+    embeddings = await get_embedding_cache().aget_many(texts, model)
+    missing_positions = [position for position, embedding in enumerate(embeddings) if embedding is None]
+    if not missing_positions:
+        return embeddings
+    # Texts already being embedded for a concurrent question share that request.
+    keys = [(model, normalize_text(texts[position])) for position in missing_positions]
+    texts_by_key = {}
+    for key, position in zip(keys, missing_positions):
+        texts_by_key.setdefault(key, texts[position])
+
+    async def embed(new_keys: list) -> list[list[float]] | None:
+        client = get_async_openai_client()
+        try:
+            response = await embedding_call.call(
+                lambda: client.embeddings.create(input=[texts_by_key[key] for key in new_keys], model=model)
+            )
+        except UpstreamUnavailable:
+            raise
+        except Exception as e:
+            logger.error(f"Error getting embedding: {str(e)}")
+            return None
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    for position, embedding in zip(missing_positions, await embedding_flight.do_many(keys, embed)):
+        if embedding is None:
+            return None
+        embeddings[position] = get_embedding_cache().put(texts[position], model, embedding)
+    return embeddings
+
+
+def _fill_embeddings(texts, embeddings, missing_positions, response, model) -> list[list[float]]:
+    for item in response.data:
+        position = missing_positions[item.index]
+        embeddings[position] = item.embedding
+        get_embedding_cache().put(texts[position], model, item.embedding)
+    return embeddings
+
+
+async def embed_question(message: str, recent_turns: list[ConversationTurn]) -> list:
+    """
+    Embed a question and build the conversation context vector of the turns before it.
+
+    Each turn is embedded once, together with the first question asked after it; the
+    conversation context is the decayed average of the turn embeddings instead of an
+    embedding of the joined history.
+    Args:
+        message (str): The question.
+        recent_turns (list[ConversationTurn]): The turns in the context window, oldest first.
+    Returns:
+        list: The question embedding, followed by the conversation context vector when there is one.
+    """
+    new_turns = pending_turns(recent_turns)
+    embeddings = await aget_embeddings([message] + [turn.text for turn in new_turns])
+    if embeddings is None:
+        raise ValueError("Could not get embedding for the message.")
+    for turn, embedding in zip(new_turns, embeddings[1:]):
+        turn.embedding = embedding
+    conversation_embedding = context_embedding(recent_turns, decay=CONVERSATION_EMBEDDING_DECAY)
+    return [embeddings[0]] if conversation_embedding is None else [embeddings[0], conversation_embedding]
+
+
+def retrieve(
+    query_embeddings: list,
+    query_texts: list[str],
+    index: EmbeddingIndex,
+    allowed_rows: np.ndarray | None = None
+) -> list[list[ScoredChunk]]:
+    """
+    Search one corpus with the question and the conversation context; runs in a worker thread.
+    Returns:
+        list[list[ScoredChunk]]: The chunks retrieved for each query.
+    """
+    results = search_many(
+        query_embeddings,
+        [index],
+        allowed_rows=[allowed_rows],
+        query_texts=query_texts,
+        hybrid_options={
+            "pool_size": HYBRID_POOL_SIZE,
+            "rare_fraction": LEXICAL_RARE_FRACTION,
+            "max_candidates": LEXICAL_MAX_CANDIDATES,
+        }
+    )
+    return [query_results[0] for query_results in results]
 
 
 async def send_message(
     message: str,
-    crawls_chunks_text_and_embedding: list[ChunkAndEmbedding],
-    message_chunks_text_and_embedding: list[ChunkAndEmbedding],
-    message_history: list[str],
+    crawls_chunks_text_and_embedding: EmbeddingIndex,
+    message_chunks_text_and_embedding: EmbeddingIndex,
+    message_history: ChatConversation,
     message_history_size: int = 5,
     chat_message_history: list[Message] | None = None,
-    user_message_history: list[Message] | None = None
+    user_message_history: list[Message] | None = None,
+    bot_id: int | None = None,
+    chat_id: int | None = None,
+    on_partial_answer: Callable[[str], Awaitable[None]] | None = None,
+    user_id: int | None = None,
+    query_embeddings: list | None = None,
+    timer: StageTimer | None = None
 ) -> str:
-    message_embedding = get_embedding(message)
-    if message_embedding is None:
-        raise ValueError("Could not get embedding for the message.")
-    retrived_content = get_top_k_similar_text(message_embedding, crawls_chunks_text_and_embedding)
-    retrived_relevant_message_chunks = get_top_k_similar_text(message_embedding, message_chunks_text_and_embedding)
-    previous_messages = "\n".join(message_history[-message_history_size:])
-    if previous_messages:
-        previous_messages_embedding = get_embedding(previous_messages)
-        previous_messages_retrieved_content = get_top_k_similar_text(previous_messages_embedding, crawls_chunks_text_and_embedding)
-        previous_messages_retrieved_relevant_message_chunks = get_top_k_similar_text(previous_messages_embedding, message_chunks_text_and_embedding)
-    else:
-        previous_messages_retrieved_content = ""
-        previous_messages_retrieved_relevant_message_chunks = ""
-
-    prompt = f"""You are a helpful assistant answering based on documentation.
-    Answer the question based on the relevant documentation and historical context below.
-    Limit your answer to 200 words by summarizing. In case the user is vague, ask for clarification.
-    If the question is not relevant to the documentation, say "I don't know".
-    Question:
-    {message}
-    Previous questions and answers:
-    {previous_messages}
-    Relevant documentation:
-    {retrived_content}
-    {previous_messages_retrieved_content}
-    Relevant historical context from other conversations:
-    {retrived_relevant_message_chunks}
-    {previous_messages_retrieved_relevant_message_chunks}
-    """
-    if chat_message_history:
-        prompt += "\nThis the last few messages from the current chat feel free to use this to answer the question:"
-        for chat_message in chat_message_history:
-            prompt += f"\n{chat_message.message} (from {chat_message.chat_name}) at {chat_message.created_at if chat_message.created_at else 'unknown time'}"
-    if user_message_history:
-        prompt += "\nThis the last few messages from the current user across all chats asking the question ONLY use this IF it answers the question the information below is very sensitive:"
-        for user_message in user_message_history:
-            prompt += f"\n{user_message.message} (from {user_message.username}) at {user_message.created_at if user_message.created_at else 'unknown time'} from the chat {user_message.chat_name}"
-    client = OpenAI(api_key=OPEN_AI_API_KEY)
-    response = client.chat.completions.create(
+    timer = timer or StageTimer()
+    recent_turns = message_history.recent(message_history_size)
+    previous_messages = "\n".join(turn.text for turn in recent_turns)
+    if query_embeddings is None:
+        query_embeddings = await timer.timed("embedding", embed_question(message, recent_turns))
+    queries = [message, previous_messages][:len(query_embeddings)]
+    # Chat history is only searched among the chunks of chats the asking user is a member of.
+    allowed_message_rows = message_chunks_text_and_embedding.visible_rows(
+        user_id,
+        access_controlled="message_history_chunks" in MEMBER_COLUMNS
+    ) if ACCESS_FILTER_ENABLED else None
+    # The corpora are searched concurrently in the retrieval pool's threads; NumPy releases the GIL while scoring.
+    crawl_results, message_results = await asyncio.gather(
+        timer.timed("crawl_retrieval", get_retrieval_pool().run(retrieve, query_embeddings, queries, crawls_chunks_text_and_embedding)),
+        timer.timed("message_retrieval", get_retrieval_pool().run(retrieve, query_embeddings, queries, message_chunks_text_and_embedding, allowed_message_rows)),
+    )
+    # Cached answers are shared by everyone asking the bot in the chat, so with the cache on the prompt
+    # only carries shared context: the retrieved chunks (the access-filtered chat history chunks
+    # included, so users who can see different chats never share an answer) and the chat's
+    # conversation. The asking user's messages and the chat's latest raw messages, which change with
+    # every group message, are left out of both the prompt and the key.
+    answer_cache_scope = (bot_id, chat_id)
+    if ANSWER_CACHE_ENABLED:
+        chat_message_history = user_message_history = None
+        context_key = context_fingerprint(
+            previous_messages,
+            *(join_chunks(scored_chunks) for scored_chunks in crawl_results + message_results)
+        )
+        cached_answer = get_answer_cache().get(answer_cache_scope, query_embeddings[0], context_key)
+        if cached_answer is not None:
+            message_history.append(ConversationTurn(message, cached_answer))
+            return cached_answer
+
+    # Assembling the prompt is pure-Python string and token work, so it runs in the prompt pool, off the event loop.
+    prompt, prompt_stats = await timer.timed("prompt", get_prompt_pool().run(
+        build_prompt,
+        message,
+        previous_messages,
+        crawl_results,
+        message_results,
+        chat_message_history,
+        user_message_history,
+        PROMPT_TOKEN_BUDGET,
+        PROMPT_MESSAGE_TOKEN_BUDGET,
+        PROMPT_RELEVANCE_WEIGHT,
+        PROMPT_DUPLICATE_THRESHOLD
+    ))
+    logger.info(
+        f"Prompt for chat {chat_id}: {prompt_stats.tokens} tokens, {prompt_stats.chunks} chunks "
+        f"({prompt_stats.duplicate_chunks} duplicates and {prompt_stats.chunks_over_budget} over budget dropped), "
+        f"{prompt_stats.messages} messages ({prompt_stats.messages_over_budget} over budget dropped)"
+    )
+    _record_prompt(prompt_stats)
+    # Identical questions asked concurrently in the same bot with the same context share one completion;
+    # the whole prompt is keyed so chat and user history never reach an answer for someone else.
+    try:
+        response_message = await timer.timed("completion", completion_flight.do(
+            (bot_id, context_fingerprint(prompt)),
+            lambda: complete(prompt, on_partial_answer)
+        ))
+    except UpstreamUnavailable as e:
+        # Degraded answers are neither cached nor kept as conversation turns.
+        logger.warning(f"Sending a retrieval-only answer in chat {chat_id}: {str(e)}")
+        return fallback_answer(crawl_results[0])
+    if ANSWER_CACHE_ENABLED:
+        get_answer_cache().put(answer_cache_scope, query_embeddings[0], context_key, response_message)
+    message_history.append(ConversationTurn(message, response_message))
+    return response_message
+
+
+def _record_prompt(prompt_stats: PromptStats) -> None:
+    _prompt_counts["prompts"] += 1
+    _prompt_counts["tokens"] += prompt_stats.tokens
+    _prompt_counts["max_tokens"] = max(_prompt_counts["max_tokens"], prompt_stats.tokens)
+    _prompt_counts["duplicate_chunks"] += prompt_stats.duplicate_chunks
+    _prompt_counts["chunks_over_budget"] += prompt_stats.chunks_over_budget
+
+
+async def complete(prompt: str, on_partial_answer: Callable[[str], Awaitable[None]] | None = None) -> str:
+    """
+    Answer a prompt with the chat model, streaming it to `on_partial_answer` when given.
+    """
+    client = get_async_openai_client()
+    if on_partial_answer is None:
+        response = await completion_call.call(lambda: client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": prompt}],
+        ))
+        return response.choices[0].message.content.strip()
+    # A streamed answer is already being shown to the user, so it is never hedged.
+    return await completion_call.call(lambda: stream_completion(client, prompt, on_partial_answer), hedge=False)
+
+
+def fallback_answer(scored_chunks: list[ScoredChunk], snippets: int = FALLBACK_SNIPPETS, snippet_length: int = 400) -> str:
+    """
+    Build a degraded answer from the top retrieved documentation, for when the model is unavailable.
+    """
+    if not scored_chunks:
+        return "I can't answer right now, please try again in a few minutes."
+    excerpts = "\n\n".join(
+        f"- {' '.join(scored_chunk.chunk.split())[:snippet_length]}" for scored_chunk in scored_chunks[:snippets]
+    )
+    return f"I can't write a full answer right now, but these parts of the documentation look relevant:\n\n{excerpts}"
+
+
+def lexical_fallback_answer(message: str, index: EmbeddingIndex) -> str:
+    """
+    Build a degraded answer from a keyword search, for when the question cannot even be embedded.
+    """
+    if index is None or index.lexical is None:
+        return fallback_answer([])
+    rows, _ = index.lexical.search(message, FALLBACK_SNIPPETS)
+    return fallback_answer([ScoredChunk(row=int(row), chunk=index.chunks[row], score=0.0) for row in rows])
+
+
+async def stream_completion(client, prompt: str, on_partial_answer: Callable[[str], Awaitable[None]]) -> str:
+    """
+    Run the completion in streaming mode, passing the answer so far to `on_partial_answer` as tokens arrive.
+    Returns:
+        str: The full answer.
+    """
+    stream = await client.chat.completions.create(
         model="gpt-4o-mini",
         messages=[{"role": "user", "content": prompt}],
+        stream=True,
     )
-    response_message = response.choices[0].message.content.strip()
-    message_history.append(f"User: {message}\nAssistant: {response_message}")
-    return response_message
+    answer = ""
+    async for chunk in stream:
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+        answer += chunk.choices[0].delta.content
+        await on_partial_answer(answer)
+    return answer.strip()
 
 
 # Given a query embedding, compute the text of all the documentation pages which are the most relevant to the query.
-def get_top_k_similar_text(query_embedding, chunks_text_and_embedding, k=5):
-    similarities = []
-    for chunk in chunks_text_and_embedding:
-        sim = 1 - cosine(query_embedding, chunk.embedding)  # cosine similarity
-        similarities.append((chunk.chunk, sim))
-    similarities.sort(key=lambda x: x[1], reverse=True)
-    best_chunks = list(map(lambda x: x[0], similarities[:k]))
-    return "\n".join(best_chunks)
+def get_top_k_similar_text(
+    query_embedding: list[float],
+    chunks_text_and_embedding: EmbeddingIndex | list[ChunkAndEmbedding],
+    k: int = 5
+) -> str:
+    if not isinstance(chunks_text_and_embedding, EmbeddingIndex):
+        chunks_text_and_embedding = EmbeddingIndex.from_chunks(chunks_text_and_embedding)
+    return join_chunks(chunks_text_and_embedding.search(query_embedding, k=k))
+
+
+def join_chunks(scored_chunks: list[ScoredChunk]) -> str:
+    return "\n".join(scored_chunk.chunk for scored_chunk in scored_chunks)
 
 
-def get_chunks_text_and_embedding(
+def build_index(
     table_name: str,
-    chunk_column_name: str = 'chunk',
-    embedding_column_name: str = 'chunk_embedding'
-) -> list[ChunkAndEmbedding]:
-    supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY)
-    response = (
-        supabase_client.table(table_name)
-        .select(f"{chunk_column_name}, {embedding_column_name}")
-        .not_.is_(embedding_column_name, None)
-        .execute()
-    )
-    rows = response.data
-    return list(map(lambda row: ChunkAndEmbedding(
-        chunk=row[chunk_column_name],
-        embedding=row[embedding_column_name]
-    ), rows))
+    index: EmbeddingIndex,
+    storage: str = "float32",
+    retrieval_index: str = RETRIEVAL_INDEX,
+    lexical: bool = False
+) -> EmbeddingIndex:
+    """
+    Build the retrieval index for a corpus, using the approximate IVF index for large corpora.
+    Args:
+        table_name (str): The table the chunks were loaded from, used to name the saved IVF index.
+        index (EmbeddingIndex): The exact index over the loaded chunks.
+        storage (str): How the embeddings are kept in memory: float32, float16 or int8.
+        retrieval_index (str): The search mode: exact, ivf, auto or two_stage.
+        lexical (bool): Whether to attach a lexical index for hybrid search.
+    Returns:
+        EmbeddingIndex: The exact index, or an IVFIndex or TwoStageIndex searched through the same interface.
+    """
+    index = index.quantized(storage)
+    if lexical and index.lexical is None:
+        index.lexical = LexicalIndex.build(index.chunks)
+    index_type = expected_index_params(retrieval_index, len(index), index.dimension)["index_type"]
+    if index_type == "two_stage":
+        return TwoStageIndex.from_index(index, prefix_dims=TWO_STAGE_PREFIX_DIMS, pool_size=TWO_STAGE_POOL_SIZE)
+    if index_type == "exact":
+        return index
+    index_path = os.path.join(IVF_INDEX_DIR, table_name) if IVF_INDEX_DIR else None
+    fingerprint = index.fingerprint() if index_path else None
+    # The saved clustering is only reused for the very same rows, texts and embeddings.
+    if index_path and IVFIndex.saved_fingerprint(index_path) == fingerprint:
+        saved_index = IVFIndex.load(index_path, nprobe=IVF_NPROBE)
+        # Older saves may lack the membership or lexical index this corpus needs.
+        if index.members is not None and saved_index.members is None:
+            logger.warning(f"Saved IVF index for {table_name} has no membership index, rebuilding it")
+        elif index.lexical is None or saved_index.lexical is not None:
+            if index.members is not None:
+                # Chat members change without changing the fingerprint, so the saved posting lists
+                # are replaced by the ones just loaded, in the saved row order.
+                order = np.argsort(index.row_ids)
+                saved_index.members = index.members.take(order[np.searchsorted(index.row_ids, saved_index.row_ids, sorter=order)])
+            logger.info(f"Loaded IVF index for {table_name} from {index_path}")
+            return saved_index
+    ivf_index = IVFIndex.build(index, nprobe=IVF_NPROBE)
+    if index_path:
+        ivf_index.save(index_path, fingerprint)
+    return ivf_index
+
+
+def expected_index_params(retrieval_index: str, rows: int, dimension: int) -> dict:
+    """
+    Return the kind and parameters of the index `build_index` builds for a corpus, in the form of `index_params`.
+    Args:
+        retrieval_index (str): The search mode: exact, ivf, auto or two_stage.
+        rows (int): The number of chunks in the corpus.
+        dimension (int): The dimension of the embeddings.
+    Returns:
+        dict: The index type, with the two-stage parameters for a two-stage index.
+    """
+    if rows == 0:
+        return {"index_type": "exact"}
+    if retrieval_index == "two_stage":
+        # Vectors no longer than the prefix are searched exactly.
+        if dimension <= TWO_STAGE_PREFIX_DIMS:
+            return {"index_type": "exact"}
+        return {"index_type": "two_stage", "prefix_dims": TWO_STAGE_PREFIX_DIMS, "pool_size": TWO_STAGE_POOL_SIZE}
+    if retrieval_index == "ivf" or (retrieval_index == "auto" and rows >= ANN_MIN_CORPUS_SIZE):
+        return {"index_type": "ivf"}
+    return {"index_type": "exact"}
+
+
+def _snapshot_usable(name: str, index: EmbeddingIndex, table_name: str, storage: str, retrieval_index: str) -> bool:
+    # A snapshot written with another embedding storage or retrieval index, or without the
+    # membership index the table needs, is replaced by a fresh load.
+    if index.storage != storage:
+        return False
+    if table_name in MEMBER_COLUMNS and index.members is None:
+        logger.warning(f"Snapshot of {name} has no membership index, rebuilding it")
+        return False
+    expected = expected_index_params(retrieval_index, len(index), index.dimension)
+    params = index_params(index)
+    if any(params.get(key) != value for key, value in expected.items()):
+        logger.info(f"Rebuilding {name}: its snapshot holds {params}, the configuration asks for {expected}")
+        return False
+    return True
+
+
+def load_corpus(table_name: str, bot_id: int | None = None) -> EmbeddingIndex:
+    """
+    Load the retrieval index of a chunk table, from its memory-mapped snapshot when there is one.
+
+    Without a snapshot the table is downloaded, and a snapshot is written when SNAPSHOT_DIR
+    is set so the next start is near-instant. Rows added since the snapshot are applied
+    afterwards by the corpus refresher.
+    Args:
+        table_name (str): The chunk table to load.
+        bot_id (int | None): Only load this bot's partition of the table.
+    Returns:
+        EmbeddingIndex: The index over the table or partition.
+    """
+    name = partition_name(table_name, bot_id)
+    storage = CORPUS_EMBEDDING_STORAGE.get(table_name, EMBEDDING_STORAGE)
+    retrieval_index = CORPUS_RETRIEVAL_INDEX.get(table_name, RETRIEVAL_INDEX)
+    if SNAPSHOT_DIR:
+        index = load_snapshot(SNAPSHOT_DIR, name, nprobe=IVF_NPROBE)
+        if index is not None and _snapshot_usable(name, index, table_name, storage, retrieval_index):
+            if not LEXICAL_SEARCH_ENABLED or index.lexical is not None:
+                return index
+            index.lexical = LexicalIndex.build(index.chunks)
+            return save_snapshot(index, SNAPSHOT_DIR, name)
+    index = build_index(name, load_index(table_name, bot_id=bot_id), storage=storage, retrieval_index=retrieval_index, lexical=LEXICAL_SEARCH_ENABLED)
+    if SNAPSHOT_DIR:
+        index = save_snapshot(index, SNAPSHOT_DIR, name)
+    return index
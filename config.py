@@ -1,7 +1,7 @@
 """Configuration settings and constants for the Artemis Telegram Bot."""
 
 import os
-from typing import Dict, Any
+
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -19,4 +19,130 @@ LOG_FILE = os.getenv("LOG_FILE", "logs/supportbot.log")
 SUPABASE_URL = os.getenv("SUPABASE_PROJECT_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_PROJECT_KEY")
 
-OPEN_AI_API_KEY = os.getenv("OPEN_AI_API_KEY")
\ No newline at end of file
+OPEN_AI_API_KEY = os.getenv("OPEN_AI_API_KEY")
+
+# Retrieval configuration
+# "exact" scans every chunk, "ivf" always uses the approximate index, "auto" switches to it for large corpora,
+# "two_stage" scans truncated embeddings and reranks the best candidates with the full ones.
+# CORPUS_RETRIEVAL_INDEX overrides it per table, e.g. "crawled_url_chunks=two_stage"
+RETRIEVAL_INDEX = os.getenv("RETRIEVAL_INDEX", "auto")
+CORPUS_RETRIEVAL_INDEX = dict(
+    item.strip().split("=", 1) for item in os.getenv("CORPUS_RETRIEVAL_INDEX", "").split(",") if item.strip()
+)
+TWO_STAGE_PREFIX_DIMS = int(os.getenv("TWO_STAGE_PREFIX_DIMS", "256"))
+TWO_STAGE_POOL_SIZE = int(os.getenv("TWO_STAGE_POOL_SIZE", "100"))
+ANN_MIN_CORPUS_SIZE = int(os.getenv("ANN_MIN_CORPUS_SIZE", "50000"))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "8"))
+IVF_INDEX_DIR = os.getenv("IVF_INDEX_DIR")
+
+# OpenAI HTTP connection pool, shared by the bot and the agent_code scripts
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+
+# Embedding cache; the on-disk tier is only used when EMBEDDING_CACHE_PATH is set
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")
+
+# How often cache and pool statistics are written to the log, in seconds (0 disables it)
+STATS_LOG_INTERVAL = float(os.getenv("STATS_LOG_INTERVAL", "300"))
+
+# Semantic answer cache; answers are reused for near-duplicate questions asked in the same bot and chat
+# with the same retrieved chunks and conversation. With the cache on, prompts leave out the asking
+# user's and the chat's latest raw messages, so an answer can be shared by every member of the chat
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+
+# Streamed answers: a placeholder reply is edited as tokens arrive, at most once per interval (seconds)
+STREAM_ANSWERS = os.getenv("STREAM_ANSWERS", "true").lower() == "true"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+STREAM_GROUP_EDIT_INTERVAL = float(os.getenv("STREAM_GROUP_EDIT_INTERVAL", "3.0"))
+
+# Background corpus refresh; new and newly embedded chunks are merged into the live indexes
+CORPUS_REFRESH_INTERVAL = float(os.getenv("CORPUS_REFRESH_INTERVAL", "300"))
+# Optional timestamp column used to also pick up chunks whose text or embedding was changed in place
+CORPUS_UPDATED_AT_COLUMN = os.getenv("CORPUS_UPDATED_AT_COLUMN")
+
+# Memory-mapped corpus snapshots; when set, the bot starts from the newest snapshot plus a DB delta
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR")
+
+# Per-bot partitions of the chat history corpus, loaded on a bot's first question and evicted
+# least recently used first once the loaded partitions take more than this many megabytes
+PARTITION_CACHE_MAX_MB = float(os.getenv("PARTITION_CACHE_MAX_MB", "1024"))
+
+# How corpus embeddings are kept in memory: "float32", "float16" (half the memory, slower exact scans)
+# or "int8" (a quarter of the memory, per-row scaled, recall@5 within a few percent of float32).
+# Two-stage indexes keep their prefix embeddings in the same type.
+# CORPUS_EMBEDDING_STORAGE overrides it per table, e.g. "crawled_url_chunks=int8,message_history_chunks=float16"
+EMBEDDING_STORAGE = os.getenv("EMBEDDING_STORAGE", "float32")
+CORPUS_EMBEDDING_STORAGE = dict(
+    item.strip().split("=", 1) for item in os.getenv("CORPUS_EMBEDDING_STORAGE", "").split(",") if item.strip()
+)
+
+# Only search the chat history chunks whose chat_member_ids include the user asking the question
+ACCESS_FILTER_ENABLED = os.getenv("ACCESS_FILTER_ENABLED", "true").lower() == "true"
+
+# Keyword search: a BM25 index over the chunk texts is fused with the embedding ranking. The chunks holding
+# a question's identifiers (error codes, ticket ids, paths) are added to the embedding candidates.
+# Opt-in: fusion still lets keyword hits outrank lower embedding hits, see tests/test_hybrid_search.py.
+# Hybrid search runs the full dense scan plus the identifier rows and BM25, so it always costs more than
+# dense search: 1.1 vs 0.7 ms per query on 10k chunks and 11.4 vs 10.6 ms on 100k (256 dimensions,
+# agent_code.benchmark_retrieval --hybrid), finding the chunk of an error code in the top 5 every time
+# where dense search never did.
+LEXICAL_SEARCH_ENABLED = os.getenv("LEXICAL_SEARCH_ENABLED", "false").lower() == "true"
+HYBRID_POOL_SIZE = int(os.getenv("HYBRID_POOL_SIZE", "50"))
+LEXICAL_RARE_FRACTION = float(os.getenv("LEXICAL_RARE_FRACTION", "0.01"))
+LEXICAL_MAX_CANDIDATES = int(os.getenv("LEXICAL_MAX_CANDIDATES", "5000"))
+
+# Conversation context: the embeddings of the last turns are averaged, each turn weighing this much
+# less than the one after it, instead of embedding the joined history for every question
+CONVERSATION_EMBEDDING_DECAY = float(os.getenv("CONVERSATION_EMBEDDING_DECAY", "0.7"))
+
+# Conversation memory: the last turns of every (bot, chat), dropped after CONVERSATION_IDLE_TTL seconds
+# without a question and evicted least recently used first above CONVERSATION_MEMORY_MAX_MB.
+# With CONVERSATION_PERSIST, turns are also written to the conversation_turns table and read back on a miss;
+# create the table, its (bot_id, chat_id, created_at) index and the 30-day retention job with
+# supportbot/clients/conversations/conversation_turns.sql first
+CONVERSATION_MAX_TURNS = int(os.getenv("CONVERSATION_MAX_TURNS", "5"))
+CONVERSATION_IDLE_TTL = float(os.getenv("CONVERSATION_IDLE_TTL", "86400"))
+CONVERSATION_MEMORY_MAX_MB = float(os.getenv("CONVERSATION_MEMORY_MAX_MB", "64"))
+CONVERSATION_PERSIST = os.getenv("CONVERSATION_PERSIST", "false").lower() == "true"
+
+# Recent messages kept in memory per chat and per user for the question prompt, and the number of
+# chats and users kept; the messages table is only read for the ones not in memory
+RECENT_CHAT_MESSAGES = int(os.getenv("RECENT_CHAT_MESSAGES", "10"))
+RECENT_USER_MESSAGES = int(os.getenv("RECENT_USER_MESSAGES", "20"))
+RECENT_MESSAGES_MAX_KEYS = int(os.getenv("RECENT_MESSAGES_MAX_KEYS", "10000"))
+
+# Worker pools keeping CPU-bound question work off the event loop: threads for the NumPy retrieval,
+# and processes for building prompts (0 builds them in the retrieval threads)
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", str(min(4, os.cpu_count() or 1))))
+PROMPT_WORKERS = int(os.getenv("PROMPT_WORKERS", "0"))
+
+# Prompt size: the retrieved chunks are picked by relevance and diversity until the prompt reaches
+# PROMPT_TOKEN_BUDGET tokens, keeping PROMPT_MESSAGE_TOKEN_BUDGET of them for recent chat and user messages.
+# Chunks whose token sets overlap a picked chunk by PROMPT_DUPLICATE_THRESHOLD or more are dropped
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+PROMPT_MESSAGE_TOKEN_BUDGET = int(os.getenv("PROMPT_MESSAGE_TOKEN_BUDGET", "1000"))
+PROMPT_RELEVANCE_WEIGHT = float(os.getenv("PROMPT_RELEVANCE_WEIGHT", "0.7"))
+PROMPT_DUPLICATE_THRESHOLD = float(os.getenv("PROMPT_DUPLICATE_THRESHOLD", "0.8"))
+
+# Deadlines of the OpenAI calls in seconds. A call slower than the recent HEDGE_PERCENTILE latency is
+# hedged with a second identical request, and after BREAKER_FAILURE_THRESHOLD consecutive failures or
+# missed deadlines the calls are stopped for BREAKER_RESET_TIMEOUT seconds. Meanwhile questions get a
+# degraded answer quoting the FALLBACK_SNIPPETS best documentation chunks
+EMBEDDING_DEADLINE = float(os.getenv("EMBEDDING_DEADLINE", "5"))
+COMPLETION_DEADLINE = float(os.getenv("COMPLETION_DEADLINE", "45"))
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "true").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+FALLBACK_SNIPPETS = int(os.getenv("FALLBACK_SNIPPETS", "3"))
+
+# Supabase queries share one async client and its connection pool; at most SUPABASE_MAX_CONCURRENCY
+# of them run at once and the others wait without blocking the event loop
+SUPABASE_MAX_CONCURRENCY = int(os.getenv("SUPABASE_MAX_CONCURRENCY", "10"))
@@ -11,10 +11,22 @@ import sys
 from dotenv import load_dotenv
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
 
+from agent_utils import (get_answer_cache, get_prompt_pool, get_retrieval_pool,
+                         load_corpus)
+from config import (CONVERSATION_IDLE_TTL, CONVERSATION_MAX_TURNS,
+                    CONVERSATION_MEMORY_MAX_MB, CONVERSATION_PERSIST,
+                    CORPUS_REFRESH_INTERVAL, CORPUS_UPDATED_AT_COLUMN,
+                    PARTITION_CACHE_MAX_MB, SNAPSHOT_DIR, STATS_LOG_INTERVAL)
+from supportbot.clients.conversations.conversation_client import \
+    ConversationClient
+from supportbot.clients.supabase.connection import supabase_connection
 from supportbot.handlers.message_handlers import (handle_group_message,
                                                   handle_message, help_command,
                                                   welcome_message)
-from agent_utils import get_chunks_text_and_embedding
+from supportbot.metrics import log_stats_periodically, register_stats
+from supportbot.retrieval.conversation_memory import ConversationMemory
+from supportbot.retrieval.corpus_refresher import CorpusRefresher
+from supportbot.retrieval.partitioned_index import PartitionedIndexCache
 
 # Load environment variables
 load_dotenv()
@@ -71,6 +83,44 @@ def signal_handler(signum, frame):
     sys.exit(0)
 
 
+async def post_init(application: Application) -> None:
+    """Start the background tasks that live as long as the bot."""
+    if STATS_LOG_INTERVAL > 0:
+        application.create_task(log_stats_periodically(STATS_LOG_INTERVAL))
+    await get_prompt_pool().start()
+    register_stats("supabase", supabase_connection.stats)
+    # Crawled docs are not tied to a bot yet, so every bot searches the same crawl corpus.
+    bot_data = application.bot_data
+    refresher = CorpusRefresher(
+        'crawled_url_chunks',
+        get_index=lambda: bot_data["crawls_chunks_text_and_embedding"],
+        set_index=lambda index: bot_data.__setitem__("crawls_chunks_text_and_embedding", index),
+        updated_at_column=CORPUS_UPDATED_AT_COLUMN,
+        snapshot_dir=SNAPSHOT_DIR,
+        # Every bot searches the crawl corpus, so a change to it makes every cached answer stale.
+        on_refresh=lambda bot_id: get_answer_cache().invalidate()
+    )
+    register_stats("crawled_url_chunks_refresher", refresher.stats)
+    if SNAPSHOT_DIR:
+        # Apply the rows added since the snapshot was written before serving questions.
+        await refresher.refresh()
+    if CORPUS_REFRESH_INTERVAL > 0:
+        application.create_task(refresher.run(CORPUS_REFRESH_INTERVAL))
+
+    register_stats("conversation_memory", bot_data["conversation_memory"].stats)
+    message_chunk_partitions: PartitionedIndexCache = bot_data["message_chunk_partitions"]
+    register_stats("message_history_chunks_partitions", message_chunk_partitions.stats)
+    if CORPUS_REFRESH_INTERVAL > 0:
+        application.create_task(message_chunk_partitions.run(CORPUS_REFRESH_INTERVAL))
+
+
+async def post_shutdown(application: Application) -> None:
+    """Release the connections and workers that live as long as the bot."""
+    await supabase_connection.close()
+    get_prompt_pool().shutdown()
+    get_retrieval_pool().shutdown()
+
+
 def main():
     """Start the bot."""
     logger.info("Initializing bot...")
@@ -87,7 +137,7 @@ def main():
     try:
         logger.info("Creating Telegram application...")
         # Create the Application
-        application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+        application = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
 
         logger.info("Adding handlers...")
         # Add handlers
@@ -115,9 +165,26 @@ def main():
             MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, welcome_message)
         )
 
-        application.bot_data["crawls_chunks_text_and_embedding"] = get_chunks_text_and_embedding('crawled_url_chunks')
-        application.bot_data["message_chunks_text_and_embedding"] = get_chunks_text_and_embedding('message_history_chunks')
-        application.bot_data["message_history"] = []
+        application.bot_data["crawls_chunks_text_and_embedding"] = load_corpus('crawled_url_chunks')
+        # Chat history is partitioned by bot, each partition is loaded on the bot's first question.
+        application.bot_data["message_chunk_partitions"] = PartitionedIndexCache(
+            'message_history_chunks',
+            load_partition=lambda bot_id: load_corpus('message_history_chunks', bot_id=bot_id),
+            max_bytes=int(PARTITION_CACHE_MAX_MB * 2**20),
+            refresh_options={
+                "updated_at_column": CORPUS_UPDATED_AT_COLUMN,
+                "snapshot_dir": SNAPSHOT_DIR,
+                # A change to a bot's partition only makes that bot's cached answers stale.
+                "on_refresh": lambda bot_id: get_answer_cache().invalidate(bot_id=bot_id),
+            }
+        )
+        # The recent turns of every chat, used as the context of its follow-up questions.
+        application.bot_data["conversation_memory"] = ConversationMemory(
+            max_turns=CONVERSATION_MAX_TURNS,
+            idle_ttl=CONVERSATION_IDLE_TTL,
+            max_bytes=int(CONVERSATION_MEMORY_MAX_MB * 2**20),
+            client=ConversationClient() if CONVERSATION_PERSIST else None
+        )
 
         # Start the bot
         logger.info("Starting bot...")
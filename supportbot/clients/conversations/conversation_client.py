@@ -0,0 +1,63 @@
+import json
+import logging
+
+from supportbot.clients.supabase.connection import supabase_connection
+from supportbot.retrieval.conversation_context import ConversationTurn
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationClient:
+    """
+    Stores the question and answer turns of the bot's conversations in the `conversation_turns` table,
+    created with conversation_turns.sql next to this module.
+    """
+    def __init__(self, table: str = "conversation_turns"):
+        self.table = table
+
+    async def save_turn(self, bot_id: int | None, chat_id: int, turn: ConversationTurn) -> bool:
+        """
+        Insert one turn of a chat's conversation.
+        Args:
+            bot_id (int | None): The bot that answered.
+            chat_id (int): The chat the question was asked in.
+            turn (ConversationTurn): The question and its answer.
+        Returns:
+            bool: Whether the turn was saved.
+        """
+        try:
+            await supabase_connection.execute(lambda client: client.table(self.table).insert({
+                'bot_id': bot_id,
+                'chat_id': chat_id,
+                'question': turn.question,
+                'answer': turn.answer,
+            }))
+            return True
+        except Exception as e:
+            logger.error(f"Error saving conversation turn: {str(e)}")
+            return False
+
+    async def get_recent_turns(self, bot_id: int | None, chat_id: int, limit: int = 5) -> list[ConversationTurn]:
+        """
+        Retrieve the last turns of a chat's conversation, oldest first.
+        Args:
+            bot_id (int | None): The bot that answered.
+            chat_id (int): The chat to retrieve the turns for.
+            limit (int): The maximum number of turns to retrieve.
+        Returns:
+            list[ConversationTurn]: The turns, empty when there are none or on error.
+        """
+        try:
+            def build_query(client):
+                query = client.table(self.table).select("question, answer").eq("chat_id", chat_id)
+                query = query.is_("bot_id", None) if bot_id is None else query.eq("bot_id", bot_id)
+                return query.order("created_at", desc=True).limit(limit)
+            response = await supabase_connection.execute(build_query)
+            response_json = json.loads(response.json())
+            return [
+                ConversationTurn(question=item['question'], answer=item['answer'])
+                for item in reversed(response_json['data'])
+            ]
+        except Exception as e:
+            logger.error(f"Error retrieving conversation turns: {str(e)}")
+            return []
@@ -0,0 +1,30 @@
+-- Schema of the conversation_turns table used by ConversationClient when CONVERSATION_PERSIST is set.
+-- Run it once in the Supabase SQL editor (or with psql) before turning persistence on.
+
+create table if not exists conversation_turns (
+    id bigint generated always as identity primary key,
+    -- Null for chats without a bot, matched with `is null` by get_recent_turns.
+    bot_id bigint,
+    chat_id bigint not null,
+    question text not null,
+    answer text not null,
+    created_at timestamptz not null default now()
+);
+
+-- get_recent_turns reads the newest turns of one (bot, chat): an index-only range scan.
+create index if not exists conversation_turns_bot_chat_created_at_idx
+    on conversation_turns (bot_id, chat_id, created_at desc);
+
+-- Retention: only the last CONVERSATION_MAX_TURNS turns of a chat are ever read back, and a chat idle
+-- for CONVERSATION_IDLE_TTL (a day by default) starts without context, so turns are kept 30 days
+-- for support follow-ups and then deleted nightly with pg_cron (Database > Extensions in Supabase).
+create index if not exists conversation_turns_created_at_idx
+    on conversation_turns (created_at);
+
+create extension if not exists pg_cron;
+
+select cron.schedule(
+    'conversation-turns-retention',
+    '15 3 * * *',
+    $$delete from conversation_turns where created_at < now() - interval '30 days'$$
+);
@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 
+
 @dataclass
 class GenericChunk:
     identifier: str
@@ -10,3 +11,5 @@ class GenericChunk:
 class ChunkAndEmbedding:
     chunk: str
     embedding: list[float]
+    row_id: int | None = None
+    member_ids: list[int] | None = None
@@ -1,17 +1,12 @@
 import json
 import logging
 
-from supabase import Client, create_client
-
-from config import SUPABASE_KEY, SUPABASE_URL
+from supportbot.clients.supabase.connection import supabase_connection
 
 from .dataclasses import Message
 
 logger = logging.getLogger(__name__)
 class MessageClient:
-    def __init__(self):
-        self.supabase_client: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
     async def get_chat_history(self, chat_id: str, limit: int = 5) -> list[Message] | None:
         """
         Retrieve chat history for a specific chat ID.
@@ -22,23 +17,7 @@ class MessageClient:
             list: A list of messages in the chat history.
         """
         try:
-            response = (
-                self.supabase_client.table("messages")
-                .select("*")
-                .eq("chat_id", chat_id)
-                .order("created_at", desc=True)
-                .limit(limit)
-                .execute()
-            )
-            response_json = json.loads(response.json())
-            if response_json['data']:
-                # Convert the response data to Message dataclass instances
-                messages = [
-                    self._convert_to_message(item) for item in response_json['data']
-                ]
-                return messages
-            else:
-                return None
+            return await self.latest_messages("chat_id", chat_id, limit) or None
         except Exception as e:
             logger.error(f"Error retrieving chat history: {str(e)}")
             return None
@@ -53,27 +32,34 @@ class MessageClient:
             list: A list of messages sent by the user.
         """
         try:
-            response = (
-                self.supabase_client.table("messages")
-                .select("*")
-                .eq("username", user_id)
-                .order("created_at", desc=True)
-                .limit(limit)
-                .execute()
-            )
-            response_json = json.loads(response.json())
-            if response_json['data']:
-                # Convert the response data to Message dataclass instances
-                messages = [
-                    self._convert_to_message(item) for item in response_json['data']
-                ]
-                return messages
-            else:
-                return None
+            return await self.latest_messages("username", user_id, limit) or None
         except Exception as e:
             logger.error(f"Error retrieving user message history: {str(e)}")
             return None
 
+    async def latest_messages(self, column: str, value: str, limit: int) -> list[Message]:
+        """
+        Retrieve the latest messages whose `column` equals `value`, newest first.
+        Unlike the history getters, a failed query raises instead of returning None,
+        so callers can tell an error from a chat or user without messages.
+        Args:
+            column (str): The column to filter on, e.g. "chat_id" or "username".
+            value (str): The value the column must equal.
+            limit (int): The maximum number of messages to retrieve.
+        Returns:
+            list: The matching messages, empty if there are none.
+        """
+        response = await supabase_connection.execute(lambda client: (
+            client.table("messages")
+            .select("*")
+            .eq(column, value)
+            .order("created_at", desc=True)
+            .limit(limit)
+        ))
+        response_json = json.loads(response.json())
+        # Convert the response data to Message dataclass instances
+        return [self._convert_to_message(item) for item in response_json['data'] or []]
+
     """
     Private Helper Functions:
     """
@@ -0,0 +1,139 @@
+import logging
+from collections import OrderedDict, deque
+from typing import Hashable
+
+from .dataclasses import Message
+from .messages_client import MessageClient
+
+logger = logging.getLogger(__name__)
+
+
+class RecentMessageIndex:
+    """
+    Write-through cache of the latest messages of every chat and every user.
+
+    The handlers add each message right after inserting it into the `messages` table, so
+    the questions that follow read the chat and user history from memory instead of
+    querying the table. A chat or user seen for the first time is backfilled from the
+    table once; messages added while that read is in flight are merged into its rows, and
+    a failed read is not cached, so the next question reads the table again. At most
+    `max_keys` chats and users are kept, least recently used first out.
+    """
+    def __init__(
+        self,
+        chat_messages: int = 10,
+        user_messages: int = 20,
+        max_keys: int = 10000,
+        client: MessageClient | None = None
+    ) -> None:
+        self.chat_messages = chat_messages
+        self.user_messages = user_messages
+        self.max_keys = max_keys
+        self._client = client
+        self._messages: OrderedDict[tuple[str, Hashable], deque[Message]] = OrderedDict()
+        # Messages added to keys whose backfill is in flight, one buffer per backfill.
+        self._loading: dict[tuple[str, Hashable], list[list[Message]]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+
+    @property
+    def client(self) -> MessageClient:
+        # Created on first use, so importing the handlers does not open a database client.
+        if self._client is None:
+            self._client = MessageClient()
+        return self._client
+
+    def add(self, message: Message) -> None:
+        """
+        Record a message that was just inserted into the `messages` table.
+        """
+        for key in (("chat", message.chat_id), ("user", message.username)):
+            messages = self._messages.get(key)
+            if messages is not None:
+                messages.appendleft(message)
+            for added in self._loading.get(key, ()):
+                added.append(message)
+
+    async def get_chat_history(self, chat_id: str, limit: int = 10) -> list[Message] | None:
+        """
+        Return the latest messages of a chat, newest first, like `MessageClient.get_chat_history`.
+        """
+        return await self._get(("chat", chat_id), "chat_id", limit, self.chat_messages)
+
+    async def get_user_messsage_history(self, username: str, limit: int = 20) -> list[Message] | None:
+        """
+        Return the latest messages of a user across chats, newest first, like `MessageClient.get_user_messsage_history`.
+        """
+        return await self._get(("user", username), "username", limit, self.user_messages)
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "keys": len(self._messages),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / requests, 3) if requests else None,
+            "evictions": self.evictions,
+            "errors": self.errors,
+        }
+
+    async def _get(self, key: tuple[str, Hashable], column: str, limit: int, capacity: int) -> list[Message] | None:
+        if limit > capacity:
+            return await self._fetch(key, column, limit)
+        messages = self._messages.get(key)
+        if messages is not None:
+            self.hits += 1
+            self._messages.move_to_end(key)
+            return list(messages)[:limit] or None
+        self.misses += 1
+        added: list[Message] = []
+        self._loading.setdefault(key, []).append(added)
+        try:
+            fetched = await self.client.latest_messages(column, key[1], capacity)
+        except Exception as e:
+            logger.error(f"Error backfilling recent messages of {key[0]} {key[1]}: {str(e)}")
+            self.errors += 1
+            return None
+        finally:
+            self._loading[key].remove(added)
+            if not self._loading[key]:
+                del self._loading[key]
+        # A concurrent question may have loaded the key while the table was read; its deque
+        # already holds the messages added since.
+        messages = self._messages.get(key)
+        if messages is None:
+            messages = self._messages[key] = deque(merge_added(fetched, added), maxlen=capacity)
+            self._evict()
+        return list(messages)[:limit] or None
+
+    async def _fetch(self, key: tuple[str, Hashable], column: str, limit: int) -> list[Message] | None:
+        try:
+            return await self.client.latest_messages(column, key[1], limit) or None
+        except Exception as e:
+            logger.error(f"Error retrieving recent messages of {key[0]} {key[1]}: {str(e)}")
+            self.errors += 1
+            return None
+
+    def _evict(self) -> None:
+        while len(self._messages) > self.max_keys:
+            self._messages.popitem(last=False)
+            self.evictions += 1
+
+
+def merge_added(fetched: list[Message], added: list[Message]) -> list[Message]:
+    """
+    Merge the rows of a backfill with the messages added while it was in flight, newest first.
+
+    An added message is either among the rows, when it was inserted before the table was
+    read, or newer than all of them.
+    Args:
+        fetched (list[Message]): The rows read from the table, newest first.
+        added (list[Message]): The messages added during the read, oldest first.
+    Returns:
+        list: The merged messages, newest first.
+    """
+    fetched_ids = {(message.chat_id, message.update_id) for message in fetched}
+    newer = [message for message in reversed(added) if (message.chat_id, message.update_id) not in fetched_ids]
+    return newer + fetched
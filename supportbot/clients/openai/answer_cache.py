@@ -0,0 +1,151 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Hashable
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _CachedAnswer:
+    question_embedding: np.ndarray
+    context_key: str
+    answer: str
+    created_at: float
+
+
+class AnswerCache:
+    """
+    Semantic cache of LLM answers.
+
+    An answer is reused when a new question in the same scope is at least `threshold`
+    cosine-similar to a cached one and was answered from the same retrieved context.
+    Entries expire after `ttl` seconds and the least recently used ones are evicted
+    once `max_entries` answers are cached across all scopes.
+    """
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600, threshold: float = 0.95) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self._scopes: dict[Hashable, OrderedDict[int, _CachedAnswer]] = {}
+        self._lru: OrderedDict[tuple[Hashable, int], None] = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, scope: Hashable, question_embedding: list[float], context_key: str) -> str | None:
+        """
+        Return a cached answer for a near-duplicate question, or None.
+        Args:
+            scope (Hashable): The isolation scope, answers are never shared across scopes.
+            question_embedding (list[float]): The embedding of the new question.
+            context_key (str): The fingerprint of the context retrieved for the new question.
+        Returns:
+            str | None: The cached answer, or None on a miss.
+        """
+        query = _normalize(question_embedding)
+        now = time.monotonic()
+        with self._lock:
+            entries = self._scopes.get(scope, {})
+            best_id, best_score = None, self.threshold
+            for entry_id, entry in list(entries.items()):
+                if now - entry.created_at > self.ttl:
+                    self._remove(scope, entry_id)
+                    continue
+                if entry.context_key != context_key:
+                    continue
+                score = float(entry.question_embedding @ query)
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._lru.move_to_end((scope, best_id))
+            return entries[best_id].answer
+
+    def put(self, scope: Hashable, question_embedding: list[float], context_key: str, answer: str) -> None:
+        """
+        Cache the answer given to a question within a scope.
+        """
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._scopes.setdefault(scope, OrderedDict())[entry_id] = _CachedAnswer(
+                question_embedding=_normalize(question_embedding),
+                context_key=context_key,
+                answer=answer,
+                created_at=time.monotonic()
+            )
+            self._lru[(scope, entry_id)] = None
+            while len(self._lru) > self.max_entries:
+                (evicted_scope, evicted_id), _ = self._lru.popitem(last=False)
+                self._remove(evicted_scope, evicted_id)
+                self.evictions += 1
+
+    def invalidate(self, scope: Hashable | None = None, bot_id: int | None = None) -> None:
+        """
+        Drop the cached answers of one scope, of every scope of a bot, or of every scope when neither is given.
+        Called when the corpora the answers were built from are refreshed.
+        Args:
+            scope (Hashable | None): The scope to drop.
+            bot_id (int | None): Drop every `(bot_id, ...)` tuple scope of this bot.
+        """
+        with self._lock:
+            if scope is not None:
+                scopes = [scope]
+            elif bot_id is not None:
+                scopes = [cached_scope for cached_scope in self._scopes if isinstance(cached_scope, tuple) and cached_scope[:1] == (bot_id,)]
+            else:
+                scopes = list(self._scopes)
+            for invalidated_scope in scopes:
+                for entry_id in list(self._scopes.get(invalidated_scope, {})):
+                    self._remove(invalidated_scope, entry_id)
+        if scope is not None:
+            logger.info(f"Invalidated answer cache for {scope}")
+        elif bot_id is not None:
+            logger.info(f"Invalidated answer cache for {len(scopes)} chats of bot {bot_id}")
+        else:
+            logger.info("Invalidated answer cache for all scopes")
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._lru),
+            "scopes": len(self._scopes),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, scope: Hashable, entry_id: int) -> None:
+        entries = self._scopes.get(scope)
+        if entries is None:
+            return
+        entries.pop(entry_id, None)
+        self._lru.pop((scope, entry_id), None)
+        if not entries:
+            del self._scopes[scope]
+
+
+def context_fingerprint(*contexts: str) -> str:
+    """
+    Hash the retrieved context of a question so answers are only reused for identical context.
+    """
+    digest = hashlib.sha256()
+    for context in contexts:
+        digest.update(context.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _normalize(embedding: list[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
@@ -0,0 +1,173 @@
+import asyncio
+import atexit
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SQLITE_MAX_PARAMETERS = 500  # Keys looked up per SELECT, below SQLite's bound parameter limit.
+
+
+class EmbeddingCache:
+    """
+    Content-addressed cache of embeddings, keyed by model name and text.
+
+    Embeddings live in a size-bounded in-memory LRU. When a path is given they are also
+    written to a SQLite file, which survives restarts and is read on an in-memory miss.
+    Writes to the file are queued and committed in batches by a writer thread, at most
+    every `flush_interval` seconds, and `aget_many` reads the file in a worker thread,
+    so the event loop never waits on the disk.
+    """
+    def __init__(self, max_entries: int = 10000, path: str | None = None, flush_interval: float = 1.0) -> None:
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self._entries: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection: sqlite3.Connection | None = None
+        # Held while using the connection, which the writer thread and the lookups share.
+        self._disk_lock = threading.Lock()
+        self._pending: dict[str, tuple[str, bytes]] = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_writes = 0
+        self.disk_commits = 0
+        if path:
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, model TEXT, embedding BLOB)"
+            )
+            self._connection.commit()
+            threading.Thread(target=self._write_pending, name="embedding-cache-writer", daemon=True).start()
+            # The writer is a daemon thread, so the last batch is written at exit.
+            atexit.register(self.flush)
+
+    def get(self, text: str, model: str) -> np.ndarray | None:
+        """
+        Return the cached embedding of a text, or None if it was never stored.
+        Reads the disk tier in the calling thread; use `aget_many` from the event loop.
+        """
+        return self._lookup([_cache_key(text, model)])[0]
+
+    async def aget_many(self, texts: list[str], model: str) -> list[np.ndarray | None]:
+        """
+        Return the cached embeddings of several texts, None for the ones never stored.
+        Texts missing from memory are read from the disk tier in one worker thread call.
+        """
+        keys = [_cache_key(text, model) for text in texts]
+        embeddings = [self._get_memory(key) for key in keys]
+        missing = [key for key, embedding in zip(keys, embeddings) if embedding is None]
+        if missing and self._connection is not None:
+            found = await asyncio.to_thread(self._read_disk, missing)
+            embeddings = [self._found_on_disk(key, found) if embedding is None else embedding for key, embedding in zip(keys, embeddings)]
+        self.misses += sum(embedding is None for embedding in embeddings)
+        return embeddings
+
+    def put(self, text: str, model: str, embedding) -> np.ndarray:
+        """
+        Store the embedding of a text in memory and, if configured, queue it for the disk.
+        Returns:
+            np.ndarray: The stored float32 embedding.
+        """
+        key = _cache_key(text, model)
+        vector = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            self._remember(key, vector)
+            if self._connection is not None:
+                self._pending[key] = (model, vector.tobytes())
+        return vector
+
+    def flush(self) -> None:
+        """
+        Write the queued embeddings to the disk tier in one transaction.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending or self._connection is None:
+            return
+        with self._disk_lock:
+            try:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, model, embedding) VALUES (?, ?, ?)",
+                    [(key, model, blob) for key, (model, blob) in pending.items()]
+                )
+                self._connection.commit()
+                self.disk_writes += len(pending)
+                self.disk_commits += 1
+            except sqlite3.Error as e:
+                logger.error(f"Error writing {len(pending)} embeddings to the disk cache: {str(e)}")
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "pending_writes": len(self._pending),
+            "disk_writes": self.disk_writes,
+            "disk_commits": self.disk_commits,
+        }
+
+    def _lookup(self, keys: list[str]) -> list[np.ndarray | None]:
+        embeddings = [self._get_memory(key) for key in keys]
+        missing = [key for key, embedding in zip(keys, embeddings) if embedding is None]
+        if missing and self._connection is not None:
+            found = self._read_disk(missing)
+            embeddings = [self._found_on_disk(key, found) if embedding is None else embedding for key, embedding in zip(keys, embeddings)]
+        self.misses += sum(embedding is None for embedding in embeddings)
+        return embeddings
+
+    def _get_memory(self, key: str) -> np.ndarray | None:
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return embedding
+
+    def _read_disk(self, keys: list[str]) -> dict[str, np.ndarray]:
+        found = {}
+        with self._lock:
+            # Queued embeddings evicted from memory before being written are still readable.
+            for key in keys:
+                if key in self._pending:
+                    found[key] = np.frombuffer(self._pending[key][1], dtype=np.float32)
+        unwritten = [key for key in keys if key not in found]
+        with self._disk_lock:
+            for start in range(0, len(unwritten), SQLITE_MAX_PARAMETERS):
+                batch = unwritten[start:start + SQLITE_MAX_PARAMETERS]
+                rows = self._connection.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({', '.join('?' * len(batch))})", batch
+                ).fetchall()
+                found.update((key, np.frombuffer(blob, dtype=np.float32)) for key, blob in rows)
+        return found
+
+    def _found_on_disk(self, key: str, found: dict[str, np.ndarray]) -> np.ndarray | None:
+        embedding = found.get(key)
+        if embedding is not None:
+            with self._lock:
+                self._remember(key, embedding)
+                self.disk_hits += 1
+        return embedding
+
+    def _write_pending(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            if self._pending:
+                self.flush()
+
+    def _remember(self, key: str, embedding: np.ndarray) -> None:
+        self._entries[key] = embedding
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+def _cache_key(text: str, model: str) -> str:
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
@@ -0,0 +1,68 @@
+import logging
+import threading
+
+import httpx
+from openai import (AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient,
+                    OpenAI)
+
+from config import (OPEN_AI_API_KEY, OPENAI_CONNECT_TIMEOUT,
+                    OPENAI_KEEPALIVE_EXPIRY, OPENAI_MAX_CONNECTIONS,
+                    OPENAI_MAX_KEEPALIVE_CONNECTIONS, OPENAI_TIMEOUT)
+
+logger = logging.getLogger(__name__)
+
+_client: OpenAI | None = None
+_async_client: AsyncOpenAI | None = None
+_client_lock = threading.Lock()
+
+
+def get_openai_client() -> OpenAI:
+    """
+    Return the process-wide sync OpenAI client.
+
+    The client is created on first use and keeps its HTTP connections alive between
+    calls, so repeated embeddings and completions reuse the same TLS sessions.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OpenAI(
+                    api_key=OPEN_AI_API_KEY,
+                    timeout=_timeout(),
+                    http_client=DefaultHttpxClient(limits=_limits(), timeout=_timeout())
+                )
+                logger.info("Created pooled OpenAI client")
+    return _client
+
+
+def get_async_openai_client() -> AsyncOpenAI:
+    """
+    Return the process-wide async OpenAI client.
+
+    It must be first used from the event loop that will keep using it, which for the
+    bot is the loop started by `run_polling`.
+    """
+    global _async_client
+    if _async_client is None:
+        with _client_lock:
+            if _async_client is None:
+                _async_client = AsyncOpenAI(
+                    api_key=OPEN_AI_API_KEY,
+                    timeout=_timeout(),
+                    http_client=DefaultAsyncHttpxClient(limits=_limits(), timeout=_timeout())
+                )
+                logger.info("Created pooled async OpenAI client")
+    return _async_client
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+    )
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
@@ -0,0 +1,171 @@
+from dataclasses import dataclass
+
+import tiktoken
+
+from supportbot.clients.messages.dataclasses import Message
+from supportbot.retrieval.dataclasses import ScoredChunk
+
+_encoding = None
+
+
+@dataclass
+class PromptStats:
+    tokens: int
+    chunks: int
+    duplicate_chunks: int
+    chunks_over_budget: int
+    messages: int
+    messages_over_budget: int
+
+
+def encode(text: str) -> list[int]:
+    """
+    Tokenize text with cl100k_base, the encoding the chunks were cut with in agent_code.chunk_utils.
+    """
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    return _encoding.encode_ordinary(text)
+
+
+def build_prompt(
+    message: str,
+    previous_messages: str,
+    documentation: list[list[ScoredChunk]],
+    message_chunks: list[list[ScoredChunk]],
+    chat_message_history: list[Message] | None = None,
+    user_message_history: list[Message] | None = None,
+    token_budget: int = 6000,
+    message_token_budget: int = 1000,
+    relevance_weight: float = 0.7,
+    duplicate_threshold: float = 0.8
+) -> tuple[str, PromptStats]:
+    """
+    Assemble the completion prompt of a question within a token budget.
+
+    The instructions, the question and the previous turns are always included. The
+    retrieved chunks are then added by maximal marginal relevance: each step picks the
+    chunk with the best mix of retrieval score and dissimilarity to the chunks already
+    picked, measured as the Jaccard similarity of their token sets. Chunks at least
+    `duplicate_threshold` similar to a picked one are dropped as near-duplicates, and
+    chunks that no longer fit in the budget are skipped. Up to `message_token_budget`
+    tokens of the budget are kept for the recent chat and user messages, newest first.
+    Only takes strings, chunks and messages, so it can run in a worker process.
+    Args:
+        message (str): The question.
+        previous_messages (str): The previous turns of the chat's conversation.
+        documentation (list[list[ScoredChunk]]): The documentation retrieved per query, the question first.
+        message_chunks (list[list[ScoredChunk]]): The chat history chunks retrieved per query, the question first.
+        chat_message_history (list[Message] | None): The last messages of the current chat, newest first.
+        user_message_history (list[Message] | None): The last messages of the asking user, newest first.
+        token_budget (int): The maximum number of tokens of the prompt.
+        message_token_budget (int): The tokens kept for the chat and user messages.
+        relevance_weight (float): The weight of relevance against diversity when picking chunks.
+        duplicate_threshold (float): The token set similarity from which a chunk is a near-duplicate.
+    Returns:
+        tuple[str, PromptStats]: The prompt and what went into it.
+    """
+    sections = {"documentation": documentation, "message_chunks": message_chunks}
+    candidates = []
+    seen_texts = set()
+    duplicate_chunks = 0
+    for section, results in sections.items():
+        for scored_chunks in results:
+            for scored_chunk in scored_chunks:
+                if scored_chunk.chunk in seen_texts:
+                    duplicate_chunks += 1
+                    continue
+                seen_texts.add(scored_chunk.chunk)
+                tokens = encode(scored_chunk.chunk)
+                # A picked chunk also costs the newline joining it to its section.
+                candidates.append((section, scored_chunk, len(tokens) + 1, set(tokens)))
+
+    def assemble(selected: dict[str, list[str]], chat_lines: list[str], user_lines: list[str]) -> str:
+        prompt = f"""You are a helpful assistant answering based on documentation.
+    Answer the question based on the relevant documentation and historical context below.
+    Limit your answer to 200 words by summarizing. In case the user is vague, ask for clarification.
+    If the question is not relevant to the documentation, say "I don't know".
+    Question:
+    {message}
+    Previous questions and answers:
+    {previous_messages}
+    Relevant documentation:
+    {chr(10).join(selected["documentation"])}
+    Relevant historical context from other conversations:
+    {chr(10).join(selected["message_chunks"])}
+    """
+        if chat_lines:
+            prompt += "\nThis the last few messages from the current chat feel free to use this to answer the question:"
+            prompt += "".join(chat_lines)
+        if user_lines:
+            prompt += "\nThis the last few messages from the current user across all chats asking the question ONLY use this IF it answers the question the information below is very sensitive:"
+            prompt += "".join(user_lines)
+        return prompt
+
+    chat_lines = [
+        f"\n{chat_message.message} (from {chat_message.chat_name}) at {chat_message.created_at if chat_message.created_at else 'unknown time'}"
+        for chat_message in chat_message_history or []
+    ]
+    user_lines = [
+        f"\n{user_message.message} (from {user_message.username}) at {user_message.created_at if user_message.created_at else 'unknown time'} from the chat {user_message.chat_name}"
+        for user_message in user_message_history or []
+    ]
+    # The headers of the message sections are counted with the fixed part when there are messages.
+    fixed_tokens = len(encode(assemble({"documentation": [], "message_chunks": []}, [""] if chat_lines else [], [""] if user_lines else [])))
+    message_tokens = [len(encode(line)) for line in chat_lines + user_lines]
+    remaining = token_budget - fixed_tokens - min(message_token_budget, sum(message_tokens))
+
+    selected: dict[str, list[str]] = {"documentation": [], "message_chunks": []}
+    picked_sections: list[str] = []
+    picked_token_sets: list[set[int]] = []
+    chunks_over_budget = 0
+    while candidates:
+        def marginal_relevance(candidate) -> float:
+            redundancy = max((_jaccard(candidate[3], picked) for picked in picked_token_sets), default=0.0)
+            return relevance_weight * candidate[1].score - (1 - relevance_weight) * redundancy
+        best = max(candidates, key=marginal_relevance)
+        candidates.remove(best)
+        section, scored_chunk, token_count, token_set = best
+        if any(_jaccard(token_set, picked) >= duplicate_threshold for picked in picked_token_sets):
+            duplicate_chunks += 1
+        elif token_count > remaining:
+            chunks_over_budget += 1
+        else:
+            selected[section].append(scored_chunk.chunk)
+            picked_sections.append(section)
+            picked_token_sets.append(token_set)
+            remaining -= token_count
+
+    # Messages get their reserved tokens plus whatever the chunks left, newest first.
+    remaining += min(message_token_budget, sum(message_tokens))
+    kept = [False] * len(message_tokens)
+    for position, token_count in enumerate(message_tokens):
+        if token_count <= remaining:
+            kept[position] = True
+            remaining -= token_count
+    kept_chat_lines = [line for line, keep in zip(chat_lines, kept[:len(chat_lines)]) if keep]
+    kept_user_lines = [line for line, keep in zip(user_lines, kept[len(chat_lines):]) if keep]
+
+    prompt = assemble(selected, kept_chat_lines, kept_user_lines)
+    tokens = len(encode(prompt))
+    # Token counts of the pieces can differ from the count of the joined text by a few tokens at
+    # their boundaries, so the last picked chunks are dropped until the prompt really fits.
+    while tokens > token_budget and picked_sections:
+        selected[picked_sections.pop()].pop()
+        chunks_over_budget += 1
+        prompt = assemble(selected, kept_chat_lines, kept_user_lines)
+        tokens = len(encode(prompt))
+    return prompt, PromptStats(
+        tokens=tokens,
+        chunks=sum(len(chunks) for chunks in selected.values()),
+        duplicate_chunks=duplicate_chunks,
+        chunks_over_budget=chunks_over_budget,
+        messages=sum(kept),
+        messages_over_budget=len(kept) - sum(kept),
+    )
+
+
+def _jaccard(tokens: set[int], other: set[int]) -> float:
+    if not tokens or not other:
+        return 0.0
+    return len(tokens & other) / len(tokens | other)
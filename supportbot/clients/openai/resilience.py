@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, TypeVar
+
+import httpx
+import numpy as np
+import openai
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Hedge delays are only derived from the observed latencies once there are this many of them.
+MIN_LATENCY_SAMPLES = 20
+
+
+class UpstreamUnavailable(Exception):
+    """
+    Raised when an upstream call missed its deadline or its circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream that keeps failing or missing its deadlines.
+
+    After `failure_threshold` consecutive failures the breaker opens and calls are
+    refused for `reset_timeout` seconds. Then a single trial call is let through: its
+    success closes the breaker, its failure opens it again.
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.opened_at: float | None = None
+        self._trial_running = False
+        self.opens = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial_running:
+            self._trial_running = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    def record_cancelled(self) -> None:
+        # A cancelled trial, or one rejected for its request, neither closes nor reopens the
+        # breaker; the next call becomes the trial.
+        self._trial_running = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        # Failures of calls that started before the breaker opened do not restart its timeout.
+        if self._trial_running or (self.opened_at is None and self.consecutive_failures >= self.failure_threshold):
+            self.opens += 1
+            self.opened_at = time.monotonic()
+            logger.warning(f"Circuit breaker opened after {self.consecutive_failures} consecutive failures")
+        self._trial_running = False
+
+
+class ResilientCall:
+    """
+    Runs calls to one upstream under a deadline, with an optional hedged retry and a circuit breaker.
+
+    When the first attempt has not answered after the `hedge_percentile` latency of the
+    recent successful calls, a second identical attempt is started and the first answer
+    wins, which cuts the tail latency caused by one slow request. Only the latencies of
+    calls that may be hedged set that delay; calls that may not, such as streamed answers,
+    are tracked apart. Calls that miss the
+    deadline or fail on the upstream's side (see `is_upstream_failure`) count towards the
+    breaker; while it is open, calls fail at once with `UpstreamUnavailable` so the caller
+    can fall back instead of waiting. Errors of the request itself, like a 400 for a too
+    long input, are re-raised without touching the breaker.
+    """
+    def __init__(
+        self,
+        name: str,
+        deadline: float,
+        hedge: bool = True,
+        hedge_percentile: float = 0.95,
+        min_hedge_delay: float = 0.0,
+        breaker: CircuitBreaker | None = None,
+        window: int = 200
+    ) -> None:
+        self.name = name
+        self.deadline = deadline
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.breaker = breaker or CircuitBreaker()
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.unhedged_latencies: deque[float] = deque(maxlen=window)
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    async def call(self, fn: Callable[[], Awaitable[T]], hedge: bool = True) -> T:
+        """
+        Run `fn()` under the deadline, hedging it when enabled here and for this call.
+        Args:
+            fn (Callable[[], Awaitable[T]]): Starts one attempt; called again for the hedge.
+            hedge (bool): Whether this call may be hedged, e.g. not when it streams to the user.
+                Calls that may not are left out of the latencies the hedge delay is taken from.
+        Returns:
+            T: The result of the first attempt that succeeded.
+        """
+        if not self.breaker.allow():
+            raise UpstreamUnavailable(f"{self.name} circuit breaker is open")
+        self.calls += 1
+        started_at = time.monotonic()
+        attempts = [_start(fn)]
+        try:
+            async with asyncio.timeout(self.deadline):
+                hedge_delay = self.hedge_delay() if self.hedge and hedge else None
+                done, _ = await asyncio.wait(attempts, timeout=hedge_delay)
+                if not done:
+                    self.hedged += 1
+                    attempts.append(_start(fn))
+                winner = await _first_success(attempts)
+        except TimeoutError:
+            self.timeouts += 1
+            self.breaker.record_failure()
+            raise UpstreamUnavailable(f"{self.name} missed its {self.deadline:.1f}s deadline")
+        except asyncio.CancelledError:
+            self.breaker.record_cancelled()
+            raise
+        except Exception as e:
+            self.errors += 1
+            if is_upstream_failure(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_cancelled()
+            raise
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+        if winner is not attempts[0]:
+            self.hedge_wins += 1
+        (self.latencies if hedge else self.unhedged_latencies).append(time.monotonic() - started_at)
+        self.breaker.record_success()
+        return winner.result()
+
+    def hedge_delay(self) -> float | None:
+        """
+        Return how long to wait for the first attempt before hedging, or None while there are too few samples.
+        """
+        if len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        return max(self.min_hedge_delay, float(np.quantile(self.latencies, self.hedge_percentile)))
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "p50_ms": _quantile_ms(self.latencies, 0.5),
+            "p99_ms": _quantile_ms(self.latencies, 0.99),
+            "unhedged_p50_ms": _quantile_ms(self.unhedged_latencies, 0.5),
+            "unhedged_p99_ms": _quantile_ms(self.unhedged_latencies, 0.99),
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "breaker": self.breaker.state,
+            "breaker_opens": self.breaker.opens,
+            "rejected": self.breaker.rejected,
+        }
+
+
+def is_upstream_failure(error: Exception) -> bool:
+    """
+    Return whether an error says the upstream is unhealthy rather than the request wrong:
+    timeouts, connection errors, 5xx responses and 429 rate limits.
+    Args:
+        error (Exception): The error an attempt raised.
+    Returns:
+        bool: Whether the error counts towards the circuit breaker.
+    """
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError, OSError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        status_code = error.status_code
+    elif isinstance(error, httpx.HTTPStatusError):
+        status_code = error.response.status_code
+    else:
+        return False
+    return status_code >= 500 or status_code == 429
+
+
+def _quantile_ms(latencies: deque[float], quantile: float) -> int | None:
+    return round(float(np.quantile(latencies, quantile)) * 1000) if latencies else None
+
+
+def _start(fn: Callable[[], Awaitable[T]]) -> asyncio.Future:
+    attempt = asyncio.ensure_future(fn())
+    # A losing attempt's error is never awaited; read it so it is not reported as unhandled.
+    attempt.add_done_callback(lambda done: done.cancelled() or done.exception())
+    return attempt
+
+
+async def _first_success(attempts: list[asyncio.Future]) -> asyncio.Future:
+    # The first attempt to succeed wins; an attempt's error only counts once every attempt has failed.
+    pending = set(attempts)
+    error = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for attempt in done:
+            if attempt.exception() is None:
+                return attempt
+            error = attempt.exception()
+    raise error
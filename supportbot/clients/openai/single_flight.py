@@ -0,0 +1,88 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical upstream calls.
+
+    A call whose key is already in flight waits for that call's result instead of
+    starting its own. The upstream call runs as its own task, so it finishes for the
+    other waiters even when the caller that started it is cancelled. Nothing is kept
+    once a call finishes; caching results is left to the caches.
+    """
+    def __init__(self) -> None:
+        self._flights: dict[Hashable, tuple[asyncio.Task, int]] = {}
+        self.calls = 0
+        self.keys = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Return the result of `fn()`, sharing it with the concurrent calls for the same key.
+        """
+        async def call(_keys):
+            return [await fn()]
+        return (await self.do_many([key], call))[0]
+
+    async def do_many(self, keys: list[Hashable], fn: Callable[[list[Hashable]], Awaitable[list[T] | None]]) -> list[T | None]:
+        """
+        Resolve several keys, with one call of `fn` for the keys that are not already in flight.
+        Args:
+            keys (list[Hashable]): The keys to resolve.
+            fn (Callable): Called with the keys to resolve, returns their results in the same order, or None on failure.
+        Returns:
+            list[T | None]: One result per key, None for the keys whose call failed.
+        """
+        flights: dict[Hashable, tuple[asyncio.Task, int]] = {}
+        new_keys = []
+        for key in keys:
+            if key in flights:
+                self.shared += 1
+            elif key in self._flights:
+                flights[key] = self._flights[key]
+                self.shared += 1
+            else:
+                flights[key] = None
+                new_keys.append(key)
+        if new_keys:
+            task = asyncio.ensure_future(fn(new_keys))
+            self.calls += 1
+            self.keys += len(new_keys)
+            for position, key in enumerate(new_keys):
+                flights[key] = self._flights[key] = (task, position)
+            task.add_done_callback(lambda _: self._land(task, new_keys))
+        results = []
+        for key in keys:
+            task, position = flights[key]
+            # Shielded so a cancelled caller does not cancel the call the other callers wait for.
+            flight_results = await asyncio.shield(task)
+            results.append(None if flight_results is None else flight_results[position])
+        return results
+
+    def stats(self) -> dict:
+        return {
+            "upstream_calls": self.calls,
+            "upstream_keys": self.keys,
+            "saved": self.shared,
+        }
+
+    def _land(self, task: asyncio.Task, keys: list[Hashable]) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            # Raised to the waiters; read here too so a call nobody waits for anymore is not reported as unhandled.
+            logger.debug(f"Coalesced call failed: {task.exception()}")
+        for key in keys:
+            if self._flights.get(key, (None,))[0] is task:
+                del self._flights[key]
+
+
+def normalize_text(text: str) -> str:
+    """
+    Collapse whitespace so texts differing only in spacing share a call.
+    """
+    return " ".join(text.split())
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import time
+from typing import Any, Callable
+
+from postgrest import APIResponse
+from supabase import AsyncClient, acreate_client
+
+from config import SUPABASE_KEY, SUPABASE_MAX_CONCURRENCY, SUPABASE_URL
+
+logger = logging.getLogger(__name__)
+
+
+class SupabaseConnection:
+    """
+    The async Supabase client shared by every data-access client of the bot.
+
+    The client is created on first use, so its HTTP connection pool belongs to the bot's
+    event loop, and every query goes through that one pool instead of a client per
+    caller. At most `max_concurrency` queries run at once; the others wait their turn
+    without blocking the event loop, and the time they wait is counted so a saturated
+    pool shows up in the stats.
+    """
+    def __init__(self, url: str | None, key: str | None, max_concurrency: int) -> None:
+        self.url = url
+        self.key = key
+        self.max_concurrency = max_concurrency
+        self._client: AsyncClient | None = None
+        self._client_lock = asyncio.Lock()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.waiting = 0
+        self.queries = 0
+        self.errors = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_query = 0.0
+
+    async def client(self) -> AsyncClient:
+        """
+        Return the shared client, creating it on first use.
+        """
+        if self._client is None:
+            async with self._client_lock:
+                if self._client is None:
+                    self._client = await acreate_client(self.url, self.key)
+                    logger.info(f"Created Supabase client with up to {self.max_concurrency} concurrent queries")
+        return self._client
+
+    async def execute(self, build_query: Callable[[AsyncClient], Any]) -> APIResponse:
+        """
+        Build a query on the shared client and execute it once a slot is free.
+        Args:
+            build_query (Callable[[AsyncClient], Any]): Returns the query to execute, e.g.
+                `lambda client: client.table("messages").select("*")`.
+        Returns:
+            APIResponse: The response of the query.
+        """
+        query = build_query(await self.client())
+        queued_at = time.monotonic()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        started_at = time.monotonic()
+        wait = started_at - queued_at
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await query.execute()
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+            self.queries += 1
+            self.total_query += time.monotonic() - started_at
+
+    async def close(self) -> None:
+        """
+        Close the connection pool of the shared client.
+        """
+        if self._client is not None:
+            await self._client.postgrest.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "waiting": self.waiting,
+            "queries": self.queries,
+            "errors": self.errors,
+            "avg_wait_ms": round(self.total_wait * 1000 / self.queries, 1) if self.queries else None,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "avg_query_ms": round(self.total_query * 1000 / self.queries, 1) if self.queries else None,
+        }
+
+
+supabase_connection = SupabaseConnection(SUPABASE_URL, SUPABASE_KEY, SUPABASE_MAX_CONCURRENCY)
@@ -1,14 +1,10 @@
-import logging
-from supabase import create_client, Client
 import json
-from config import SUPABASE_KEY, SUPABASE_URL
+import logging
+
+from supportbot.clients.supabase.connection import supabase_connection
 
 logger = logging.getLogger(__name__)
 class Supabase:
-    def __init__(self):
-        self.supabase_client: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-
     async def get_row(self, table: str, primary_key: str, primary_data: str) -> dict:
         """
         Generic Get Function for retrieving a row from a Supabase table.
@@ -20,12 +16,11 @@ class Supabase:
             dict: The row data as a dictionary.
         """
         try:
-            response = (
-                self.supabase_client.table(table)
+            response = await supabase_connection.execute(lambda client: (
+                client.table(table)
                 .select("*")
                 .eq(primary_key, primary_data)
-                .execute()
-            )
+            ))
             response_json = json.loads(response.json())
             if response_json['data']:
                 if len(response_json['data']) > 1:
@@ -45,12 +40,11 @@ class Supabase:
             dict: The inserted row data as a dictionary.
     """
     async def insert_row(self, table, dict: dict) -> dict:
-        try: 
-            response = (
-                self.supabase_client.table(table)
+        try:
+            response = await supabase_connection.execute(lambda client: (
+                client.table(table)
                 .insert(dict)
-                .execute()
-            )
+            ))
             response_json = json.loads(response.json())
             data_response = response_json['data'][0]
             return data_response
@@ -69,12 +63,11 @@ class Supabase:
     """
     async def update_row(self, primary_key, primary_data, table, update_dict: dict) -> dict:
         try:
-            response = (
-                self.supabase_client.table(table)
+            response = await supabase_connection.execute(lambda client: (
+                client.table(table)
                 .update(update_dict)
                 .eq(primary_key, primary_data)
-                .execute()
-            )
+            ))
             response_json = json.loads(response.json())
             data_response = response_json['data'][0]
             return data_response
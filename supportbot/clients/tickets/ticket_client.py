@@ -3,9 +3,7 @@ import logging
 import re
 from typing import Dict, Optional
 
-from supabase import Client, create_client
-
-from config import SUPABASE_KEY, SUPABASE_URL
+from supportbot.clients.supabase.connection import supabase_connection
 from supportbot.clients.tickets.dataclasses import Ticket, TicketCreateMesage
 
 logger = logging.getLogger(__name__)
@@ -34,20 +32,16 @@ class TicketParser:
 
 class TicketClient:
     """Client for handling ticket operations."""
-    def __init__(self):
-        self.supabase_client: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
     async def get_open_tickets_for_bot(self, bot_id: str) -> list[Ticket]:
         """Get open tickets for a specific bot."""
         try:
             # Fetch tickets with status 'open' or 'in_progress'
-            response = (
-                self.supabase_client.table("tickets")
+            response = await supabase_connection.execute(lambda client: (
+                client.table("tickets")
                 .select("*")
                 .eq("bot_id", int(bot_id))
                 .eq("status", "open")
-                .execute()
-            )
+            ))
             response_json = json.loads(response.json())
             if response_json['data']:
                 return [Ticket(**item) for item in response_json['data']]
@@ -60,14 +54,13 @@ class TicketClient:
     async def get_in_progress_tickets_for_bot(self, bot_id: str) -> list[Ticket]:
         """Get in-progress tickets for a specific bot."""
         try:
-            response = (
-                self.supabase_client.table("tickets")
+            response = await supabase_connection.execute(lambda client: (
+                client.table("tickets")
                 .select("*")
                 .eq("bot_id", int(bot_id))
                 .eq("status", "in_progress")
                 .order("created_at", desc=True)
-                .execute()
-            )
+            ))
             response_json = json.loads(response.json())
             if response_json['data']:
                 return [Ticket(**item) for item in response_json['data']]
@@ -80,15 +73,14 @@ class TicketClient:
     async def get_closed_tickets_for_bot(self, bot_id: str, limit: int = 10) -> list[Ticket]:
         """Get closed tickets for a specific bot."""
         try:
-            response = (
-                self.supabase_client.table("tickets")
+            response = await supabase_connection.execute(lambda client: (
+                client.table("tickets")
                 .select("*")
                 .eq("bot_id", int(bot_id))
                 .eq("status", "resolved")
                 .order("created_at", desc=True)
                 .limit(limit)
-                .execute()
-            )
+            ))
             response_json = json.loads(response.json())
             if response_json['data']:
                 return [Ticket(**item) for item in response_json['data']]
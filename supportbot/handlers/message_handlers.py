@@ -1,16 +1,22 @@
 # flake8: noqa
+import asyncio
 import json
 import logging
 from dataclasses import asdict
+from typing import Awaitable, Callable
 
+import numpy as np
 from telegram import Update
 from telegram.ext import ContextTypes
 
-from agent_utils import send_message
+from agent_utils import embed_question, lexical_fallback_answer, send_message
+from config import (RECENT_CHAT_MESSAGES, RECENT_MESSAGES_MAX_KEYS,
+                    RECENT_USER_MESSAGES, STREAM_ANSWERS, STREAM_EDIT_INTERVAL,
+                    STREAM_GROUP_EDIT_INTERVAL)
 from message_history_utils import get_message_history
-from supportbot.clients.crawl.dataclasses import ChunkAndEmbedding
 from supportbot.clients.messages.dataclasses import Message, MessageMetadata
-from supportbot.clients.messages.messages_client import MessageClient
+from supportbot.clients.messages.recent_messages import RecentMessageIndex
+from supportbot.clients.openai.resilience import UpstreamUnavailable
 from supportbot.clients.supabase.supabase_client import Supabase
 from supportbot.clients.tickets.ticket_client import TicketClient
 from supportbot.handlers.bot_handlers import (handle_activate_bot_command,
@@ -18,10 +24,25 @@ from supportbot.handlers.bot_handlers import (handle_activate_bot_command,
                                               handle_build_bot_command)
 from supportbot.handlers.helper import (get_bot_for_chat, get_bot_for_user,
                                         get_user)
+from supportbot.handlers.streaming import StreamingReply, streaming_stats
 from supportbot.handlers.ticket_handlers import (handle_ticket_create_command,
                                                  handle_ticket_update_command)
+from supportbot.metrics import StageTimer, register_stats
+from supportbot.retrieval.conversation_memory import ChatConversation
+from supportbot.retrieval.embedding_index import EmbeddingIndex
 
 supabase_client = Supabase()
+recent_messages = RecentMessageIndex(
+    chat_messages=RECENT_CHAT_MESSAGES,
+    user_messages=RECENT_USER_MESSAGES,
+    max_keys=RECENT_MESSAGES_MAX_KEYS
+)
+register_stats("recent_messages", recent_messages.stats)
+register_stats("streaming", streaming_stats)
+EMPTY_INDEX = EmbeddingIndex([], np.empty((0, 0), dtype=np.float32))
+# The number of previous turns of the chat's conversation used as the context of a question
+MESSAGE_HISTORY_SIZE = 5
+QUESTION_ERROR_MESSAGE = "An error occurred while processing your question. Please try again later."
 logger = logging.getLogger(__name__)
 
 
@@ -79,6 +100,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             table='messages',
             dict=asdict(message)
         )
+        message.created_at = message_insert_response.get('created_at')
+        recent_messages.add(message)
         logger.info(f"Message doesn't start with =support, inserting into messages table: {message_insert_response}")
         return
 
@@ -137,21 +160,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     )
                 return await update.message.reply_text(response, parse_mode="Markdown")
             case "question":
-                crawls_chunks_text_and_embedding = context.bot_data.get("crawls_chunks_text_and_embedding")
-                message_chunks_text_and_embedding = context.bot_data.get("message_chunks_text_and_embedding")
-                message_history = context.bot_data.get("message_history")
-                message_client = MessageClient()
-                # Fetch chat history from the database
-                chat_message_history_postgres = await message_client.get_chat_history(chat_id, limit=10)
-                user_message_history = await message_client.get_user_messsage_history(username, limit=20)
-                response = await handle_question_command(stripped_message, crawls_chunks_text_and_embedding, message_chunks_text_and_embedding, message_history, chat_message_history_postgres, user_message_history)
-                if not response:
-                    return await update.message.reply_text(
-                        f"Error: No Reponse\n\n"
-                        f"Internal Error please reach out to the team"
-                    )
-                else:
-                    return await update.message.reply_text(response, parse_mode="Markdown")
+                return await answer_question(update, context, bot, stripped_message, edit_interval=STREAM_EDIT_INTERVAL)
             case "fetch_my_messages":
                 message_history_list = await get_message_history()
                 for message_history in message_history_list:
@@ -257,6 +266,8 @@ async def handle_group_message(update: Update, context: ContextTypes.DEFAULT_TYP
                 table='messages',
                 dict=asdict(message)
             )
+            message.created_at = message_insert_response.get('created_at')
+            recent_messages.add(message)
             logger.info(f"Message doesn't start with =support, inserting into messages table: {message_insert_response}")
         else:
             logger.info(f"Message doesn't start with =support and no bot is active in the chat, so no action taken.")
@@ -302,21 +313,7 @@ async def handle_group_message(update: Update, context: ContextTypes.DEFAULT_TYP
                 await update.message.reply_text(response, parse_mode="Markdown")
                 return
             case "question":
-                crawls_chunks_text_and_embedding = context.bot_data.get("crawls_chunks_text_and_embedding")
-                message_chunks_text_and_embedding = context.bot_data.get("message_chunks_text_and_embedding")
-                message_history = context.bot_data.get("message_history")
-                message_client = MessageClient()
-                # Fetch chat history from the database
-                chat_message_history_postgres = await message_client.get_chat_history(chat_id, limit=10)
-                user_message_history = await message_client.get_user_messsage_history(username, limit=20)
-                response = await handle_question_command(stripped_message, crawls_chunks_text_and_embedding, message_chunks_text_and_embedding, message_history, chat_message_history_postgres, user_message_history)
-                if not response:
-                    await update.message.reply_text(
-                        f"Error: No Reponse\n\n"
-                        f"Internal Error please reach out to the team"
-                    )
-                else:
-                    await update.message.reply_text(response, parse_mode="Markdown")
+                await answer_question(update, context, bot, stripped_message, edit_interval=STREAM_GROUP_EDIT_INTERVAL)
                 return
             case _:
                 await update.message.reply_text(
@@ -438,18 +435,105 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     """
     await update.message.reply_text(help_text, parse_mode='Markdown')
 
+async def get_message_chunks_for_bot(context: ContextTypes.DEFAULT_TYPE, bot) -> EmbeddingIndex:
+    """
+    Return the chat history index of the bot's own partition, loading it on its first question.
+    """
+    if not bot:
+        return EMPTY_INDEX
+    return await context.bot_data["message_chunk_partitions"].get(bot.bot_id)
+
+
+async def answer_question(update: Update, context: ContextTypes.DEFAULT_TYPE, bot, question: str, edit_interval: float) -> None:
+    """
+    Answer a `=support question` and reply with the answer, streamed when STREAM_ANSWERS is set.
+
+    The inputs of the answer do not depend on each other, so they are gathered concurrently:
+    the chat's conversation and the question embedding (which needs the conversation's
+    unembedded turns), the bot's chat history partition, and the recent chat and user
+    messages. The time of every stage is logged with the answer.
+    """
+    chat_id = update.effective_chat.id
+    bot_id = bot.bot_id if bot else None
+    timer = StageTimer()
+    answer_reply = StreamingReply(update.message, edit_interval=edit_interval)
+
+    async def embed():
+        message_history = await timer.timed("conversation", context.bot_data["conversation_memory"].get(bot_id, chat_id))
+        query_embeddings = await timer.timed("embedding", embed_question(question, message_history.recent(MESSAGE_HISTORY_SIZE)))
+        return message_history, query_embeddings
+
+    # Once the placeholder is sent every failure must replace it, or the reply is left at "…".
+    try:
+        inputs = await asyncio.gather(
+            embed(),
+            timer.timed("partition", get_message_chunks_for_bot(context, bot)),
+            # Recent chat and user history is served from memory, the database is only read on a miss
+            timer.timed("chat_history", recent_messages.get_chat_history(chat_id, limit=10)),
+            timer.timed("user_history", recent_messages.get_user_messsage_history(update.effective_sender.username, limit=20)),
+            answer_reply.start() if STREAM_ANSWERS else asyncio.sleep(0),
+            return_exceptions=True
+        )
+        # The placeholder has been sent (or failed) before a failed input is handled, so it is always replaced.
+        for result in inputs:
+            if isinstance(result, Exception):
+                raise result
+        (message_history, query_embeddings), message_chunks_text_and_embedding, chat_message_history, user_message_history, _ = inputs
+        response = await handle_question_command(
+            question,
+            context.bot_data.get("crawls_chunks_text_and_embedding"),
+            message_chunks_text_and_embedding,
+            message_history,
+            chat_message_history,
+            user_message_history,
+            bot_id=bot_id,
+            chat_id=chat_id,
+            on_partial_answer=answer_reply.update if STREAM_ANSWERS else None,
+            user_id=update.effective_user.id,
+            query_embeddings=query_embeddings,
+            timer=timer
+        )
+    except UpstreamUnavailable as e:
+        logger.warning(f"Sending a keyword search answer in chat {chat_id}: {str(e)}")
+        response = lexical_fallback_answer(question, context.bot_data.get("crawls_chunks_text_and_embedding"))
+    except Exception as e:
+        logger.error(f"Error in answer_question: {type(e).__name__}: {str(e)}")
+        response = QUESTION_ERROR_MESSAGE
+    if answer_reply.time_to_first_token is not None:
+        timer.stages["first_visible_token"] = answer_reply.time_to_first_token
+    logger.info(f"Answered question in chat {chat_id} in {timer.elapsed * 1000:.0f}ms ({timer})")
+    try:
+        if not response:
+            await answer_reply.finish(
+                f"Error: No Reponse\n\n"
+                f"Internal Error please reach out to the team",
+                parse_mode=None
+            )
+        else:
+            await answer_reply.finish(response)
+    except Exception as e:
+        logger.error(f"Error sending the answer in chat {chat_id}: {type(e).__name__}: {str(e)}")
+        await answer_reply.finish(QUESTION_ERROR_MESSAGE, parse_mode=None)
+
+
 async def handle_question_command(
     message: str, 
-    crawls_chunks_text_and_embedding : list[ChunkAndEmbedding],
-    message_chunks_text_and_embedding : list[ChunkAndEmbedding],
-    message_history: list[str],
+    crawls_chunks_text_and_embedding : EmbeddingIndex,
+    message_chunks_text_and_embedding : EmbeddingIndex,
+    message_history: ChatConversation,
     chat_message_history: list[Message] | None = None,
-    user_message_history: list[Message] | None = None
+    user_message_history: list[Message] | None = None,
+    bot_id: int | None = None,
+    chat_id: int | None = None,
+    on_partial_answer: Callable[[str], Awaitable[None]] | None = None,
+    user_id: int | None = None,
+    query_embeddings: list | None = None,
+    timer: StageTimer | None = None
 ) -> str | None:
     try:
-        return await send_message(message, crawls_chunks_text_and_embedding, message_chunks_text_and_embedding, message_history, message_history_size=5, chat_message_history=chat_message_history, user_message_history=user_message_history)
+        return await send_message(message, crawls_chunks_text_and_embedding, message_chunks_text_and_embedding, message_history, message_history_size=MESSAGE_HISTORY_SIZE, chat_message_history=chat_message_history, user_message_history=user_message_history, bot_id=bot_id, chat_id=chat_id, on_partial_answer=on_partial_answer, user_id=user_id, query_embeddings=query_embeddings, timer=timer)
     except ValueError as e:
         logger.error(f"Error in handle_question_command: {str(e)}")
-        return "An error occurred while processing your question. Please try again later."
+        return QUESTION_ERROR_MESSAGE
     
 
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import numpy as np
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+PLACEHOLDER_TEXT = "…"
+
+# Times from the placeholder to the first answer text shown, over the last replies.
+_first_token_latencies: deque[float] = deque(maxlen=200)
+_streaming_counts = {"replies": 0, "edits": 0, "skipped_edits": 0, "rate_limited": 0}
+
+
+class StreamingReply:
+    """
+    Reply to a message with an answer that is revealed progressively.
+
+    `start` sends a placeholder right away, `update` edits it with the partial answer at
+    most once every `edit_interval` seconds to stay within Telegram's edit rate limits,
+    and `finish` writes the final answer with Markdown, falling back to plain text when
+    the answer is not valid Markdown. The time from the placeholder to the first answer
+    text shown is kept in `time_to_first_token` and in `streaming_stats`.
+    """
+    def __init__(self, message: Message, edit_interval: float = 1.0) -> None:
+        self.message = message
+        self.edit_interval = edit_interval
+        self.reply: Message | None = None
+        self._started_at = time.monotonic()
+        self._next_edit_at = 0.0
+        self._last_text = PLACEHOLDER_TEXT
+        self.time_to_first_token: float | None = None
+
+    async def start(self) -> None:
+        self._started_at = time.monotonic()
+        _streaming_counts["replies"] += 1
+        self.reply = await self.message.reply_text(PLACEHOLDER_TEXT)
+
+    async def update(self, text: str) -> None:
+        """
+        Show the partial answer if the last edit is old enough, otherwise skip it.
+        """
+        now = time.monotonic()
+        if self.reply is None or not text.strip() or text == self._last_text:
+            return
+        if now < self._next_edit_at:
+            _streaming_counts["skipped_edits"] += 1
+            return
+        self._next_edit_at = now + self.edit_interval
+        try:
+            await self.reply.edit_text(text)
+        except RetryAfter as e:
+            _streaming_counts["rate_limited"] += 1
+            self._next_edit_at = now + _seconds(e.retry_after)
+            return
+        except BadRequest as e:
+            logger.warning(f"Could not edit streamed answer: {str(e)}")
+            return
+        _streaming_counts["edits"] += 1
+        self._last_text = text
+        self._record_first_token(now)
+
+    async def finish(self, text: str, parse_mode: str | None = "Markdown") -> Message:
+        """
+        Show the final answer, as a new reply when `start` was never called.
+        """
+        if self.reply is None:
+            return await self._send(self.message.reply_text, text, parse_mode)
+        # Wait out a pending rate limit so the final edit is not dropped.
+        delay = self._next_edit_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            reply = await self._send(self.reply.edit_text, text, parse_mode)
+        except RetryAfter as e:
+            _streaming_counts["rate_limited"] += 1
+            await asyncio.sleep(_seconds(e.retry_after))
+            reply = await self._send(self.reply.edit_text, text, parse_mode)
+        # An answer that was not streamed first becomes visible here.
+        self._record_first_token(time.monotonic())
+        return reply
+
+    def _record_first_token(self, now: float) -> None:
+        if self.time_to_first_token is not None:
+            return
+        self.time_to_first_token = now - self._started_at
+        _first_token_latencies.append(self.time_to_first_token)
+        logger.info(f"Time to first visible token: {self.time_to_first_token:.2f}s")
+
+    async def _send(self, send, text: str, parse_mode: str | None) -> Message:
+        try:
+            return await send(text, parse_mode=parse_mode)
+        except BadRequest as e:
+            # Telegram rejects an edit that would not change the message; the answer is already shown.
+            if _is_not_modified(e):
+                return self.reply
+            if parse_mode is None:
+                raise
+            logger.warning(f"Answer is not valid {parse_mode}, sending it as plain text: {str(e)}")
+        try:
+            return await send(text)
+        except BadRequest as e:
+            if _is_not_modified(e):
+                return self.reply
+            raise
+
+
+def streaming_stats() -> dict:
+    latencies = np.asarray(_first_token_latencies)
+    return {
+        **_streaming_counts,
+        "ttft_p50_ms": round(float(np.quantile(latencies, 0.5)) * 1000) if len(latencies) else None,
+        "ttft_p95_ms": round(float(np.quantile(latencies, 0.95)) * 1000) if len(latencies) else None,
+    }
+
+
+def _is_not_modified(error: BadRequest) -> bool:
+    return "not modified" in str(error).lower()
+
+
+def _seconds(retry_after) -> float:
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
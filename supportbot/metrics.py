@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, TypeVar
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+_stats_providers: dict[str, Callable[[], dict]] = {}
+
+
+def register_stats(name: str, provider: Callable[[], dict]) -> None:
+    """
+    Register a callable returning the current counters of a component.
+    Args:
+        name (str): The name the counters are reported under.
+        provider (Callable[[], dict]): Returns the counters as a dictionary.
+    """
+    _stats_providers[name] = provider
+
+
+def collect_stats() -> dict[str, dict]:
+    """
+    Return the current counters of every registered component.
+    """
+    return {name: provider() for name, provider in _stats_providers.items()}
+
+
+async def log_stats_periodically(interval: float) -> None:
+    """
+    Write the registered counters to the log every `interval` seconds until cancelled.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        for name, stats in collect_stats().items():
+            logger.info(f"{name} stats: {stats}")
+
+
+class StageTimer:
+    """
+    Wall-clock durations of the stages of one request, for a single log line.
+
+    Stages may overlap when they run concurrently, so the durations can add up to more
+    than the request's total time.
+    """
+    def __init__(self) -> None:
+        self.started_at = time.monotonic()
+        self.stages: dict[str, float] = {}
+
+    async def timed(self, name: str, awaitable: Awaitable[T]) -> T:
+        """
+        Await a stage and record how long it took, even when it fails.
+        """
+        started_at = time.monotonic()
+        try:
+            return await awaitable
+        finally:
+            self.stages[name] = time.monotonic() - started_at
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def __str__(self) -> str:
+        return ", ".join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in self.stages.items())
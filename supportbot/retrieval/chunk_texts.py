@@ -0,0 +1,53 @@
+from typing import Sequence
+
+import numpy as np
+
+
+class MappedChunkTexts(Sequence[str]):
+    """
+    Chunk texts backed by a memory-mapped UTF-8 blob and an offset table.
+
+    A text is only decoded when it is indexed, so an index can hold millions of chunks
+    without keeping their texts on the heap. Each entry of `refs` points either at a
+    text in the blob (ref >= 0) or at a text added after the snapshot was written and
+    kept in `extra` (ref = -1 - position in extra).
+    """
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray, refs: np.ndarray | None = None, extra: list[str] | None = None) -> None:
+        self.blob = blob
+        self.offsets = offsets
+        self.refs = np.arange(len(offsets) - 1, dtype=np.int64) if refs is None else refs
+        self.extra = extra if extra is not None else []
+
+    def __len__(self) -> int:
+        return len(self.refs)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[position] for position in range(*row.indices(len(self)))]
+        ref = int(self.refs[row])
+        if ref < 0:
+            return self.extra[-1 - ref]
+        return bytes(self.blob[self.offsets[ref]:self.offsets[ref + 1]]).decode("utf-8")
+
+    def take(self, rows) -> "MappedChunkTexts":
+        return MappedChunkTexts(self.blob, self.offsets, self.refs[np.asarray(rows, dtype=np.int64)], self.extra)
+
+    def extend(self, chunks: list[str]) -> "MappedChunkTexts":
+        extra = self.extra + list(chunks)
+        new_refs = -1 - np.arange(len(self.extra), len(extra), dtype=np.int64)
+        return MappedChunkTexts(self.blob, self.offsets, np.concatenate([self.refs, new_refs]), extra)
+
+
+def take_chunks(chunks: Sequence[str], rows) -> Sequence[str]:
+    """
+    Select chunk texts by row without decoding them when they are memory-mapped.
+    """
+    if isinstance(chunks, MappedChunkTexts):
+        return chunks.take(rows)
+    return [chunks[row] for row in rows]
+
+
+def concat_chunks(chunks: Sequence[str], new_chunks: list[str]) -> Sequence[str]:
+    if isinstance(chunks, MappedChunkTexts):
+        return chunks.extend(new_chunks)
+    return list(chunks) + list(new_chunks)
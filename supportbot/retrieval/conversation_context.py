@@ -0,0 +1,50 @@
+import logging
+from dataclasses import dataclass
+from typing import Sequence
+
+import numpy as np
+
+from .embedding_index import normalize_rows
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ConversationTurn:
+    question: str
+    answer: str
+    # Embedding of `text`, filled in when the turn is first used as conversation context.
+    embedding: np.ndarray | None = None
+
+    @property
+    def text(self) -> str:
+        return f"User: {self.question}\nAssistant: {self.answer}"
+
+
+def pending_turns(turns: Sequence[ConversationTurn]) -> list[ConversationTurn]:
+    """
+    Return the turns that have not been embedded yet, normally only the previous one.
+    """
+    return [turn for turn in turns if turn.embedding is None]
+
+
+def context_embedding(turns: Sequence[ConversationTurn], decay: float = 0.7) -> np.ndarray | None:
+    """
+    Combine the embeddings of the last turns into one conversation context vector.
+
+    Each turn is embedded once, so the context of a new question costs only the turns
+    added since the previous one instead of the whole joined history. The turns are
+    averaged with weights decaying by `decay` per turn of age, newest first, so the
+    context follows the current topic of the conversation.
+    Args:
+        turns (Sequence[ConversationTurn]): The turns in the context window, oldest first.
+        decay (float): The weight of a turn relative to the turn after it.
+    Returns:
+        np.ndarray | None: The normalized context vector, or None when no turn is embedded.
+    """
+    embedded = [turn.embedding for turn in turns if turn.embedding is not None]
+    if not embedded:
+        return None
+    weights = decay ** np.arange(len(embedded) - 1, -1, -1, dtype=np.float32)
+    vectors = normalize_rows(np.asarray(embedded, dtype=np.float32))
+    return normalize_rows((weights @ vectors)[None, :])[0]
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Hashable
+
+from .conversation_context import ConversationTurn
+
+logger = logging.getLogger(__name__)
+
+
+class ChatConversation:
+    """
+    The last turns of one chat's conversation with a bot, in a fixed-size ring buffer.
+    """
+    def __init__(self, key: Hashable, max_turns: int, memory: "ConversationMemory | None" = None) -> None:
+        self.key = key
+        self.turns: deque[ConversationTurn] = deque(maxlen=max_turns)
+        self.nbytes = 0
+        self.last_used_at = time.monotonic()
+        self._memory = memory
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    def recent(self, size: int) -> list[ConversationTurn]:
+        """
+        Return the last `size` turns, oldest first.
+        """
+        return list(self.turns)[-size:] if size > 0 else []
+
+    def append(self, turn: ConversationTurn) -> None:
+        """
+        Add a turn, dropping the oldest one when the buffer is full.
+        """
+        self.turns.append(turn)
+        if self._memory is not None:
+            self._memory._on_append(self, turn)
+
+    def _measure(self) -> int:
+        # Turn embeddings are filled in after the turn is added, so they are counted on the next append.
+        return sum(
+            len(turn.question) + len(turn.answer) + (turn.embedding.nbytes if turn.embedding is not None else 0)
+            for turn in self.turns
+        )
+
+
+class ConversationMemory:
+    """
+    Recent conversation turns per (bot, chat), used as the context of follow-up questions.
+
+    Every chat gets a ring buffer of its last `max_turns` turns. Chats idle for more than
+    `idle_ttl` seconds are dropped, and the least recently used chats are evicted once
+    all buffers take more than `max_bytes`. With a `client` (a `ConversationClient`),
+    every turn is also written to the database, and a chat that is not in memory is
+    backfilled from it, so conversations survive restarts and evictions.
+    """
+    def __init__(self, max_turns: int = 5, idle_ttl: float = 86400, max_bytes: int = 64 * 2**20, client=None) -> None:
+        self.max_turns = max_turns
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_bytes
+        self.client = client
+        self._chats: OrderedDict[Hashable, ChatConversation] = OrderedDict()
+        self._total_bytes = 0
+        self._pending_writes: set[asyncio.Task] = set()
+        self.hits = 0
+        self.misses = 0
+        self.backfills = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.write_errors = 0
+
+    async def get(self, bot_id: int | None, chat_id: int) -> ChatConversation:
+        """
+        Return the conversation of a chat, backfilling it from the database when it is not in memory.
+        Args:
+            bot_id (int | None): The bot answering in the chat.
+            chat_id (int): The chat.
+        Returns:
+            ChatConversation: The chat's conversation, empty for a new chat.
+        """
+        self._expire()
+        key = (bot_id, chat_id)
+        conversation = self._chats.get(key)
+        if conversation is not None:
+            self.hits += 1
+            self._touch(conversation)
+            return conversation
+        self.misses += 1
+        conversation = ChatConversation(key, self.max_turns, self)
+        if self.client is not None:
+            conversation.turns.extend(await self.client.get_recent_turns(bot_id, chat_id, limit=self.max_turns))
+            self.backfills += 1
+            # Another question of the same chat may have created it while the database was read.
+            if key in self._chats:
+                return self._chats[key]
+        self._chats[key] = conversation
+        self._resize(conversation)
+        return conversation
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "chats": len(self._chats),
+            "turns": sum(len(conversation) for conversation in self._chats.values()),
+            "mb": round(self._total_bytes / 2**20, 2),
+            "hit_rate": round(self.hits / requests, 3) if requests else None,
+            "backfills": self.backfills,
+            "expirations": self.expirations,
+            "evictions": self.evictions,
+            "write_errors": self.write_errors,
+        }
+
+    def _on_append(self, conversation: ChatConversation, turn: ConversationTurn) -> None:
+        # A question that started before its chat was dropped still saves its turn, outside the accounting.
+        self._touch(conversation)
+        self._resize(conversation)
+        if self.client is not None:
+            bot_id, chat_id = conversation.key
+            write = asyncio.ensure_future(self.client.save_turn(bot_id, chat_id, turn))
+            # Keep a reference so the write is not garbage collected before it finishes.
+            self._pending_writes.add(write)
+            write.add_done_callback(self._on_write_done)
+
+    def _on_write_done(self, write: asyncio.Task) -> None:
+        self._pending_writes.discard(write)
+        if write.cancelled() or write.exception() is not None or not write.result():
+            self.write_errors += 1
+
+    def _touch(self, conversation: ChatConversation) -> None:
+        conversation.last_used_at = time.monotonic()
+        if self._chats.get(conversation.key) is conversation:
+            self._chats.move_to_end(conversation.key)
+
+    def _resize(self, conversation: ChatConversation) -> None:
+        if self._chats.get(conversation.key) is not conversation:
+            return
+        nbytes = conversation._measure()
+        self._total_bytes += nbytes - conversation.nbytes
+        conversation.nbytes = nbytes
+        while self._total_bytes > self.max_bytes and len(self._chats) > 1:
+            key = next(iter(self._chats))
+            if key == conversation.key:
+                self._chats.move_to_end(key)
+                continue
+            self._drop(key)
+            self.evictions += 1
+
+    def _expire(self) -> None:
+        # Chats are kept in least recently used order, so the idle ones are at the front.
+        now = time.monotonic()
+        while self._chats:
+            key, conversation = next(iter(self._chats.items()))
+            if now - conversation.last_used_at <= self.idle_ttl:
+                break
+            self._drop(key)
+            self.expirations += 1
+
+    def _drop(self, key: Hashable) -> None:
+        conversation = self._chats.pop(key)
+        self._total_bytes -= conversation.nbytes
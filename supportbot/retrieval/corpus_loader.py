@@ -0,0 +1,141 @@
+import gc
+import logging
+import resource
+import time
+
+import numpy as np
+from supabase import Client, create_client
+
+from config import SUPABASE_KEY, SUPABASE_URL
+
+from .embedding_index import EmbeddingIndex, decode_embedding, normalize_rows
+from .membership_index import MembershipIndex, parse_member_ids
+
+logger = logging.getLogger(__name__)
+
+# How the rows of a chunk table are tied to a bot, as a PostgREST embedded resource and the
+# column to filter on. Crawled docs carry no bot id yet, so that table is shared by all bots.
+PARTITION_JOINS = {
+    'message_history_chunks': ('message_history!inner(bot_id)', 'message_history.bot_id'),
+}
+
+# Columns listing the Telegram users allowed to see a chunk, for tables with access control.
+MEMBER_COLUMNS = {
+    'message_history_chunks': 'chat_member_ids',
+}
+
+
+def partition_name(table_name: str, bot_id: int | None = None) -> str:
+    """
+    Name a table, or one bot's partition of it, in logs, stats and snapshot paths.
+    """
+    return table_name if bot_id is None else f"{table_name}.bot_{bot_id}"
+
+
+def select_chunks(supabase_client: Client, table_name: str, columns: str, bot_id: int | None = None, count: str | None = None):
+    """
+    Start a select on a chunk table, restricted to one bot's rows when a bot id is given.
+    """
+    if bot_id is None:
+        return supabase_client.table(table_name).select(columns, count=count)
+    if table_name not in PARTITION_JOINS:
+        raise ValueError(f"{table_name} cannot be partitioned by bot.")
+    join, filter_column = PARTITION_JOINS[table_name]
+    return (
+        supabase_client.table(table_name)
+        .select(f"{columns}, {join}", count=count)
+        .eq(filter_column, bot_id)
+    )
+
+
+def load_index(
+    table_name: str,
+    chunk_column_name: str = 'chunk',
+    embedding_column_name: str = 'chunk_embedding',
+    batch_size: int = 1000,
+    bot_id: int | None = None
+) -> EmbeddingIndex:
+    """
+    Load every embedded chunk of a table into an exact index.
+
+    The table is read in pages of `batch_size` rows ordered by id, and each page's
+    embeddings are decoded straight into a preallocated float32 matrix. Only one page of
+    Python rows is alive at a time, so peak memory is the matrix plus one page. Tables
+    listed in MEMBER_COLUMNS also get the membership index of their chunks.
+    Args:
+        table_name (str): The chunk table to load.
+        chunk_column_name (str): The column holding the chunk text.
+        embedding_column_name (str): The column holding the chunk embedding.
+        batch_size (int): The number of rows fetched per request.
+        bot_id (int | None): Only load the chunks of this bot.
+    Returns:
+        EmbeddingIndex: The index over every chunk that has an embedding.
+    """
+    started_at = time.monotonic()
+    supabase_client: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    expected_rows = _count_embedded_rows(supabase_client, table_name, embedding_column_name, bot_id)
+    member_column_name = MEMBER_COLUMNS.get(table_name)
+    columns = f"id, {chunk_column_name}, {embedding_column_name}" + (f", {member_column_name}" if member_column_name else "")
+    chunks: list[str] = []
+    members: list[list[int] | None] = []
+    matrix: np.ndarray | None = None
+    row_ids: np.ndarray | None = None
+    last_id = None
+    while True:
+        query = (
+            select_chunks(supabase_client, table_name, columns, bot_id)
+            .not_.is_(embedding_column_name, None)
+        )
+        if last_id is not None:
+            query = query.gt("id", last_id)
+        rows = query.order("id").limit(batch_size).execute().data
+        # The HTTP client leaves each response in a reference cycle that holds the page's body
+        # twice, as bytes and as text. A young-generation collection frees it now instead of
+        # letting dozens of pages pile up until the next full collection.
+        gc.collect(1)
+        for row in rows:
+            embedding = decode_embedding(row[embedding_column_name])
+            if matrix is None:
+                matrix = np.empty((max(expected_rows, 1), embedding.shape[0]), dtype=np.float32)
+                row_ids = np.empty(matrix.shape[0], dtype=np.int64)
+            position = len(chunks)
+            # Rows embedded after the count was taken do not fit; grow the buffers geometrically.
+            if position == matrix.shape[0]:
+                matrix = np.resize(matrix, (2 * position, matrix.shape[1]))
+                row_ids = np.resize(row_ids, 2 * position)
+            matrix[position] = embedding
+            row_ids[position] = row['id']
+            chunks.append(row[chunk_column_name])
+            if member_column_name:
+                members.append(parse_member_ids(row[member_column_name]))
+        if len(rows) < batch_size:
+            break
+        last_id = rows[-1]['id']
+
+    membership = MembershipIndex.from_members(members) if member_column_name else None
+    if matrix is None:
+        return EmbeddingIndex([], np.empty((0, 0), dtype=np.float32), members=membership)
+    if matrix.shape[0] != len(chunks):
+        matrix = matrix[:len(chunks)].copy()
+    normalize_rows(matrix, out=matrix)
+    index = EmbeddingIndex(chunks, matrix, row_ids[:len(chunks)], normalized=True, members=membership)
+    logger.info(
+        f"Loaded {len(index)} chunks from {partition_name(table_name, bot_id)} in {time.monotonic() - started_at:.1f}s "
+        f"(embeddings: {matrix.nbytes / 2**20:.0f} MB, peak RSS: {_peak_rss_mb():.0f} MB)"
+    )
+    return index
+
+
+def _count_embedded_rows(supabase_client: Client, table_name: str, embedding_column_name: str, bot_id: int | None) -> int:
+    response = (
+        select_chunks(supabase_client, table_name, "id", bot_id, count="exact")
+        .not_.is_(embedding_column_name, None)
+        .limit(1)
+        .execute()
+    )
+    return response.count or 0
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is reported in kilobytes on Linux, which is where the bot runs.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
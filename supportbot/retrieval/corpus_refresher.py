@@ -0,0 +1,248 @@
+import asyncio
+import logging
+from typing import Callable
+
+import numpy as np
+from supabase import Client, create_client
+
+from config import SUPABASE_KEY, SUPABASE_URL
+from supportbot.clients.crawl.dataclasses import ChunkAndEmbedding
+
+from .corpus_loader import MEMBER_COLUMNS, partition_name, select_chunks
+from .embedding_index import EmbeddingIndex
+from .membership_index import parse_member_ids
+from .snapshot import save_snapshot
+
+logger = logging.getLogger(__name__)
+
+ID_FILTER_BATCH_SIZE = 100  # Ids per `in` filter, to keep the request URL short.
+MAX_UNEMBEDDED_IDS = 1000  # Newest rows still waiting for an embedding that are re-checked on every refresh.
+
+
+class CorpusRefresher:
+    """
+    Keep a live retrieval index in sync with its chunk table, or with one bot's partition of it.
+
+    Each refresh pulls the embedded rows with ids above the newest one in the index, the
+    rows among the newest `MAX_UNEMBEDDED_IDS` still waiting for an embedding that have got
+    one since, and rows whose `updated_at_column` moved forward when one is configured. They are
+    merged into a copy of the index off the event loop, and the copy then replaces the
+    live index with a single call to `set_index`. Questions already running keep the index they
+    started with. With a snapshot directory, every merge is also written as a new snapshot.
+    `on_refresh` is called with the refresher's `bot_id` after a merge that added chunks or
+    changed the text or embedding of one; a change of members alone does not call it.
+    """
+    def __init__(
+        self,
+        table_name: str,
+        get_index: Callable[[], EmbeddingIndex],
+        set_index: Callable[[EmbeddingIndex], None],
+        chunk_column_name: str = 'chunk',
+        embedding_column_name: str = 'chunk_embedding',
+        updated_at_column: str | None = None,
+        snapshot_dir: str | None = None,
+        on_refresh: Callable[..., None] | None = None,
+        batch_size: int = 500,
+        bot_id: int | None = None
+    ) -> None:
+        self.supabase_client: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+        self.table_name = table_name
+        self.get_index = get_index
+        self.set_index = set_index
+        self.chunk_column_name = chunk_column_name
+        self.embedding_column_name = embedding_column_name
+        self.updated_at_column = updated_at_column
+        self.snapshot_dir = snapshot_dir
+        self.on_refresh = on_refresh
+        self.batch_size = batch_size
+        self.bot_id = bot_id
+        self.name = partition_name(table_name, bot_id)
+        self.member_column_name = MEMBER_COLUMNS.get(table_name)
+        self.updated_since: str | None = None
+        # Ids of rows without an embedding yet, re-checked on the next refresh.
+        self.unembedded_ids: list[int] = []
+        self.refreshes = 0
+        self.rows_merged = 0
+
+    async def run(self, interval: float) -> None:
+        """
+        Refresh the index every `interval` seconds until cancelled.
+        """
+        try:
+            # Taken right after the index was loaded, so rows it left out for lack of an embedding are re-checked.
+            self.unembedded_ids = await asyncio.to_thread(self._fetch_unembedded_ids)
+            if self.updated_at_column:
+                self.updated_since = await asyncio.to_thread(self._latest_update)
+        except Exception as e:
+            logger.error(f"Error starting the refresh of {self.name}: {str(e)}")
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing {self.name}: {str(e)}")
+
+    async def refresh(self) -> int:
+        """
+        Merge new and changed rows into the live index.
+        Returns:
+            int: The number of rows merged.
+        """
+        index = self.get_index()
+        rows = await asyncio.to_thread(self._fetch_changed_rows, index)
+        self.refreshes += 1
+        if not rows:
+            return 0
+        merged_index, content_changed = await asyncio.to_thread(self._merge, index, rows)
+        self.set_index(merged_index)
+        self.rows_merged += len(rows)
+        logger.info(f"Merged {len(rows)} new or changed chunks into {self.name}")
+        if self.on_refresh and content_changed:
+            self.on_refresh(bot_id=self.bot_id)
+        return len(rows)
+
+    def stats(self) -> dict:
+        return {
+            "chunks": len(self.get_index()),
+            "refreshes": self.refreshes,
+            "rows_merged": self.rows_merged,
+            "unembedded_ids": len(self.unembedded_ids),
+        }
+
+    def _merge(self, index: EmbeddingIndex, rows: list[ChunkAndEmbedding]) -> tuple[EmbeddingIndex, bool]:
+        merged_index = index.merged(rows)
+        if self.snapshot_dir:
+            # Writing a new snapshot moves the merged matrix off the heap and back into shared pages.
+            merged_index = save_snapshot(merged_index, self.snapshot_dir, self.name)
+        return merged_index, changes_content(index, rows)
+
+    def _fetch_changed_rows(self, index: EmbeddingIndex) -> list[ChunkAndEmbedding]:
+        # Rows are inserted first and embedded later by the agent_code scripts, which skip rows
+        # that fail to embed, so ids above the newest one in the index are paged, while rows
+        # below it that were still waiting for an embedding are only re-checked by id.
+        watermark = int(index.row_ids.max()) if len(index) else 0
+        candidate_ids = np.asarray(
+            self._fetch_embedded_ids_after(watermark) + self._fetch_embedded_ids_in(self.unembedded_ids),
+            dtype=np.int64
+        )
+        self.unembedded_ids = self._fetch_unembedded_ids()
+        new_ids = candidate_ids[~np.isin(candidate_ids, index.row_ids)].tolist()
+        rows = self._fetch_rows(new_ids)
+        if self.updated_at_column:
+            fetched_ids = set(new_ids)
+            rows += [row for row in self._fetch_updated_rows() if row.row_id not in fetched_ids]
+        return rows
+
+    def _fetch_unembedded_ids(self) -> list[int]:
+        # Older rows that never get an embedding drop out of the window; with an
+        # `updated_at_column`, embedding them later still brings them in.
+        response = (
+            self._select("id")
+            .is_(self.embedding_column_name, None)
+            .order("id", desc=True)
+            .limit(MAX_UNEMBEDDED_IDS)
+            .execute()
+        )
+        return [row['id'] for row in response.data]
+
+    def _fetch_embedded_ids_in(self, ids: list[int]) -> list[int]:
+        embedded_ids = []
+        for start in range(0, len(ids), ID_FILTER_BATCH_SIZE):
+            response = (
+                self._select("id")
+                .in_("id", ids[start:start + ID_FILTER_BATCH_SIZE])
+                .not_.is_(self.embedding_column_name, None)
+                .execute()
+            )
+            embedded_ids += [row['id'] for row in response.data]
+        return embedded_ids
+
+    def _fetch_embedded_ids_after(self, watermark: int) -> list[int]:
+        ids = []
+        while True:
+            response = (
+                self._select("id")
+                .gt("id", watermark)
+                .not_.is_(self.embedding_column_name, None)
+                .order("id")
+                .limit(self.batch_size)
+                .execute()
+            )
+            ids += [row['id'] for row in response.data]
+            if len(response.data) < self.batch_size:
+                return ids
+            watermark = ids[-1]
+
+    def _fetch_rows(self, ids: list[int]) -> list[ChunkAndEmbedding]:
+        rows = []
+        for start in range(0, len(ids), ID_FILTER_BATCH_SIZE):
+            response = (
+                self.supabase_client.table(self.table_name)
+                .select(self._row_columns())
+                .in_("id", ids[start:start + ID_FILTER_BATCH_SIZE])
+                .execute()
+            )
+            rows += [self._convert_to_chunk(row) for row in response.data]
+        return rows
+
+    def _fetch_updated_rows(self) -> list[ChunkAndEmbedding]:
+        if self.updated_since is None:
+            self.updated_since = self._latest_update()
+            return []
+        rows, offset = [], 0
+        while True:
+            response = (
+                self._select(f"{self._row_columns()}, {self.updated_at_column}")
+                .gt(self.updated_at_column, self.updated_since)
+                .not_.is_(self.embedding_column_name, None)
+                .order(self.updated_at_column)
+                .order("id")
+                .range(offset, offset + self.batch_size - 1)
+                .execute()
+            )
+            rows += response.data
+            if len(response.data) < self.batch_size:
+                break
+            offset += self.batch_size
+        if rows:
+            self.updated_since = rows[-1][self.updated_at_column]
+        return [self._convert_to_chunk(row) for row in rows]
+
+    def _latest_update(self) -> str | None:
+        response = (
+            self._select(self.updated_at_column)
+            .order(self.updated_at_column, desc=True)
+            .limit(1)
+            .execute()
+        )
+        return response.data[0][self.updated_at_column] if response.data else None
+
+    def _row_columns(self) -> str:
+        columns = f"id, {self.chunk_column_name}, {self.embedding_column_name}"
+        return f"{columns}, {self.member_column_name}" if self.member_column_name else columns
+
+    def _select(self, columns: str):
+        return select_chunks(self.supabase_client, self.table_name, columns, self.bot_id)
+
+    def _convert_to_chunk(self, row: dict) -> ChunkAndEmbedding:
+        return ChunkAndEmbedding(
+            chunk=row[self.chunk_column_name],
+            embedding=row[self.embedding_column_name],
+            row_id=row['id'],
+            member_ids=parse_member_ids(row[self.member_column_name]) if self.member_column_name else None
+        )
+
+
+def changes_content(index: EmbeddingIndex, rows: list[ChunkAndEmbedding]) -> bool:
+    """
+    Return whether merging the rows adds a chunk to the index or changes the text or embedding of one.
+    Rows whose `updated_at_column` moved without such a change, like a new chat member, return False.
+    """
+    positions = dict(zip(index.row_ids.tolist(), range(len(index))))
+    existing = [positions.get(row.row_id) for row in rows]
+    if any(position is None for position in existing):
+        return True
+    if any(index.chunks[position] != row.chunk for position, row in zip(existing, rows)):
+        return True
+    update = EmbeddingIndex.from_chunks(rows, storage=index.storage)
+    return not np.array_equal(index.embeddings(existing), update.embeddings())
@@ -0,0 +1,8 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class ScoredChunk:
+    row: int
+    chunk: str
+    score: float
@@ -0,0 +1,480 @@
+import hashlib
+import logging
+from typing import Sequence
+
+import numpy as np
+
+from supportbot.clients.crawl.dataclasses import ChunkAndEmbedding
+
+from .chunk_texts import concat_chunks, take_chunks
+from .dataclasses import ScoredChunk
+from .lexical_index import LexicalIndex, concat_lexical, take_lexical
+from .membership_index import MembershipIndex, concat_members, take_members
+
+logger = logging.getLogger(__name__)
+
+# How the embedding matrix can be stored; int8 rows carry one float32 scale each.
+STORAGE_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+SCORE_BLOCK_SIZE = 1024  # Quantized rows expanded to float32 per matrix product while scoring.
+RRF_K = 60  # Rank offset of reciprocal-rank fusion; 60 is the value from the original paper.
+TIE_TOLERANCE = 1e-6  # Scores closer than this differ by float32 rounding only.
+
+# How many hybrid searches added the rows holding the query's identifiers to the dense candidates.
+_hybrid_search_counts = {"identifier_candidates": 0, "fused": 0}
+
+
+class EmbeddingIndex:
+    """
+    Exact cosine-similarity index over a corpus of chunk embeddings.
+
+    The corpus is kept as a single row-normalized matrix so that a query is scored
+    with one matrix-vector product instead of one distance call per chunk. The matrix
+    is float32 by default; with `storage="float16"` or `"int8"` it is kept quantized
+    and dequantized block by block while scoring, so only one block is ever expanded.
+    int8 rows are scaled per vector, with the scales kept in `scales`. Corpora with access
+    control carry a `MembershipIndex` in `members`, used to restrict a search to the rows a
+    user may see, and corpora searched with keywords as well carry a `LexicalIndex` in `lexical`.
+    """
+    def __init__(
+        self,
+        chunks: Sequence[str],
+        embeddings,
+        row_ids=None,
+        normalized: bool = False,
+        storage: str = "float32",
+        scales=None,
+        members: MembershipIndex | None = None,
+        lexical: LexicalIndex | None = None
+    ) -> None:
+        if storage not in STORAGE_DTYPES:
+            raise ValueError(f"Unknown embedding storage {storage}, expected one of {', '.join(STORAGE_DTYPES)}.")
+        matrix = np.asarray(embeddings)
+        # Matrices already in the storage type, such as snapshots, are used as they are.
+        quantized = storage != "float32" and matrix.dtype == STORAGE_DTYPES[storage]
+        if quantized and storage == "int8" and scales is None:
+            raise ValueError("int8 embeddings need their per-row scales.")
+        if not quantized:
+            matrix = matrix.astype(np.float32, copy=False)
+        if matrix.ndim != 2 and len(chunks) == 0:
+            matrix = matrix.reshape(0, 0)
+        if matrix.ndim != 2 or matrix.shape[0] != len(chunks):
+            raise ValueError(
+                f"Expected {len(chunks)} embeddings, got an array of shape {matrix.shape}."
+            )
+        self.chunks = chunks
+        self.storage = storage
+        if not quantized:
+            # Callers that already hold unit rows skip the normalization copy.
+            if not normalized:
+                matrix = normalize_rows(matrix)
+            matrix, scales = quantize_rows(matrix, storage)
+        self.matrix = matrix
+        self.scales = None if scales is None else np.asarray(scales, dtype=np.float32)
+        # Database ids of the rows, -1 when unknown; used to merge refreshed rows into the index.
+        if row_ids is None:
+            row_ids = np.full(len(chunks), -1)
+        self.row_ids = np.asarray(row_ids, dtype=np.int64)
+        self.members = members
+        self.lexical = lexical
+
+    @classmethod
+    def from_chunks(cls, chunks_text_and_embedding: list[ChunkAndEmbedding], storage: str = "float32") -> "EmbeddingIndex":
+        """
+        Build an index from a list of chunks, such as the rows fetched by `CorpusRefresher`.
+        Args:
+            chunks_text_and_embedding (list[ChunkAndEmbedding]): The chunks to index.
+            storage (str): How the embeddings are stored, one of STORAGE_DTYPES.
+        Returns:
+            EmbeddingIndex: The index over the given chunks.
+        """
+        chunks = [chunk.chunk for chunk in chunks_text_and_embedding]
+        embeddings = [decode_embedding(chunk.embedding) for chunk in chunks_text_and_embedding]
+        row_ids = [-1 if chunk.row_id is None else chunk.row_id for chunk in chunks_text_and_embedding]
+        members = MembershipIndex.from_members([chunk.member_ids for chunk in chunks_text_and_embedding])
+        return cls(chunks, embeddings, row_ids, storage=storage, members=members)
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    @property
+    def dimension(self) -> int:
+        return self.matrix.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The size of the stored embeddings, scales included.
+        """
+        return self.matrix.nbytes + (0 if self.scales is None else self.scales.nbytes)
+
+    def quantized(self, storage: str) -> "EmbeddingIndex":
+        """
+        Return the same corpus with its embeddings stored as `storage`.
+        """
+        if storage == self.storage:
+            return self
+        return EmbeddingIndex(self.chunks, self.embeddings(), self.row_ids, normalized=True, storage=storage, members=self.members, lexical=self.lexical)
+
+    def fingerprint(self) -> str:
+        """
+        Hash the corpus: its row ids, chunk texts and stored embeddings, whatever the row order.
+
+        Two indexes over the same rows have the same fingerprint even when one of them
+        was reordered, such as an IVF index grouping its rows by cluster.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{self.storage}:{self.matrix.shape}".encode())
+        order = np.argsort(self.row_ids, kind="stable")
+        digest.update(self.row_ids[order].tobytes())
+        for start in range(0, len(order), SCORE_BLOCK_SIZE):
+            rows = order[start:start + SCORE_BLOCK_SIZE]
+            digest.update(np.ascontiguousarray(self.matrix[rows]).tobytes())
+            if self.scales is not None:
+                digest.update(self.scales[rows].tobytes())
+            for row in rows:
+                chunk = self.chunks[row].encode("utf-8")
+                digest.update(len(chunk).to_bytes(8, "little") + chunk)
+        return digest.hexdigest()
+
+    def embeddings(self, rows=None) -> np.ndarray:
+        """
+        Return the normalized float32 embeddings of the given rows, or of every row.
+        """
+        if rows is None:
+            return dequantize_rows(self.matrix, self.scales)
+        return dequantize_rows(self.matrix[rows], None if self.scales is None else self.scales[rows])
+
+    def score(self, queries: np.ndarray, rows=None) -> np.ndarray:
+        """
+        Return the cosine similarity of each normalized query with the given rows, or with every row.
+        Returns:
+            np.ndarray: A (queries, rows) float32 score matrix.
+        """
+        if self.storage == "float32":
+            matrix = self.matrix if rows is None else self.matrix[rows]
+            return queries @ matrix.T
+        row_count = self.matrix.shape[0] if rows is None else len(rows)
+        scores = np.empty((queries.shape[0], row_count), dtype=np.float32)
+        # One small float32 buffer is reused for every block, so it stays in cache.
+        buffer = np.empty((min(SCORE_BLOCK_SIZE, row_count), self.matrix.shape[1]), dtype=np.float32)
+        for start in range(0, row_count, SCORE_BLOCK_SIZE):
+            block = self.matrix[start:start + SCORE_BLOCK_SIZE] if rows is None else self.matrix[rows[start:start + SCORE_BLOCK_SIZE]]
+            block_buffer = buffer[:block.shape[0]]
+            np.copyto(block_buffer, block, casting="unsafe")
+            np.matmul(queries, block_buffer.T, out=scores[:, start:start + block.shape[0]])
+        if self.scales is not None:
+            # Scaling the scores is the same as scaling the rows, and much cheaper.
+            scores *= self.scales if rows is None else self.scales[rows]
+        return scores
+
+    def merged(self, chunks_text_and_embedding: list[ChunkAndEmbedding]) -> "EmbeddingIndex":
+        """
+        Return a new index with the given rows added, replacing rows with the same database id.
+
+        The index itself is left untouched, so searches running against it are unaffected.
+        """
+        if not chunks_text_and_embedding:
+            return self
+        update = EmbeddingIndex.from_chunks(chunks_text_and_embedding, storage=self.storage)
+        keep = self._rows_kept_after(update)
+        return EmbeddingIndex(
+            chunks=concat_chunks(take_chunks(self.chunks, np.flatnonzero(keep)), update.chunks),
+            embeddings=_stack(self.matrix[keep], update.matrix),
+            row_ids=np.concatenate([self.row_ids[keep], update.row_ids]),
+            normalized=True,
+            storage=self.storage,
+            scales=_concat_scales(self, keep, update),
+            members=concat_members(take_members(self.members, np.flatnonzero(keep)), update.members),
+            lexical=concat_lexical(take_lexical(self.lexical, np.flatnonzero(keep)), update.chunks)
+        )
+
+    def _rows_kept_after(self, update: "EmbeddingIndex") -> np.ndarray:
+        known_ids = update.row_ids[update.row_ids >= 0]
+        return ~np.isin(self.row_ids, known_ids)
+
+    def search(self, query_embedding, k: int = 5, allowed_rows: np.ndarray | None = None) -> list[ScoredChunk]:
+        """
+        Return the k chunks most similar to the query, best first.
+        Args:
+            query_embedding (list[float]): The embedding of the query.
+            k (int): The number of chunks to return.
+            allowed_rows (np.ndarray | None): Only search these sorted rows, such as the rows visible to a user.
+        Returns:
+            list[ScoredChunk]: The best chunks with their cosine similarity.
+        """
+        query = np.asarray(query_embedding, dtype=np.float32).reshape(1, -1)
+        return self.search_batch(normalize_rows(query), k=k, allowed_rows=allowed_rows)[0]
+
+    def search_batch(self, queries: np.ndarray, k: int = 5, allowed_rows: np.ndarray | None = None) -> list[list[ScoredChunk]]:
+        """
+        Return the k best chunks for each row of an already normalized query matrix.
+        With `allowed_rows`, only those rows are scored.
+        """
+        if len(self) == 0 or k <= 0 or (allowed_rows is not None and len(allowed_rows) == 0):
+            return [[] for _ in range(queries.shape[0])]
+        scores = self.score(queries, allowed_rows)
+        return [self._scored_chunks(query_scores, top_k_rows(query_scores, k), allowed_rows) for query_scores in scores]
+
+    def visible_rows(self, member_id: int | None, access_controlled: bool = False) -> np.ndarray | None:
+        """
+        Return the rows a user may see, or None when the corpus has no access control.
+        Args:
+            member_id (int | None): The Telegram user id; no rows are visible without one.
+            access_controlled (bool): The corpus comes from a table in MEMBER_COLUMNS, so without
+                a membership index no rows are visible instead of every row.
+        """
+        if self.members is None:
+            if access_controlled:
+                if len(self):
+                    logger.warning(f"Access-controlled index of {len(self)} chunks has no membership index, hiding every row")
+                return np.empty(0, dtype=np.int64)
+            return None
+        if member_id is None:
+            return np.empty(0, dtype=np.int64)
+        return self.members.rows_for(member_id)
+
+    def _scored_chunks(self, scores: np.ndarray, positions: np.ndarray, rows: np.ndarray | None = None) -> list[ScoredChunk]:
+        # Scores are indexed by position in `rows` when the search was restricted to them.
+        return [
+            ScoredChunk(
+                row=int(position if rows is None else rows[position]),
+                chunk=self.chunks[position if rows is None else rows[position]],
+                score=float(scores[position])
+            )
+            for position in positions
+        ]
+
+
+def normalize_rows(matrix: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
+    """
+    Scale every row to unit length. Zero rows are left as zeros so they score 0 against any query.
+    Pass `out=matrix` to normalize in place.
+    """
+    if out is None:
+        out = np.empty(matrix.shape, dtype=np.result_type(matrix.dtype, np.float32))
+    # Norms are taken block by block: np.linalg.norm over the whole matrix would allocate a
+    # squared copy of it, doubling peak memory while a corpus loads.
+    for start in range(0, matrix.shape[0], SCORE_BLOCK_SIZE):
+        block = slice(start, start + SCORE_BLOCK_SIZE)
+        norms = np.linalg.norm(matrix[block], axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        np.divide(matrix[block], norms, out=out[block])
+    return out
+
+
+def quantize_rows(matrix: np.ndarray, storage: str) -> tuple[np.ndarray, np.ndarray | None]:
+    """
+    Convert a normalized float32 matrix to a storage type.
+    Returns:
+        tuple[np.ndarray, np.ndarray | None]: The stored matrix, and the per-row scales for int8.
+    """
+    if storage == "float32":
+        return matrix, None
+    if storage == "float16":
+        return matrix.astype(np.float16), None
+    # Each row is scaled so its largest component maps to 127, which keeps the error per
+    # row proportional to that row instead of to the largest value in the corpus.
+    scales = np.abs(matrix).max(axis=1) / 127 if matrix.size else np.empty(matrix.shape[0], dtype=np.float32)
+    scales[scales == 0] = 1.0
+    quantized = np.empty(matrix.shape, dtype=np.int8)
+    for start in range(0, matrix.shape[0], SCORE_BLOCK_SIZE):
+        block = slice(start, start + SCORE_BLOCK_SIZE)
+        np.rint(matrix[block] / scales[block, None], out=quantized[block], casting="unsafe")
+    return quantized, scales.astype(np.float32)
+
+
+def dequantize_rows(matrix: np.ndarray, scales: np.ndarray | None = None) -> np.ndarray:
+    if scales is None:
+        return matrix.astype(np.float32, copy=False)
+    return matrix.astype(np.float32) * scales[:, None]
+
+
+def decode_embedding(value) -> np.ndarray:
+    """
+    Decode an embedding as returned by PostgREST: a JSON array, or the text form of a pgvector column.
+    """
+    if isinstance(value, str):
+        return np.fromstring(value.strip("[]"), dtype=np.float32, sep=",")
+    return np.asarray(value, dtype=np.float32)
+
+
+def _stack(matrix: np.ndarray, other: np.ndarray) -> np.ndarray:
+    if matrix.shape[0] == 0:
+        return other
+    if other.shape[0] == 0:
+        return matrix
+    return np.vstack([matrix, other])
+
+
+def _concat_scales(index: EmbeddingIndex, keep: np.ndarray, update: EmbeddingIndex) -> np.ndarray | None:
+    if index.scales is None:
+        return None
+    return np.concatenate([index.scales[keep], update.scales])
+
+
+def top_k_rows(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Return the indices of the k highest scores, best first.
+
+    Uses a partial selection so only the k winners are sorted. Scores within
+    TIE_TOLERANCE of each other count as ties and are ordered by the lower row index,
+    which matches the stable full sort the retrieval used before and keeps float32
+    rounding, e.g. between scaled copies of one embedding, from reordering them.
+    """
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < scores.shape[0]:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        # argpartition picks an arbitrary subset of rows tied with the k-th score,
+        # so pull in every tied row and let the sort below choose the lowest ones.
+        threshold = scores[candidates].min()
+        candidates = np.union1d(candidates, np.flatnonzero(scores >= threshold - TIE_TOLERANCE))
+    else:
+        candidates = np.arange(scores.shape[0])
+    candidates = candidates[np.lexsort((candidates, -scores[candidates]))]
+    ranked_scores = scores[candidates]
+    # Each score within the tolerance of the one before it joins that one's tie group.
+    groups = np.concatenate([[0], np.cumsum(ranked_scores[:-1] - ranked_scores[1:] > TIE_TOLERANCE)])
+    return candidates[np.lexsort((candidates, groups))][:k]
+
+
+def search_many(
+    query_embeddings: list[list[float]],
+    indexes: list[EmbeddingIndex],
+    k: int = 5,
+    deduplicate: bool = True,
+    allowed_rows: list[np.ndarray | None] | None = None,
+    query_texts: list[str] | None = None,
+    hybrid_options: dict | None = None
+) -> list[list[list[ScoredChunk]]]:
+    """
+    Answer several queries against several corpora in one pass.
+
+    Each exact corpus is scored against all the queries with a single matrix-matrix product.
+    Args:
+        query_embeddings (list[list[float]]): The query embeddings, in priority order.
+        indexes (list[EmbeddingIndex]): The corpora to search.
+        k (int): The number of chunks to return per query and corpus.
+        deduplicate (bool): Drop chunks from a query's results that an earlier query
+            already retrieved from the same corpus; the earlier result keeps the best
+            score any of the queries gave the chunk.
+        allowed_rows (list[np.ndarray | None] | None): Per corpus, the only rows that may
+            be searched, or None to search every row.
+        query_texts (list[str] | None): The query texts; corpora with a lexical index are
+            then searched with `hybrid_search`.
+        hybrid_options (dict | None): Keyword arguments passed to `hybrid_search`.
+    Returns:
+        list[list[list[ScoredChunk]]]: results[query][corpus], best chunks first.
+    """
+    results = [[[] for _ in indexes] for _ in query_embeddings]
+    if not query_embeddings or k <= 0:
+        return results
+    queries = normalize_rows(np.asarray(query_embeddings, dtype=np.float32))
+    for corpus_position, index in enumerate(indexes):
+        first_results: dict[int, ScoredChunk] = {}
+        corpus_allowed_rows = allowed_rows[corpus_position] if allowed_rows is not None else None
+        if query_texts is not None and index.lexical is not None:
+            corpus_results = [
+                hybrid_search(index, query, query_text, k=k, allowed_rows=corpus_allowed_rows, **(hybrid_options or {}))
+                for query, query_text in zip(queries, query_texts)
+            ]
+        else:
+            corpus_results = index.search_batch(queries, k=k, allowed_rows=corpus_allowed_rows)
+        for query_position, scored_chunks in enumerate(corpus_results):
+            if not deduplicate:
+                results[query_position][corpus_position] = scored_chunks
+                continue
+            kept = []
+            for scored_chunk in scored_chunks:
+                first_result = first_results.get(scored_chunk.row)
+                if first_result is None:
+                    first_results[scored_chunk.row] = scored_chunk
+                    kept.append(scored_chunk)
+                else:
+                    first_result.score = max(first_result.score, scored_chunk.score)
+            results[query_position][corpus_position] = kept
+    return results
+
+
+def hybrid_search(
+    index: EmbeddingIndex,
+    query: np.ndarray,
+    query_text: str,
+    k: int = 5,
+    allowed_rows: np.ndarray | None = None,
+    pool_size: int = 50,
+    rare_fraction: float = 0.01,
+    max_candidates: int = 5000
+) -> list[ScoredChunk]:
+    """
+    Search an index with both its lexical index and its embeddings, fusing the two rankings.
+
+    The dense ranking is the usual top `pool_size` of the whole index. When the query holds
+    identifiers, such as an error code or a ticket id, the rows containing them are scored
+    as well and ranked after the dense pool by their cosine similarity, so a chunk naming
+    the identifier reaches the fusion even when its embedding is far from the question.
+    The dense and BM25 rankings are combined with reciprocal-rank fusion, and each result
+    keeps its cosine similarity as its score.
+    Args:
+        index (EmbeddingIndex): The index to search, with a lexical index attached.
+        query (np.ndarray): The normalized query embedding.
+        query_text (str): The query text.
+        k (int): The number of chunks to return.
+        allowed_rows (np.ndarray | None): Only search these sorted rows.
+        pool_size (int): The number of results taken from each ranking before fusion.
+        rare_fraction (float): Identifier tokens in at most this fraction of the chunks count as rare.
+        max_candidates (int): Identifiers matching more rows than this are too weak a signal.
+    Returns:
+        list[ScoredChunk]: The best chunks by fused rank.
+    """
+    lexical = index.lexical
+    pool_size = max(pool_size, k)
+    lexical_rows, _ = lexical.search(query_text, pool_size, allowed_rows)
+    dense_rows, dense_scores = hybrid_dense_ranking(index, query, query_text, pool_size, allowed_rows, rare_fraction, max_candidates)
+
+    fused_scores: dict[int, float] = {}
+    for ranking in (dense_rows, lexical_rows):
+        for rank, row in enumerate(ranking.tolist()):
+            fused_scores[row] = fused_scores.get(row, 0.0) + 1 / (RRF_K + rank + 1)
+    # Ties are broken by the lower row, like the dense ranking.
+    fused_rows = sorted(fused_scores, key=lambda row: (-fused_scores[row], row))[:k]
+    cosine = dict(zip(dense_rows.tolist(), dense_scores.tolist()))
+    lexical_only = [row for row in fused_rows if row not in cosine]
+    if lexical_only:
+        cosine.update(zip(lexical_only, index.score(query[None, :], np.asarray(lexical_only))[0].tolist()))
+    return [ScoredChunk(row=row, chunk=index.chunks[row], score=float(cosine[row])) for row in fused_rows]
+
+
+def hybrid_dense_ranking(
+    index: EmbeddingIndex,
+    query: np.ndarray,
+    query_text: str,
+    pool_size: int,
+    allowed_rows: np.ndarray | None = None,
+    rare_fraction: float = 0.01,
+    max_candidates: int = 5000
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Return the dense ranking fused by `hybrid_search`, best first, and the cosine similarities.
+    It always starts with the exact dense top `pool_size`; the rows holding the query's
+    identifiers that are not among them follow.
+    """
+    dense = index.search_batch(query[None, :], k=pool_size, allowed_rows=allowed_rows)[0]
+    dense_rows = np.asarray([scored_chunk.row for scored_chunk in dense], dtype=np.int64)
+    dense_scores = np.asarray([scored_chunk.score for scored_chunk in dense], dtype=np.float32)
+    candidates = index.lexical.identifier_rows(query_text, rare_fraction, max_candidates)
+    if candidates is not None and allowed_rows is not None:
+        candidates = np.intersect1d(candidates, allowed_rows, assume_unique=True)
+    if candidates is None or len(candidates) == 0:
+        _hybrid_search_counts["fused"] += 1
+        return dense_rows, dense_scores
+    _hybrid_search_counts["identifier_candidates"] += 1
+    candidates = candidates[~np.isin(candidates, dense_rows)]
+    candidate_scores = index.score(query[None, :], candidates)[0]
+    best = top_k_rows(candidate_scores, len(candidates))
+    return np.concatenate([dense_rows, candidates[best]]), np.concatenate([dense_scores, candidate_scores[best]])
+
+
+def hybrid_search_stats() -> dict:
+    return dict(_hybrid_search_counts)
@@ -0,0 +1,240 @@
+import json
+import logging
+import os
+from typing import Sequence
+
+import numpy as np
+
+from supportbot.clients.crawl.dataclasses import ChunkAndEmbedding
+
+from .chunk_texts import concat_chunks, take_chunks
+from .dataclasses import ScoredChunk
+from .embedding_index import EmbeddingIndex, normalize_rows, top_k_rows
+from .lexical_index import (LEXICAL_ARRAYS, LexicalIndex, concat_lexical,
+                            take_lexical)
+from .membership_index import (MEMBER_ARRAYS, MembershipIndex, concat_members,
+                               take_members)
+
+logger = logging.getLogger(__name__)
+
+ASSIGNMENT_BATCH_SIZE = 65536  # Rows assigned to clusters per matrix product, to bound the temporary score matrix.
+
+
+class IVFIndex(EmbeddingIndex):
+    """
+    Approximate cosine-similarity index using an inverted file (IVF).
+
+    The corpus is clustered with spherical k-means and the rows are stored grouped by
+    cluster, so a query only scores the `nprobe` clusters whose centroids are closest
+    to it instead of the whole matrix. Row numbers refer to the clustered order.
+    A search restricted to fewer rows than the probed clusters hold scans those rows exactly.
+    """
+    def __init__(
+        self,
+        chunks: Sequence[str],
+        embeddings,
+        centroids: np.ndarray,
+        list_offsets: np.ndarray,
+        nprobe: int = 8,
+        row_ids=None,
+        normalized: bool = False,
+        storage: str = "float32",
+        scales=None,
+        members: MembershipIndex | None = None,
+        lexical: LexicalIndex | None = None
+    ) -> None:
+        super().__init__(chunks, embeddings, row_ids, normalized, storage, scales, members, lexical)
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.list_offsets = np.asarray(list_offsets, dtype=np.int64)
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(
+        cls,
+        index: EmbeddingIndex,
+        n_lists: int | None = None,
+        nprobe: int = 8,
+        iterations: int = 10,
+        seed: int = 0
+    ) -> "IVFIndex":
+        """
+        Cluster an exact index into an IVF index.
+        Args:
+            index (EmbeddingIndex): The exact index to cluster.
+            n_lists (int | None): The number of clusters, 4 * sqrt(corpus size) by default.
+            nprobe (int): The number of clusters scanned per query.
+            iterations (int): The number of k-means iterations.
+            seed (int): The seed used to sample the training rows.
+        Returns:
+            IVFIndex: The clustered index.
+        """
+        if n_lists is None:
+            n_lists = max(1, int(4 * np.sqrt(len(index))))
+        n_lists = max(1, min(n_lists, len(index)))
+        rng = np.random.default_rng(seed)
+        # k-means only needs a sample of the corpus to place the centroids.
+        sample_size = min(len(index), n_lists * 256)
+        sample = index.embeddings(np.sort(rng.choice(len(index), size=sample_size, replace=False)))
+        centroids = sample[rng.choice(sample_size, size=n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = _assign(sample, centroids)
+            counts = np.bincount(assignments, minlength=n_lists)
+            empty = counts == 0
+            sums = np.zeros_like(centroids)
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            sums[~empty] = np.add.reduceat(sample[np.argsort(assignments, kind="stable")], starts[~empty])
+            # Re-seed empty clusters with random sample rows instead of leaving them dead.
+            sums[empty] = sample[rng.choice(sample_size, size=int(empty.sum()))]
+            centroids = normalize_rows(sums)
+
+        assignments = _assign(index, centroids)
+        order = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=n_lists), out=list_offsets[1:])
+        logger.info(f"Built IVF index over {len(index)} chunks with {n_lists} lists")
+        return cls(
+            chunks=take_chunks(index.chunks, order),
+            embeddings=index.matrix[order],
+            centroids=centroids,
+            list_offsets=list_offsets,
+            nprobe=nprobe,
+            row_ids=index.row_ids[order],
+            normalized=True,
+            storage=index.storage,
+            scales=None if index.scales is None else index.scales[order],
+            members=take_members(index.members, order),
+            lexical=take_lexical(index.lexical, order)
+        )
+
+    def merged(self, chunks_text_and_embedding: list[ChunkAndEmbedding]) -> "IVFIndex":
+        """
+        Return a new index with the given rows added to their nearest existing clusters.
+
+        The centroids are not retrained; rebuild the index when the corpus has drifted a lot.
+        """
+        if not chunks_text_and_embedding:
+            return self
+        update = EmbeddingIndex.from_chunks(chunks_text_and_embedding, storage=self.storage)
+        keep = self._rows_kept_after(update)
+        n_lists = self.centroids.shape[0]
+        current_lists = np.repeat(np.arange(n_lists), np.diff(self.list_offsets))[keep]
+        assignments = np.concatenate([current_lists, _assign(update, self.centroids)])
+        order = np.argsort(assignments, kind="stable")
+        chunks = concat_chunks(take_chunks(self.chunks, np.flatnonzero(keep)), update.chunks)
+        matrix = np.vstack([self.matrix[keep], update.matrix])
+        row_ids = np.concatenate([self.row_ids[keep], update.row_ids])
+        scales = None if self.scales is None else np.concatenate([self.scales[keep], update.scales])
+        members = concat_members(take_members(self.members, np.flatnonzero(keep)), update.members)
+        lexical = concat_lexical(take_lexical(self.lexical, np.flatnonzero(keep)), update.chunks)
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=n_lists), out=list_offsets[1:])
+        return IVFIndex(
+            chunks=take_chunks(chunks, order),
+            embeddings=matrix[order],
+            centroids=self.centroids,
+            list_offsets=list_offsets,
+            nprobe=self.nprobe,
+            row_ids=row_ids[order],
+            normalized=True,
+            storage=self.storage,
+            scales=None if scales is None else scales[order],
+            members=take_members(members, order),
+            lexical=take_lexical(lexical, order)
+        )
+
+    def search_batch(self, queries: np.ndarray, k: int = 5, allowed_rows: np.ndarray | None = None) -> list[list[ScoredChunk]]:
+        if len(self) == 0 or k <= 0 or (allowed_rows is not None and len(allowed_rows) == 0):
+            return [[] for _ in range(queries.shape[0])]
+        nprobe = min(self.nprobe, self.centroids.shape[0])
+        if allowed_rows is not None and len(allowed_rows) <= nprobe * len(self) / self.centroids.shape[0]:
+            return EmbeddingIndex.search_batch(self, queries, k, allowed_rows)
+        probed_lists = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        results = []
+        for query, lists in zip(queries, probed_lists):
+            rows = np.concatenate([self._list_rows(list_id, allowed_rows) for list_id in lists])
+            if len(rows) == 0:
+                results.append([])
+                continue
+            scores = self.score(query[None, :], rows)[0]
+            best = top_k_rows(scores, k)
+            results.append([
+                ScoredChunk(row=int(rows[position]), chunk=self.chunks[rows[position]], score=float(scores[position]))
+                for position in best
+            ])
+        return results
+
+    def _list_rows(self, list_id: int, allowed_rows: np.ndarray | None) -> np.ndarray:
+        start, end = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+        if allowed_rows is None:
+            return np.arange(start, end)
+        # Lists are contiguous row ranges, so the allowed rows inside one are a slice of the sorted array.
+        return allowed_rows[np.searchsorted(allowed_rows, start):np.searchsorted(allowed_rows, end)]
+
+    def save(self, path: str, fingerprint: str | None = None) -> None:
+        """
+        Save the index to a directory so it can be loaded without re-clustering.
+        Args:
+            path (str): The directory to write to.
+            fingerprint (str | None): The `fingerprint` of the corpus the index was built from.
+        """
+        os.makedirs(path, exist_ok=True)
+        np.savez(
+            os.path.join(path, "ivf_index.npz"),
+            matrix=self.matrix,
+            centroids=self.centroids,
+            list_offsets=self.list_offsets,
+            row_ids=self.row_ids,
+            storage=np.array(self.storage),
+            fingerprint=np.array(fingerprint or self.fingerprint()),
+            **({} if self.scales is None else {"scales": self.scales}),
+            **({} if self.members is None else dict(zip(MEMBER_ARRAYS, self.members.to_arrays()))),
+            **({} if self.lexical is None else dict(zip(LEXICAL_ARRAYS, self.lexical.to_arrays())))
+        )
+        with open(os.path.join(path, "chunks.json"), "w") as chunks_file:
+            json.dump(list(self.chunks), chunks_file)
+
+    @staticmethod
+    def saved_fingerprint(path: str) -> str | None:
+        """
+        Return the corpus fingerprint of an index saved with `save`, or None when there is
+        no saved index or it predates fingerprints.
+        """
+        try:
+            with np.load(os.path.join(path, "ivf_index.npz")) as arrays:
+                return str(arrays["fingerprint"]) if "fingerprint" in arrays else None
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def load(cls, path: str, nprobe: int = 8) -> "IVFIndex":
+        """
+        Load an index saved with `save`.
+        """
+        arrays = np.load(os.path.join(path, "ivf_index.npz"))
+        with open(os.path.join(path, "chunks.json")) as chunks_file:
+            chunks = json.load(chunks_file)
+        return cls(
+            chunks=chunks,
+            embeddings=arrays["matrix"],
+            centroids=arrays["centroids"],
+            list_offsets=arrays["list_offsets"],
+            nprobe=nprobe,
+            row_ids=arrays["row_ids"] if "row_ids" in arrays else None,
+            normalized=True,
+            storage=str(arrays["storage"]) if "storage" in arrays else "float32",
+            scales=arrays["scales"] if "scales" in arrays else None,
+            members=MembershipIndex.from_arrays(
+                *(arrays[name] for name in MEMBER_ARRAYS), len(chunks)
+            ) if MEMBER_ARRAYS[0] in arrays else None,
+            lexical=LexicalIndex(*(arrays[name] for name in LEXICAL_ARRAYS)) if LEXICAL_ARRAYS[0] in arrays else None
+        )
+
+
+def _assign(matrix: np.ndarray | EmbeddingIndex, centroids: np.ndarray) -> np.ndarray:
+    row_count = len(matrix) if isinstance(matrix, EmbeddingIndex) else matrix.shape[0]
+    assignments = np.empty(row_count, dtype=np.int64)
+    for start in range(0, row_count, ASSIGNMENT_BATCH_SIZE):
+        rows = slice(start, start + ASSIGNMENT_BATCH_SIZE)
+        batch = matrix.embeddings(rows) if isinstance(matrix, EmbeddingIndex) else matrix[rows]
+        assignments[rows] = np.argmax(batch @ centroids.T, axis=1)
+    return assignments
@@ -0,0 +1,194 @@
+import logging
+import math
+import re
+from typing import Callable, Sequence
+
+import numpy as np
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Tokens in more than this fraction of the chunks, and in more than MIN_COMMON_TOKEN_ROWS of them,
+# carry almost no BM25 weight and are skipped instead of reading their long posting lists.
+COMMON_TOKEN_FRACTION = 0.1
+MIN_COMMON_TOKEN_ROWS = 100
+# Words that look like identifiers rather than prose: error codes, ticket ids, paths, snake_case or
+# camelCase names. Only these restrict the candidates of a hybrid search; plain words never do.
+IDENTIFIER_PATTERN = re.compile(
+    r"[A-Za-z0-9]*\d[A-Za-z0-9]*(?:[-_./:][A-Za-z0-9]+)*"
+    r"|[A-Za-z0-9]+(?:[-_./:][A-Za-z0-9]+)+"
+    r"|[a-z]+[A-Z][A-Za-z0-9]*"
+)
+# Names the postings arrays are saved under, in the order of `to_arrays`.
+LEXICAL_ARRAYS = ("lexical_tokens", "lexical_rows", "lexical_counts", "lexical_row_lengths")
+
+_encoding = None
+
+
+def tokenize(text: str) -> list[int]:
+    """
+    Split text into cl100k_base token ids, the tokenizer the chunks were cut with in agent_code.chunk_utils.
+    Text is lowercased first so identifiers match whatever their casing.
+    """
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    return _encoding.encode_ordinary(text.lower())
+
+
+class LexicalIndex:
+    """
+    In-memory BM25 inverted index over chunk texts.
+
+    The postings are three flat arrays sorted by (token, row): the token id, the row and
+    the token's count in that row, so a token's postings are found with a binary search
+    and the index can be memory-mapped from a snapshot. Rows follow the order of the
+    `EmbeddingIndex` the lexical index is attached to.
+    """
+    def __init__(
+        self,
+        tokens: np.ndarray,
+        rows: np.ndarray,
+        counts: np.ndarray,
+        row_lengths: np.ndarray,
+        tokenizer: Callable[[str], list[int]] = tokenize
+    ) -> None:
+        self.tokens = tokens
+        self.rows = rows
+        self.counts = counts
+        self.row_lengths = row_lengths
+        self.tokenizer = tokenizer
+        self.average_length = float(row_lengths.mean()) if len(row_lengths) and row_lengths.any() else 1.0
+
+    @classmethod
+    def build(cls, chunks: Sequence[str], tokenizer: Callable[[str], list[int]] = tokenize) -> "LexicalIndex":
+        """
+        Tokenize every chunk and build the postings.
+        Args:
+            chunks (Sequence[str]): The chunk texts, in row order.
+            tokenizer (Callable[[str], list[int]]): Turns a text into token ids.
+        Returns:
+            LexicalIndex: The index over the chunks.
+        """
+        row_count = len(chunks)
+        token_lists = [np.asarray(tokenizer(chunk), dtype=np.int64) for chunk in chunks]
+        row_lengths = np.fromiter((len(tokens) for tokens in token_lists), dtype=np.int64, count=row_count)
+        all_tokens = np.concatenate(token_lists) if token_lists else np.empty(0, dtype=np.int64)
+        # One key per (token, row) pair; np.unique sorts them and counts the repeats in one pass.
+        keys, counts = np.unique(all_tokens * max(row_count, 1) + np.repeat(np.arange(row_count), row_lengths), return_counts=True)
+        logger.info(f"Built lexical index over {row_count} chunks with {len(keys)} postings")
+        return cls(keys // max(row_count, 1), keys % max(row_count, 1), counts.astype(np.int32), row_lengths, tokenizer)
+
+    def __len__(self) -> int:
+        return len(self.row_lengths)
+
+    @property
+    def nbytes(self) -> int:
+        return self.tokens.nbytes + self.rows.nbytes + self.counts.nbytes + self.row_lengths.nbytes
+
+    def to_arrays(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        return self.tokens, self.rows, self.counts, self.row_lengths
+
+    def search(self, query: str, k: int, allowed_rows: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Return the k rows with the highest BM25 score for the query, best first, and their scores.
+        Only the postings of the query's tokens are read, skipping tokens common to most chunks.
+        """
+        row_count = len(self)
+        matched_rows, contributions = [], []
+        for token in set(self.tokenizer(query)):
+            start, end = self._postings(token)
+            frequency = end - start
+            if frequency == 0 or frequency > max(COMMON_TOKEN_FRACTION * row_count, MIN_COMMON_TOKEN_ROWS):
+                continue
+            idf = math.log(1 + (row_count - frequency + 0.5) / (frequency + 0.5))
+            rows = self.rows[start:end]
+            counts = self.counts[start:end]
+            length_norm = 1 - BM25_B + BM25_B * self.row_lengths[rows] / self.average_length
+            matched_rows.append(rows)
+            contributions.append(idf * counts * (BM25_K1 + 1) / (counts + BM25_K1 * length_norm))
+        if not matched_rows:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        rows, positions = np.unique(np.concatenate(matched_rows), return_inverse=True)
+        scores = np.bincount(positions, weights=np.concatenate(contributions))
+        if allowed_rows is not None:
+            visible = np.isin(rows, allowed_rows, assume_unique=True)
+            rows, scores = rows[visible], scores[visible]
+        # Rows come out of np.unique sorted, so the stable sort breaks ties by the lower row.
+        best = np.argsort(-scores, kind="stable")[:k]
+        return rows[best], scores[best]
+
+    def identifier_rows(self, query: str, rare_fraction: float, max_rows: int) -> np.ndarray | None:
+        """
+        Return the sorted rows holding the identifiers of the query, such as an error code,
+        a ticket id or a path, or None when the query has none or they match too many rows.
+        Only the rare tokens of words matching IDENTIFIER_PATTERN count, so a question in
+        plain words never narrows the search. Rows holding every such token are preferred;
+        when no row holds them all, the rows holding any of them are returned.
+        """
+        rare_frequency = max(1, int(rare_fraction * len(self)))
+        postings = []
+        for token in set(token for word in identifiers(query) for token in self.tokenizer(word)):
+            start, end = self._postings(token)
+            if 0 < end - start <= rare_frequency:
+                postings.append(self.rows[start:end])
+        if not postings:
+            return None
+        # Identifiers are split into several tokens, so the rows sharing all of them are the exact matches.
+        rows = postings[0]
+        for token_rows in postings[1:]:
+            rows = np.intersect1d(rows, token_rows, assume_unique=True)
+        if len(rows) == 0:
+            rows = np.unique(np.concatenate(postings))
+        return rows if len(rows) <= max_rows else None
+
+    def take(self, rows: np.ndarray) -> "LexicalIndex":
+        """
+        Select rows in a new order, like `take_chunks`; rows left out are dropped from the postings.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == len(self) and np.array_equal(rows, np.arange(len(self))):
+            return self
+        new_rows = np.full(len(self), -1, dtype=np.int64)
+        new_rows[rows] = np.arange(len(rows))
+        moved = new_rows[self.rows]
+        kept = moved >= 0
+        tokens, moved, counts = self.tokens[kept], moved[kept], self.counts[kept]
+        order = np.lexsort((moved, tokens))
+        return LexicalIndex(tokens[order], moved[order], counts[order], self.row_lengths[rows], self.tokenizer)
+
+    def extend(self, chunks: Sequence[str]) -> "LexicalIndex":
+        """
+        Append chunks after the current rows.
+        """
+        update = LexicalIndex.build(chunks, self.tokenizer)
+        tokens = np.concatenate([self.tokens, update.tokens])
+        rows = np.concatenate([self.rows, update.rows + len(self)])
+        order = np.lexsort((rows, tokens))
+        return LexicalIndex(
+            tokens[order],
+            rows[order],
+            np.concatenate([self.counts, update.counts])[order],
+            np.concatenate([self.row_lengths, update.row_lengths]),
+            self.tokenizer
+        )
+
+    def _postings(self, token: int) -> tuple[int, int]:
+        return int(np.searchsorted(self.tokens, token, side="left")), int(np.searchsorted(self.tokens, token, side="right"))
+
+
+def identifiers(text: str) -> list[str]:
+    """
+    Return the words of a text that look like identifiers, see IDENTIFIER_PATTERN.
+    """
+    return IDENTIFIER_PATTERN.findall(text)
+
+
+def take_lexical(lexical: LexicalIndex | None, rows) -> LexicalIndex | None:
+    return None if lexical is None else lexical.take(rows)
+
+
+def concat_lexical(lexical: LexicalIndex | None, new_chunks: Sequence[str]) -> LexicalIndex | None:
+    return None if lexical is None else lexical.extend(new_chunks)
@@ -0,0 +1,118 @@
+import json
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Names the posting lists are saved under, in the order of `to_arrays`.
+MEMBER_ARRAYS = ("member_ids", "member_offsets", "member_rows")
+
+
+class MembershipIndex:
+    """
+    Posting lists from a Telegram user id to the rows of the chunks that user may see.
+
+    A chunk of chat history is visible to the members of the chat it was taken from.
+    Each posting list is a sorted array of row numbers, so filtering a search to one
+    user costs a dictionary lookup, and only the user's rows are scored afterwards.
+    Chunks without member information are visible to nobody.
+    """
+    def __init__(self, postings: dict[int, np.ndarray], row_count: int) -> None:
+        self.postings = postings
+        self.row_count = row_count
+
+    @classmethod
+    def from_members(cls, members: list[list[int] | None]) -> "MembershipIndex":
+        """
+        Build the posting lists from the member ids of each row, in row order.
+        """
+        rows_by_member: dict[int, list[int]] = {}
+        for row, member_ids in enumerate(members):
+            for member_id in member_ids or ():
+                rows_by_member.setdefault(member_id, []).append(row)
+        return cls(
+            {member_id: np.asarray(rows, dtype=np.int64) for member_id, rows in rows_by_member.items()},
+            len(members)
+        )
+
+    @classmethod
+    def from_arrays(cls, member_ids: np.ndarray, offsets: np.ndarray, rows: np.ndarray, row_count: int) -> "MembershipIndex":
+        """
+        Rebuild the posting lists written by `to_arrays`.
+        """
+        postings = {
+            int(member_id): rows[offsets[position]:offsets[position + 1]]
+            for position, member_id in enumerate(member_ids)
+        }
+        return cls(postings, row_count)
+
+    def to_arrays(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Flatten the posting lists into member ids, offsets into the rows array, and the rows.
+        """
+        member_ids = np.fromiter(self.postings, dtype=np.int64, count=len(self.postings))
+        offsets = np.zeros(len(member_ids) + 1, dtype=np.int64)
+        np.cumsum([len(self.postings[int(member_id)]) for member_id in member_ids], out=offsets[1:])
+        rows = np.concatenate([self.postings[int(member_id)] for member_id in member_ids]) if len(member_ids) else np.empty(0, dtype=np.int64)
+        return member_ids, offsets, rows
+
+    def rows_for(self, member_id: int) -> np.ndarray:
+        """
+        Return the sorted rows visible to a user.
+        """
+        return self.postings.get(member_id, np.empty(0, dtype=np.int64))
+
+    def take(self, rows: np.ndarray) -> "MembershipIndex":
+        """
+        Select rows in a new order, like `take_chunks`; rows left out are dropped from every posting list.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == self.row_count and np.array_equal(rows, np.arange(self.row_count)):
+            return self
+        new_rows = np.full(self.row_count, -1, dtype=np.int64)
+        new_rows[rows] = np.arange(len(rows))
+        postings = {}
+        for member_id, member_rows in self.postings.items():
+            moved = new_rows[member_rows]
+            moved = moved[moved >= 0]
+            if len(moved):
+                moved.sort()
+                postings[member_id] = moved
+        return MembershipIndex(postings, len(rows))
+
+    def extend(self, other: "MembershipIndex") -> "MembershipIndex":
+        """
+        Append the rows of another index after these; only the posting lists of its members are copied.
+        """
+        postings = dict(self.postings)
+        for member_id, member_rows in other.postings.items():
+            shifted = member_rows + self.row_count
+            existing = postings.get(member_id)
+            postings[member_id] = shifted if existing is None else np.concatenate([existing, shifted])
+        return MembershipIndex(postings, self.row_count + other.row_count)
+
+
+def parse_member_ids(value) -> list[int] | None:
+    """
+    Decode a `chat_member_ids` value, stored either as a JSON string or as a JSON array.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            logger.warning(f"Could not decode chat member ids: {value[:100]}")
+            return None
+    return [int(member_id) for member_id in value]
+
+
+def take_members(members: MembershipIndex | None, rows) -> MembershipIndex | None:
+    return None if members is None else members.take(rows)
+
+
+def concat_members(members: MembershipIndex | None, new_members: MembershipIndex | None) -> MembershipIndex | None:
+    if members is None or new_members is None:
+        return None
+    return members.extend(new_members)
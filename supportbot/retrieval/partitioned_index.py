@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable
+
+from .chunk_texts import MappedChunkTexts
+from .corpus_loader import partition_name
+from .corpus_refresher import CorpusRefresher
+from .embedding_index import EmbeddingIndex
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Partition:
+    index: EmbeddingIndex
+    nbytes: int
+    loaded_at: float
+    hits: int = 0
+    refresher: CorpusRefresher | None = field(default=None, repr=False)
+
+
+class PartitionedIndexCache:
+    """
+    Retrieval indexes of a chunk table, partitioned by bot and loaded on demand.
+
+    A bot's partition is loaded on its first question and kept in an LRU bounded by
+    `max_bytes`; the least recently used partitions are evicted once the loaded ones
+    take more memory than that. Concurrent first questions for the same bot share one
+    load. Questions already running keep the index they started with after an eviction.
+    With `refresh_options`, every loaded partition gets a `CorpusRefresher` built with
+    them, so `run` keeps the hot partitions in sync with the table.
+    """
+    def __init__(
+        self,
+        table_name: str,
+        load_partition: Callable[[int], EmbeddingIndex],
+        max_bytes: int,
+        refresh_options: dict | None = None
+    ) -> None:
+        self.table_name = table_name
+        self.load_partition = load_partition
+        self.max_bytes = max_bytes
+        self.refresh_options = refresh_options
+        self._partitions: OrderedDict[int, _Partition] = OrderedDict()
+        self._loading: dict[int, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+
+    async def get(self, bot_id: int) -> EmbeddingIndex:
+        """
+        Return the index of a bot's partition, loading it when it is not in memory.
+        Args:
+            bot_id (int): The bot whose chunks are searched.
+        Returns:
+            EmbeddingIndex: The index over the bot's chunks.
+        """
+        partition = self._partitions.get(bot_id)
+        if partition is not None:
+            self._partitions.move_to_end(bot_id)
+            partition.hits += 1
+            self.hits += 1
+            return partition.index
+        self.misses += 1
+        loading = self._loading.get(bot_id)
+        if loading is None:
+            loading = asyncio.ensure_future(self._load(bot_id))
+            self._loading[bot_id] = loading
+            loading.add_done_callback(lambda _: self._loading.pop(bot_id, None))
+        # A cancelled question must not cancel the load other questions are waiting for.
+        return await asyncio.shield(loading)
+
+    async def run(self, interval: float) -> None:
+        """
+        Refresh every loaded partition every `interval` seconds until cancelled.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            for bot_id, partition in list(self._partitions.items()):
+                if partition.refresher is None:
+                    continue
+                try:
+                    await partition.refresher.refresh()
+                except Exception as e:
+                    logger.error(f"Error refreshing {partition.refresher.name}: {str(e)}")
+
+    def invalidate(self, bot_id: int | None = None) -> None:
+        """
+        Drop one bot's partition, or every partition when no bot is given.
+        """
+        bot_ids = [bot_id] if bot_id is not None else list(self._partitions)
+        for invalidated_bot_id in bot_ids:
+            self._partitions.pop(invalidated_bot_id, None)
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "partitions": len(self._partitions),
+            "mb": round(self._total_bytes() / 2**20, 1),
+            "max_mb": round(self.max_bytes / 2**20, 1),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / requests, 3) if requests else None,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "by_bot": {
+                bot_id: {
+                    "chunks": len(partition.index),
+                    "mb": round(partition.nbytes / 2**20, 1),
+                    "hits": partition.hits,
+                }
+                for bot_id, partition in self._partitions.items()
+            },
+        }
+
+    async def _load(self, bot_id: int) -> EmbeddingIndex:
+        started_at = time.monotonic()
+        index = await asyncio.to_thread(self.load_partition, bot_id)
+        partition = _Partition(index=index, nbytes=index_nbytes(index), loaded_at=time.monotonic())
+        self.loads += 1
+        if self.refresh_options is not None:
+            partition.refresher = CorpusRefresher(
+                self.table_name,
+                get_index=lambda: partition.index,
+                set_index=lambda new_index: self._replace(bot_id, partition, new_index),
+                bot_id=bot_id,
+                **self.refresh_options
+            )
+            if self.refresh_options.get("snapshot_dir"):
+                # Apply the rows added since the partition's snapshot was written.
+                await partition.refresher.refresh()
+        self._partitions[bot_id] = partition
+        self._partitions.move_to_end(bot_id)
+        logger.info(
+            f"Loaded partition {partition_name(self.table_name, bot_id)} with {len(partition.index)} chunks "
+            f"({partition.nbytes / 2**20:.1f} MB) in {time.monotonic() - started_at:.1f}s"
+        )
+        self._evict(keep=bot_id)
+        return partition.index
+
+    def _replace(self, bot_id: int, partition: _Partition, index: EmbeddingIndex) -> None:
+        partition.index = index
+        partition.nbytes = index_nbytes(index)
+        if self._partitions.get(bot_id) is partition:
+            self._evict(keep=bot_id)
+
+    def _evict(self, keep: int) -> None:
+        while self._total_bytes() > self.max_bytes and len(self._partitions) > 1:
+            bot_id = next(iter(self._partitions))
+            if bot_id == keep:
+                self._partitions.move_to_end(bot_id)
+                continue
+            partition = self._partitions.pop(bot_id)
+            self.evictions += 1
+            logger.info(
+                f"Evicted partition {partition_name(self.table_name, bot_id)} "
+                f"({partition.nbytes / 2**20:.1f} MB, {partition.hits} hits)"
+            )
+
+    def _total_bytes(self) -> int:
+        return sum(partition.nbytes for partition in self._partitions.values())
+
+
+def index_nbytes(index: EmbeddingIndex) -> int:
+    """
+    Estimate the memory an index takes, counting memory-mapped data as resident.
+    """
+    nbytes = index.nbytes + index.row_ids.nbytes
+    if isinstance(index.chunks, MappedChunkTexts):
+        return nbytes + index.chunks.blob.nbytes + index.chunks.refs.nbytes
+    return nbytes + sum(len(chunk) for chunk in index.chunks)
@@ -0,0 +1,189 @@
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+
+from .chunk_texts import MappedChunkTexts
+from .embedding_index import EmbeddingIndex
+from .ivf_index import IVFIndex
+from .lexical_index import LEXICAL_ARRAYS, LexicalIndex
+from .membership_index import MEMBER_ARRAYS, MembershipIndex
+from .two_stage_index import TwoStageIndex
+
+logger = logging.getLogger(__name__)
+
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+
+
+def save_snapshot(index: EmbeddingIndex, snapshot_dir: str, table_name: str) -> EmbeddingIndex:
+    """
+    Write an index to a new snapshot version and return it memory-mapped from disk.
+
+    A snapshot version is a directory holding the normalized embedding matrix, the row
+    ids, the per-row scales of int8 embeddings, the chunk texts as one UTF-8 blob with an
+    offset table, the IVF clustering or the prefix embeddings (with their int8 scales)
+    when there are any, the chunk membership posting lists and the lexical postings when
+    the corpus has them, and a manifest with the row id watermark. The `CURRENT` file is switched to the new
+    version with an atomic rename, so readers never see a partial snapshot.
+    Args:
+        index (EmbeddingIndex): The index to write.
+        snapshot_dir (str): The root directory of the snapshots.
+        table_name (str): The chunk table the index was loaded from.
+    Returns:
+        EmbeddingIndex: The same index, backed by the memory-mapped snapshot.
+    """
+    table_dir = os.path.join(snapshot_dir, table_name)
+    version = f"{time.time_ns()}-{os.getpid()}"
+    version_dir = os.path.join(table_dir, version)
+    os.makedirs(version_dir)
+
+    np.save(os.path.join(version_dir, "embeddings.npy"), index.matrix)
+    np.save(os.path.join(version_dir, "row_ids.npy"), index.row_ids)
+    if index.scales is not None:
+        np.save(os.path.join(version_dir, "scales.npy"), index.scales)
+    if index.members is not None:
+        for name, array in zip(MEMBER_ARRAYS, index.members.to_arrays()):
+            np.save(os.path.join(version_dir, f"{name}.npy"), array)
+    if index.lexical is not None:
+        for name, array in zip(LEXICAL_ARRAYS, index.lexical.to_arrays()):
+            np.save(os.path.join(version_dir, f"{name}.npy"), array)
+    offsets = np.zeros(len(index) + 1, dtype=np.int64)
+    with open(os.path.join(version_dir, "chunks.bin"), "wb") as blob_file:
+        for position, chunk in enumerate(index.chunks):
+            encoded = chunk.encode("utf-8")
+            blob_file.write(encoded)
+            offsets[position + 1] = offsets[position] + len(encoded)
+    np.save(os.path.join(version_dir, "chunk_offsets.npy"), offsets)
+    if isinstance(index, IVFIndex):
+        np.save(os.path.join(version_dir, "centroids.npy"), index.centroids)
+        np.save(os.path.join(version_dir, "list_offsets.npy"), index.list_offsets)
+    if isinstance(index, TwoStageIndex):
+        np.save(os.path.join(version_dir, "prefix_embeddings.npy"), index.prefix_matrix)
+        if index.prefix_scales is not None:
+            np.save(os.path.join(version_dir, "prefix_scales.npy"), index.prefix_scales)
+    manifest = {
+        "table_name": table_name,
+        **index_params(index),
+        "storage": index.storage,
+        "has_members": index.members is not None,
+        "has_lexical": index.lexical is not None,
+        "rows": len(index),
+        "dimension": int(index.matrix.shape[1]),
+        "watermark": int(index.row_ids.max()) if len(index) else 0,
+        "created_at": time.time(),
+    }
+    with open(os.path.join(version_dir, MANIFEST_FILE), "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    current_tmp = os.path.join(table_dir, f"{CURRENT_FILE}.{version}")
+    with open(current_tmp, "w") as current_file:
+        current_file.write(version)
+    os.replace(current_tmp, os.path.join(table_dir, CURRENT_FILE))
+    _remove_old_versions(table_dir, keep=version)
+    logger.info(f"Wrote snapshot {version} of {table_name} with {len(index)} chunks")
+    return load_snapshot(snapshot_dir, table_name)
+
+
+def index_params(index: EmbeddingIndex) -> dict:
+    """
+    Return the kind of a retrieval index and the parameters it was built with, as kept in a snapshot manifest.
+    """
+    if isinstance(index, IVFIndex):
+        return {"index_type": "ivf", "n_lists": int(index.centroids.shape[0]), "nprobe": index.nprobe}
+    if isinstance(index, TwoStageIndex):
+        return {"index_type": "two_stage", "prefix_dims": index.prefix_dims, "pool_size": index.pool_size}
+    return {"index_type": "exact"}
+
+
+def load_snapshot(snapshot_dir: str, table_name: str, nprobe: int | None = None) -> EmbeddingIndex | None:
+    """
+    Memory-map the current snapshot of a table.
+
+    Nothing is copied onto the heap: embedding pages are read on demand and shared with
+    every process mapping the same snapshot, and chunk texts are only decoded for hits.
+    Args:
+        snapshot_dir (str): The root directory of the snapshots.
+        table_name (str): The chunk table the index was loaded from.
+        nprobe (int | None): The clusters an IVF snapshot probes per query, the saved value by default.
+    Returns:
+        EmbeddingIndex | None: The snapshot index, or None when the table has no snapshot.
+    """
+    table_dir = os.path.join(snapshot_dir, table_name)
+    try:
+        with open(os.path.join(table_dir, CURRENT_FILE)) as current_file:
+            version_dir = os.path.join(table_dir, current_file.read().strip())
+        with open(os.path.join(version_dir, MANIFEST_FILE)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except FileNotFoundError:
+        return None
+
+    # Empty arrays cannot be memory-mapped.
+    mmap_mode = "r" if manifest["rows"] else None
+    matrix = np.load(os.path.join(version_dir, "embeddings.npy"), mmap_mode=mmap_mode)
+    row_ids = np.load(os.path.join(version_dir, "row_ids.npy"), mmap_mode=mmap_mode)
+    offsets = np.load(os.path.join(version_dir, "chunk_offsets.npy"))
+    blob_path = os.path.join(version_dir, "chunks.bin")
+    blob = np.memmap(blob_path, dtype=np.uint8, mode="r") if os.path.getsize(blob_path) else np.empty(0, dtype=np.uint8)
+    chunks = MappedChunkTexts(blob, offsets)
+    # Snapshots written before quantized storage existed hold float32 embeddings.
+    storage = manifest.get("storage", "float32")
+    scales = np.load(os.path.join(version_dir, "scales.npy")) if storage == "int8" else None
+    members = None
+    if manifest.get("has_members"):
+        try:
+            members = MembershipIndex.from_arrays(
+                *(np.load(os.path.join(version_dir, f"{name}.npy")) for name in MEMBER_ARRAYS),
+                row_count=manifest["rows"]
+            )
+        except FileNotFoundError:
+            # Left without members, the snapshot of an access-controlled table is rebuilt by load_corpus.
+            logger.warning(f"Snapshot of {table_name} is missing its membership arrays")
+    lexical = None
+    if manifest.get("has_lexical"):
+        lexical = LexicalIndex(*(np.load(os.path.join(version_dir, f"{name}.npy"), mmap_mode=mmap_mode) for name in LEXICAL_ARRAYS))
+    logger.info(f"Mapped snapshot of {table_name} with {manifest['rows']} chunks (watermark {manifest['watermark']})")
+    if manifest["index_type"] == "ivf":
+        return IVFIndex(
+            chunks=chunks,
+            embeddings=matrix,
+            centroids=np.load(os.path.join(version_dir, "centroids.npy")),
+            list_offsets=np.load(os.path.join(version_dir, "list_offsets.npy")),
+            nprobe=manifest.get("nprobe", 8) if nprobe is None else nprobe,
+            row_ids=row_ids,
+            normalized=True,
+            storage=storage,
+            scales=scales,
+            members=members,
+            lexical=lexical
+        )
+    if manifest["index_type"] == "two_stage":
+        prefix_matrix = np.load(os.path.join(version_dir, "prefix_embeddings.npy"), mmap_mode=mmap_mode)
+        # Snapshots written before the prefixes were quantized hold float32 prefixes, quantized on load.
+        prefix_scales = np.load(os.path.join(version_dir, "prefix_scales.npy")) if prefix_matrix.dtype == np.int8 else None
+        return TwoStageIndex(
+            chunks=chunks,
+            embeddings=matrix,
+            prefix_dims=manifest["prefix_dims"],
+            pool_size=manifest["pool_size"],
+            row_ids=row_ids,
+            normalized=True,
+            storage=storage,
+            scales=scales,
+            prefix_matrix=prefix_matrix,
+            members=members,
+            lexical=lexical,
+            prefix_scales=prefix_scales
+        )
+    return EmbeddingIndex(chunks, matrix, row_ids, normalized=True, storage=storage, scales=scales, members=members, lexical=lexical)
+
+
+def _remove_old_versions(table_dir: str, keep: str) -> None:
+    # Processes still mapping an old version keep reading it; the files are only freed once unmapped.
+    for entry in os.listdir(table_dir):
+        path = os.path.join(table_dir, entry)
+        if entry != keep and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
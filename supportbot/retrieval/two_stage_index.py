@@ -0,0 +1,145 @@
+import logging
+from typing import Sequence
+
+import numpy as np
+
+from supportbot.clients.crawl.dataclasses import ChunkAndEmbedding
+
+from .chunk_texts import concat_chunks, take_chunks
+from .dataclasses import ScoredChunk
+from .embedding_index import (SCORE_BLOCK_SIZE, EmbeddingIndex, _concat_scales,
+                              _stack, normalize_rows, top_k_rows)
+from .lexical_index import LexicalIndex, concat_lexical, take_lexical
+from .membership_index import MembershipIndex, concat_members, take_members
+
+logger = logging.getLogger(__name__)
+
+
+class TwoStageIndex(EmbeddingIndex):
+    """
+    Coarse-to-fine cosine-similarity index over truncated embeddings.
+
+    text-embedding-3 vectors still rank well when cut to a prefix of their dimensions.
+    Every chunk is scored on the renormalized first `prefix_dims` dimensions to pick the
+    `pool_size` best candidates, and only those are rescored with the full vectors.
+    The prefixes are kept as a separate matrix next to the full embeddings, in the same
+    storage type, so an int8 or float16 index does not hold a float32 copy of its prefixes.
+    """
+    def __init__(
+        self,
+        chunks: Sequence[str],
+        embeddings,
+        prefix_dims: int = 256,
+        pool_size: int = 100,
+        row_ids=None,
+        normalized: bool = False,
+        storage: str = "float32",
+        scales=None,
+        prefix_matrix: np.ndarray | None = None,
+        members: MembershipIndex | None = None,
+        lexical: LexicalIndex | None = None,
+        prefix_scales=None
+    ) -> None:
+        super().__init__(chunks, embeddings, row_ids, normalized, storage, scales, members, lexical)
+        self.prefix_dims = prefix_dims
+        self.pool_size = pool_size
+        if prefix_matrix is None:
+            prefix_matrix = prefix_embeddings(self, prefix_dims)
+        # The prefixes are scored like the full embeddings, block by block when quantized.
+        self.prefix = EmbeddingIndex(chunks, prefix_matrix, normalized=True, storage=storage, scales=prefix_scales)
+
+    @property
+    def prefix_matrix(self) -> np.ndarray:
+        return self.prefix.matrix
+
+    @property
+    def prefix_scales(self) -> np.ndarray | None:
+        return self.prefix.scales
+
+    @classmethod
+    def from_index(cls, index: EmbeddingIndex, prefix_dims: int = 256, pool_size: int = 100) -> EmbeddingIndex:
+        """
+        Add prefix embeddings to an exact index.
+        Args:
+            index (EmbeddingIndex): The exact index.
+            prefix_dims (int): The number of leading dimensions scanned in the first stage.
+            pool_size (int): The number of candidates rescored with the full vectors.
+        Returns:
+            EmbeddingIndex: The two-stage index, or the exact index when its vectors are not longer than the prefix.
+        """
+        if len(index) == 0 or index.dimension <= prefix_dims:
+            return index
+        logger.info(f"Built two-stage index over {len(index)} chunks with {prefix_dims} prefix dimensions")
+        return cls(
+            chunks=index.chunks,
+            embeddings=index.matrix,
+            prefix_dims=prefix_dims,
+            pool_size=pool_size,
+            row_ids=index.row_ids,
+            normalized=True,
+            storage=index.storage,
+            scales=index.scales,
+            members=index.members,
+            lexical=index.lexical
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return super().nbytes + self.prefix.nbytes
+
+    def merged(self, chunks_text_and_embedding: list[ChunkAndEmbedding]) -> "TwoStageIndex":
+        """
+        Return a new index with the given rows added, replacing rows with the same database id.
+        """
+        if not chunks_text_and_embedding:
+            return self
+        # The update is built once, in the index's storage type, and its prefixes are taken from it.
+        update = EmbeddingIndex.from_chunks(chunks_text_and_embedding, storage=self.storage)
+        keep = self._rows_kept_after(update)
+        kept_rows = np.flatnonzero(keep)
+        update_prefix = EmbeddingIndex(update.chunks, prefix_embeddings(update, self.prefix_dims), normalized=True, storage=self.storage)
+        return TwoStageIndex(
+            chunks=concat_chunks(take_chunks(self.chunks, kept_rows), update.chunks),
+            embeddings=_stack(self.matrix[keep], update.matrix),
+            prefix_dims=self.prefix_dims,
+            pool_size=self.pool_size,
+            row_ids=np.concatenate([self.row_ids[keep], update.row_ids]),
+            normalized=True,
+            storage=self.storage,
+            scales=_concat_scales(self, keep, update),
+            prefix_matrix=_stack(self.prefix_matrix[keep], update_prefix.matrix),
+            members=concat_members(take_members(self.members, kept_rows), update.members),
+            lexical=concat_lexical(take_lexical(self.lexical, kept_rows), update.chunks),
+            prefix_scales=_concat_scales(self.prefix, keep, update_prefix)
+        )
+
+    def search_batch(self, queries: np.ndarray, k: int = 5, allowed_rows: np.ndarray | None = None) -> list[list[ScoredChunk]]:
+        if len(self) == 0 or k <= 0 or (allowed_rows is not None and len(allowed_rows) == 0):
+            return [[] for _ in range(queries.shape[0])]
+        pool_size = max(self.pool_size, k)
+        if allowed_rows is not None and len(allowed_rows) <= pool_size:
+            return EmbeddingIndex.search_batch(self, queries, k, allowed_rows)
+        prefix_scores = self.prefix.score(normalize_rows(queries[:, :self.prefix_dims]), allowed_rows)
+        results = []
+        for query, query_prefix_scores in zip(queries, prefix_scores):
+            candidates = np.sort(top_k_rows(query_prefix_scores, pool_size))
+            if allowed_rows is not None:
+                candidates = allowed_rows[candidates]
+            scores = self.score(query[None, :], candidates)[0]
+            best = top_k_rows(scores, k)
+            results.append([
+                ScoredChunk(row=int(candidates[position]), chunk=self.chunks[candidates[position]], score=float(scores[position]))
+                for position in best
+            ])
+        return results
+
+
+def prefix_embeddings(index: EmbeddingIndex, prefix_dims: int) -> np.ndarray:
+    """
+    Return the renormalized first `prefix_dims` dimensions of every row of an index.
+    """
+    prefix_matrix = np.empty((len(index), min(prefix_dims, index.dimension)), dtype=np.float32)
+    for start in range(0, len(index), SCORE_BLOCK_SIZE):
+        rows = slice(start, start + SCORE_BLOCK_SIZE)
+        prefix_matrix[rows] = index.embeddings(rows)[:, :prefix_dims]
+    return normalize_rows(prefix_matrix, out=prefix_matrix)
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import (Executor, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from typing import Callable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class WorkerPool:
+    """
+    Executor that CPU-bound work of the question path is dispatched into, off the event loop.
+
+    Threads suit NumPy scoring, which releases the GIL; processes suit pure-Python work
+    such as prompt assembly, and only receive the work's arguments. The executor is
+    created on first use. Queue depth and the time work waits for a worker are counted,
+    so a saturated pool shows up in the stats instead of as a slow bot.
+    """
+    def __init__(self, name: str, max_workers: int, processes: bool = False) -> None:
+        self.name = name
+        self.max_workers = max_workers
+        self.processes = processes
+        self._executor: Executor | None = None
+        self.in_flight = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        """
+        Run `fn(*args)` on a worker and return its result.
+        Args:
+            fn (Callable[..., T]): The function; a module-level one for process pools.
+            *args: Its arguments, picklable for process pools.
+        Returns:
+            T: The function's result.
+        """
+        self.in_flight += 1
+        self.max_queued = max(self.max_queued, self.in_flight - self.max_workers)
+        submitted_at = time.time()
+        try:
+            started_at, result = await asyncio.get_running_loop().run_in_executor(self._get_executor(), _timed_call, fn, args)
+        finally:
+            self.in_flight -= 1
+        finished_at = time.time()
+        # Wall-clock time, since process workers report their start time from another process.
+        wait = max(0.0, started_at - submitted_at)
+        self.completed += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.total_run += finished_at - started_at
+        return result
+
+    async def start(self) -> None:
+        """
+        Start the workers ahead of the first question, which would otherwise wait for process workers to spawn.
+        """
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        await asyncio.gather(*(loop.run_in_executor(executor, time.time) for _ in range(self.max_workers)))
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Stop the workers; the next `run` starts a new executor.
+        Args:
+            wait (bool): Whether to wait for the work already submitted to finish.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+            logger.info(f"Stopped {self.name} pool")
+
+    def stats(self) -> dict:
+        return {
+            "kind": "processes" if self.processes else "threads",
+            "workers": self.max_workers,
+            "in_flight": self.in_flight,
+            "queued": max(0, self.in_flight - self.max_workers),
+            "max_queued": self.max_queued,
+            "completed": self.completed,
+            "avg_wait_ms": round(self.total_wait * 1000 / self.completed, 1) if self.completed else None,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "avg_run_ms": round(self.total_run * 1000 / self.completed, 1) if self.completed else None,
+        }
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.processes:
+                # Forking a process that runs threads can copy held locks, so workers are spawned.
+                self._executor = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+            else:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix=self.name)
+            logger.info(f"Started {self.name} pool with {self.max_workers} {'processes' if self.processes else 'threads'}")
+        return self._executor
+
+
+def _timed_call(fn: Callable[..., T], args: tuple) -> tuple[float, T]:
+    return time.time(), fn(*args)
@@ -0,0 +1,145 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+import agent_utils
+from supportbot.clients.crawl.dataclasses import ChunkAndEmbedding
+from supportbot.clients.openai.prompt_builder import PromptStats
+from supportbot.retrieval.conversation_memory import ChatConversation
+from supportbot.retrieval.corpus_refresher import CorpusRefresher
+from supportbot.retrieval.embedding_index import EmbeddingIndex
+from supportbot.retrieval.ivf_index import IVFIndex
+from supportbot.retrieval.membership_index import MembershipIndex
+from supportbot.retrieval.two_stage_index import TwoStageIndex
+
+DIMENSION = 64
+CHUNKS_PER_CHAT = 200
+# Chat name -> the Telegram user ids of its members.
+CHATS = {"A": [1, 2], "B": [2, 3], "C": [3]}
+INDEX_TYPES = {"exact": EmbeddingIndex, "ivf": IVFIndex, "two_stage": TwoStageIndex}
+
+
+def chat_of(chunk: str) -> str:
+    return chunk.split()[1]
+
+
+def make_rows(rng, chats: dict[str, list[int]], first_row_id: int = 0, per_chat: int = CHUNKS_PER_CHAT) -> list[ChunkAndEmbedding]:
+    rows = []
+    for chat, member_ids in chats.items():
+        for position in range(per_chat):
+            rows.append(ChunkAndEmbedding(
+                chunk=f"chat {chat} chunk {position}",
+                embedding=rng.standard_normal(DIMENSION).tolist(),
+                row_id=first_row_id + len(rows),
+                member_ids=member_ids
+            ))
+    return rows
+
+
+@pytest.fixture
+def answer(monkeypatch):
+    """
+    Ask a question through send_message and return the chat history chunks that reached the prompt.
+    """
+    monkeypatch.setattr(agent_utils, "ANSWER_CACHE_ENABLED", False)
+    monkeypatch.setattr(agent_utils, "ACCESS_FILTER_ENABLED", True)
+    prompt_chunks = []
+
+    def fake_build_prompt(message, previous_messages, documentation, message_chunks, *args):
+        prompt_chunks.append([scored_chunk.chunk for scored_chunks in message_chunks for scored_chunk in scored_chunks])
+        return message, PromptStats(tokens=1, chunks=1, duplicate_chunks=0, chunks_over_budget=0, messages=0, messages_over_budget=0)
+
+    async def fake_complete(prompt, on_partial_answer=None):
+        return "answer"
+
+    monkeypatch.setattr(agent_utils, "build_prompt", fake_build_prompt)
+    monkeypatch.setattr(agent_utils, "complete", fake_complete)
+    crawl_index = EmbeddingIndex(["doc"], np.ones((1, DIMENSION), dtype=np.float32))
+
+    def ask(message_index, user_id, query_embedding):
+        asyncio.run(agent_utils.send_message(
+            "question",
+            crawl_index,
+            message_index,
+            ChatConversation((1, 10), max_turns=5),
+            bot_id=1,
+            chat_id=10,
+            user_id=user_id,
+            query_embeddings=[query_embedding]
+        ))
+        return prompt_chunks.pop()
+
+    return ask
+
+
+def build(monkeypatch, retrieval_index: str, rows: list[ChunkAndEmbedding]) -> EmbeddingIndex:
+    monkeypatch.setattr(agent_utils, "IVF_INDEX_DIR", None)
+    monkeypatch.setattr(agent_utils, "TWO_STAGE_PREFIX_DIMS", 16)
+    index = agent_utils.build_index("message_history_chunks", EmbeddingIndex.from_chunks(rows), retrieval_index=retrieval_index)
+    assert type(index) is INDEX_TYPES[retrieval_index]
+    return index
+
+
+def refresh(index: EmbeddingIndex, rows: list[ChunkAndEmbedding]) -> EmbeddingIndex:
+    live = {"index": index}
+    refresher = CorpusRefresher(
+        "message_history_chunks",
+        get_index=lambda: live["index"],
+        set_index=lambda new_index: live.__setitem__("index", new_index)
+    )
+    refresher._fetch_changed_rows = lambda index: rows
+    asyncio.run(refresher.refresh())
+    return live["index"]
+
+
+@pytest.mark.parametrize("retrieval_index", ["exact", "ivf", "two_stage"])
+def test_questions_never_retrieve_chunks_of_chats_the_asker_is_not_in(monkeypatch, answer, retrieval_index):
+    rng = np.random.default_rng(0)
+    rows = make_rows(rng, CHATS)
+    index = build(monkeypatch, retrieval_index, rows)
+    for user_id in [1, 2, 3, 4]:
+        visible_chats = {chat for chat, member_ids in CHATS.items() if user_id in member_ids}
+        # Aim every question straight at a chunk of each chat, visible or not.
+        for row in rng.choice(len(rows), size=30, replace=False):
+            retrieved = answer(index, user_id, np.asarray(rows[row].embedding, dtype=np.float32))
+            assert {chat_of(chunk) for chunk in retrieved} <= visible_chats
+            assert bool(retrieved) == bool(visible_chats)
+            if chat_of(rows[row].chunk) in visible_chats:
+                assert retrieved[0] == rows[row].chunk
+
+
+@pytest.mark.parametrize("retrieval_index", ["exact", "ivf", "two_stage"])
+def test_a_refreshed_chunk_is_only_retrieved_by_its_chat_members(monkeypatch, answer, retrieval_index):
+    rng = np.random.default_rng(1)
+    rows = make_rows(rng, CHATS)
+    index = build(monkeypatch, retrieval_index, rows)
+    new_rows = make_rows(rng, {"D": [1, 4]}, first_row_id=len(rows), per_chat=1)
+    merged = refresh(index, new_rows)
+    assert type(merged) is type(index)
+    new_chunk_embedding = np.asarray(new_rows[0].embedding, dtype=np.float32)
+
+    assert answer(merged, 1, new_chunk_embedding)[0] == "chat D chunk 0"
+    assert answer(merged, 4, new_chunk_embedding) == ["chat D chunk 0"]
+    for user_id in [2, 3]:
+        assert "chat D chunk 0" not in answer(merged, user_id, new_chunk_embedding)
+
+    # The merged posting lists match the ones built from scratch over the merged rows.
+    all_rows = {row.row_id: row for row in rows + new_rows}
+    expected = MembershipIndex.from_members([all_rows[int(row_id)].member_ids for row_id in merged.row_ids])
+    assert merged.members.postings.keys() == expected.postings.keys()
+    for member_id, member_rows in expected.postings.items():
+        np.testing.assert_array_equal(merged.members.rows_for(member_id), member_rows)
+
+
+@pytest.mark.parametrize("retrieval_index", ["exact", "two_stage"])
+def test_a_refresh_only_touches_the_posting_lists_of_the_new_members(monkeypatch, retrieval_index):
+    # Rows of exact and two-stage indexes keep their positions, so the lists of users the new chunk
+    # is not visible to are reused as they are; IVF merges regroup rows by cluster instead.
+    rng = np.random.default_rng(2)
+    index = build(monkeypatch, retrieval_index, make_rows(rng, CHATS))
+    merged = refresh(index, make_rows(rng, {"D": [1, 4]}, first_row_id=len(index), per_chat=1))
+    for member_id in [2, 3]:
+        assert merged.members.rows_for(member_id) is index.members.rows_for(member_id)
+    np.testing.assert_array_equal(merged.members.rows_for(1), np.append(index.members.rows_for(1), len(index)))
+    np.testing.assert_array_equal(merged.members.rows_for(4), [len(index)])
@@ -0,0 +1,139 @@
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import agent_utils
+from supportbot.clients.messages.dataclasses import Message
+from supportbot.clients.openai import answer_cache as answer_cache_module
+from supportbot.clients.openai.answer_cache import AnswerCache
+from supportbot.clients.openai.prompt_builder import PromptStats
+from supportbot.retrieval.conversation_memory import ChatConversation
+from supportbot.retrieval.embedding_index import EmbeddingIndex
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(answer_cache_module, "time", SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def unit(*values):
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_near_duplicate_questions_hit_above_the_threshold(clock):
+    cache = AnswerCache(threshold=0.95)
+    cache.put(("bot", "chat"), unit(1, 0), "context", "answer")
+    assert cache.get(("bot", "chat"), unit(1, 0.2), "context") == "answer"  # cosine 0.98
+    assert cache.get(("bot", "chat"), unit(1, 0.5), "context") is None  # cosine 0.89
+    # The same question answered from another context is a miss.
+    assert cache.get(("bot", "chat"), unit(1, 0), "other context") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = AnswerCache(ttl=60)
+    cache.put("scope", unit(1, 0), "context", "answer")
+    clock.now += 59
+    assert cache.get("scope", unit(1, 0), "context") == "answer"
+    clock.now += 2
+    assert cache.get("scope", unit(1, 0), "context") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_the_least_recently_used_answers_are_evicted(clock):
+    cache = AnswerCache(max_entries=2)
+    cache.put("a", unit(1, 0), "context", "answer a")
+    cache.put("b", unit(1, 0), "context", "answer b")
+    assert cache.get("a", unit(1, 0), "context") == "answer a"
+    cache.put("c", unit(1, 0), "context", "answer c")
+    assert cache.get("b", unit(1, 0), "context") is None
+    assert cache.get("a", unit(1, 0), "context") == "answer a"
+    assert cache.get("c", unit(1, 0), "context") == "answer c"
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["entries"] == 2
+
+
+def test_answers_are_not_shared_across_bots_or_chats(clock):
+    cache = AnswerCache()
+    cache.put((1, 10), unit(1, 0), "context", "bot 1 chat 10")
+    assert cache.get((1, 10), unit(1, 0), "context") == "bot 1 chat 10"
+    assert cache.get((1, 11), unit(1, 0), "context") is None
+    assert cache.get((2, 10), unit(1, 0), "context") is None
+
+
+def test_invalidate_drops_every_chat_of_one_bot(clock):
+    cache = AnswerCache()
+    cache.put((1, 10), unit(1, 0), "context", "bot 1 chat 10")
+    cache.put((1, 11), unit(1, 0), "context", "bot 1 chat 11")
+    cache.put((2, 10), unit(1, 0), "context", "bot 2 chat 10")
+    cache.invalidate(bot_id=1)
+    assert cache.get((1, 10), unit(1, 0), "context") is None
+    assert cache.get((1, 11), unit(1, 0), "context") is None
+    assert cache.get((2, 10), unit(1, 0), "context") == "bot 2 chat 10"
+    cache.invalidate()
+    assert cache.stats()["entries"] == 0
+
+
+def make_message(text: str, username: str) -> Message:
+    return Message(message=text, chat_id="10", chat_name="Group", username=username, update_id=text)
+
+
+def test_members_of_a_busy_group_share_cached_answers(monkeypatch):
+    # Two members with their own message history ask the same question while the group keeps talking.
+    monkeypatch.setattr(agent_utils, "ANSWER_CACHE_ENABLED", True)
+    monkeypatch.setattr(agent_utils, "_answer_cache", AnswerCache())
+    prompt_inputs = []
+    completions = []
+
+    def fake_build_prompt(message, previous_messages, documentation, message_chunks, chat_message_history, user_message_history, *args):
+        prompt_inputs.append((chat_message_history, user_message_history))
+        return f"prompt for {message}", PromptStats(tokens=1, chunks=1, duplicate_chunks=0, chunks_over_budget=0, messages=0, messages_over_budget=0)
+
+    async def fake_complete(prompt, on_partial_answer=None):
+        completions.append(prompt)
+        return "restart the webhook"
+
+    monkeypatch.setattr(agent_utils, "build_prompt", fake_build_prompt)
+    monkeypatch.setattr(agent_utils, "complete", fake_complete)
+    rng = np.random.default_rng(0)
+    crawl_index = EmbeddingIndex([f"doc {row}" for row in range(20)], rng.standard_normal((20, 8)).astype(np.float32))
+    message_index = EmbeddingIndex([], np.empty((0, 8), dtype=np.float32))
+    question_embedding = crawl_index.embeddings([3])[0]
+
+    async def ask(username, chat_messages):
+        return await agent_utils.send_message(
+            "how do I fix the webhook?",
+            crawl_index,
+            message_index,
+            ChatConversation((1, 10), max_turns=5),
+            chat_message_history=chat_messages,
+            user_message_history=[make_message(f"{username} said something", username)],
+            bot_id=1,
+            chat_id=10,
+            user_id=hash(username),
+            query_embeddings=[question_embedding]
+        )
+
+    async def run():
+        first = await ask("alice", [make_message("hello", "carol")])
+        second = await ask("bob", [make_message("new group message", "dave"), make_message("hello", "carol")])
+        return first, second
+
+    assert asyncio.run(run()) == ("restart the webhook", "restart the webhook")
+    assert len(completions) == 1
+    # The cached prompt carried no per-user or raw chat message context.
+    assert prompt_inputs == [(None, None)]
@@ -0,0 +1,62 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from supportbot.handlers import message_handlers
+from supportbot.handlers.streaming import PLACEHOLDER_TEXT
+
+
+class FakeReply:
+    def __init__(self, text: str) -> None:
+        self.texts = [text]
+
+    async def edit_text(self, text: str, parse_mode: str | None = None) -> "FakeReply":
+        self.texts.append(text)
+        return self
+
+
+class FakeMessage:
+    def __init__(self) -> None:
+        self.replies: list[FakeReply] = []
+
+    async def reply_text(self, text: str, parse_mode: str | None = None) -> FakeReply:
+        # A slow placeholder, so the failing input below finishes first.
+        await asyncio.sleep(0.05)
+        reply = FakeReply(text)
+        self.replies.append(reply)
+        return reply
+
+
+class FailingConversationMemory:
+    def __init__(self, error: Exception) -> None:
+        self.error = error
+
+    async def get(self, bot_id, chat_id):
+        raise self.error
+
+
+async def no_messages(*args, **kwargs):
+    return []
+
+
+@pytest.fixture
+def update(monkeypatch):
+    monkeypatch.setattr(message_handlers, "STREAM_ANSWERS", True)
+    monkeypatch.setattr(message_handlers.recent_messages, "get_chat_history", no_messages)
+    monkeypatch.setattr(message_handlers.recent_messages, "get_user_messsage_history", no_messages)
+    return SimpleNamespace(
+        message=FakeMessage(),
+        effective_chat=SimpleNamespace(id=1),
+        effective_sender=SimpleNamespace(username="user"),
+        effective_user=SimpleNamespace(id=2),
+    )
+
+
+@pytest.mark.parametrize("error", [RuntimeError("database is down"), KeyError("conversation"), ValueError("no embedding")])
+def test_a_failure_after_the_placeholder_replaces_it_with_the_error(update, error):
+    context = SimpleNamespace(bot_data={"conversation_memory": FailingConversationMemory(error)})
+    asyncio.run(message_handlers.answer_question(update, context, None, "how do I reset?", edit_interval=0))
+
+    [reply] = update.message.replies
+    assert reply.texts == [PLACEHOLDER_TEXT, message_handlers.QUESTION_ERROR_MESSAGE]
@@ -0,0 +1,94 @@
+import numpy as np
+
+from supportbot.retrieval.conversation_context import (ConversationTurn,
+                                                       context_embedding,
+                                                       pending_turns)
+from supportbot.retrieval.embedding_index import EmbeddingIndex
+
+DIMENSION = 256
+PAGES = 40
+CHUNKS_PER_PAGE = 10
+K = 5
+
+
+class BagOfWordsEmbedder:
+    """
+    Deterministic stand-in for the embeddings API: a text is the normalized sum of its word vectors,
+    so the embedding of a joined history weighs every turn by its length, like one long input.
+    """
+    def __init__(self, seed: int) -> None:
+        self.rng = np.random.default_rng(seed)
+        self.vectors: dict[str, np.ndarray] = {}
+
+    def __call__(self, text: str) -> np.ndarray:
+        vector = sum(self._vector(word) for word in text.split())
+        return (vector / np.linalg.norm(vector)).astype(np.float32)
+
+    def _vector(self, word: str) -> np.ndarray:
+        if word not in self.vectors:
+            self.vectors[word] = self.rng.standard_normal(DIMENSION)
+        return self.vectors[word]
+
+
+def make_pages(rng) -> list[str]:
+    # Consecutive chunks come from the same page and share its topic words, as in the crawl corpus.
+    chunks = []
+    for page in range(PAGES):
+        vocabulary = [f"page{page}word{position}" for position in range(30)]
+        for _ in range(CHUNKS_PER_PAGE):
+            words = list(rng.choice(vocabulary, size=12)) + list(rng.choice(["the", "a", "to", "bot", "setup"], size=4))
+            chunks.append(" ".join(words))
+    return chunks
+
+
+def test_a_single_turn_is_its_own_context():
+    embedding = np.array([3.0, 4.0], dtype=np.float32)
+    np.testing.assert_allclose(context_embedding([ConversationTurn("q", "a", embedding)]), [0.6, 0.8])
+    assert context_embedding([ConversationTurn("q", "a")]) is None
+
+
+def test_older_turns_weigh_less_by_the_decay():
+    older = ConversationTurn("q1", "a1", np.array([1.0, 0.0], dtype=np.float32))
+    newer = ConversationTurn("q2", "a2", np.array([0.0, 2.0], dtype=np.float32))
+    unembedded = ConversationTurn("q3", "a3")
+    assert pending_turns([older, unembedded, newer]) == [unembedded]
+    expected = np.array([0.5, 1.0]) / np.linalg.norm([0.5, 1.0])
+    np.testing.assert_allclose(context_embedding([older, unembedded, newer], decay=0.5), expected, rtol=1e-6)
+
+
+def test_rolling_context_follows_the_topic_the_conversation_moved_to():
+    # Each conversation reads the last 3 chunks of one page, then the first 2 of the next page;
+    # the follow-up question is about the new page, as in agent_code.compare_conversation_context.
+    rng = np.random.default_rng(0)
+    embed = BagOfWordsEmbedder(seed=1)
+    chunks = make_pages(rng)
+    index = EmbeddingIndex(chunks, np.stack([embed(chunk) for chunk in chunks]))
+    all_rows = np.arange(len(chunks))
+
+    def search(vector, turn_rows):
+        allowed_rows = np.setdiff1d(all_rows, turn_rows)
+        return [scored_chunk.row for scored_chunk in index.search(vector, k=K, allowed_rows=allowed_rows)]
+
+    results = {"joined": [], 0.5: [], 1.0: []}
+    for page in range(PAGES - 1):
+        next_page = page + 1
+        turn_rows = np.r_[page * CHUNKS_PER_PAGE + 7:(page + 1) * CHUNKS_PER_PAGE, next_page * CHUNKS_PER_PAGE:next_page * CHUNKS_PER_PAGE + 2]
+        results["joined"].append(search(embed(" ".join(chunks[row] for row in turn_rows)), turn_rows))
+        for decay in (0.5, 1.0):
+            turns = [ConversationTurn(chunks[row], "", index.embeddings([row])[0]) for row in turn_rows]
+            results[decay].append(search(context_embedding(turns, decay=decay), turn_rows))
+
+    def on_next_page(rows_per_conversation):
+        # The share of the top k results taken from the page the conversation moved to.
+        return np.mean([
+            np.mean([row // CHUNKS_PER_PAGE == page + 1 for row in rows])
+            for page, rows in enumerate(rows_per_conversation)
+        ])
+
+    def overlap(rows_per_conversation):
+        return np.mean([len(set(rows) & set(joined)) / K for rows, joined in zip(rows_per_conversation, results["joined"])])
+
+    # An even average matches the joined history; a decaying one leans towards the newest turns.
+    assert overlap(results[1.0]) >= 0.8
+    assert on_next_page(results[0.5]) > on_next_page(results["joined"]) + 0.2
+    assert on_next_page(results[0.5]) >= 0.7
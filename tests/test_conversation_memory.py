@@ -0,0 +1,194 @@
+import asyncio
+import itertools
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from supportbot.clients.conversations import conversation_client
+from supportbot.clients.conversations.conversation_client import \
+    ConversationClient
+from supportbot.retrieval import conversation_memory
+from supportbot.retrieval.conversation_context import ConversationTurn
+from supportbot.retrieval.conversation_memory import ConversationMemory
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(conversation_memory, "time", SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+class FakeTurnsQuery:
+    """
+    The subset of the PostgREST query builder ConversationClient uses, over an in-memory table.
+    """
+    def __init__(self, table: "FakeTurnsTable") -> None:
+        self.table = table
+        self.filters = []
+        self.row = None
+        self.ordering = None
+        self.row_limit = None
+
+    def insert(self, row):
+        self.row = row
+        return self
+
+    def select(self, columns):
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row[column] == value)
+        return self
+
+    def is_(self, column, value):
+        self.filters.append(lambda row: row[column] is None)
+        return self
+
+    def order(self, column, desc=False):
+        self.ordering = (column, desc)
+        return self
+
+    def limit(self, row_limit):
+        self.row_limit = row_limit
+        return self
+
+    async def execute(self):
+        if self.row is not None:
+            self.table.rows.append({**self.row, "created_at": next(self.table.clock)})
+            return SimpleNamespace(json=lambda: json.dumps({"data": []}))
+        rows = [row for row in self.table.rows if all(matches(row) for matches in self.filters)]
+        if self.ordering is not None:
+            column, desc = self.ordering
+            rows.sort(key=lambda row: row[column], reverse=desc)
+        data = [{"question": row["question"], "answer": row["answer"]} for row in rows[:self.row_limit]]
+        self.table.reads += 1
+        return SimpleNamespace(json=lambda: json.dumps({"data": data}))
+
+
+class FakeTurnsTable:
+    def __init__(self) -> None:
+        self.rows: list[dict] = []
+        self.reads = 0
+        self.clock = itertools.count()
+
+    def table(self, table_name: str) -> FakeTurnsQuery:
+        assert table_name == "conversation_turns"
+        return FakeTurnsQuery(self)
+
+
+class FakeConnection:
+    def __init__(self, table: FakeTurnsTable) -> None:
+        self.turns_table = table
+
+    async def execute(self, build_query):
+        return await build_query(self.turns_table).execute()
+
+
+@pytest.fixture
+def turns_table(monkeypatch):
+    table = FakeTurnsTable()
+    monkeypatch.setattr(conversation_client, "supabase_connection", FakeConnection(table))
+    return table
+
+
+def turn(number: int, length: int = 10) -> ConversationTurn:
+    return ConversationTurn(question=f"question {number}".ljust(length), answer=f"answer {number}".ljust(length))
+
+
+def questions(conversation) -> list[str]:
+    return [turn.question.strip() for turn in conversation.turns]
+
+
+def test_a_chat_keeps_its_last_turns_in_a_ring_buffer(clock):
+    memory = ConversationMemory(max_turns=3)
+
+    async def run():
+        conversation = await memory.get(1, 10)
+        for number in range(5):
+            conversation.append(turn(number))
+        return conversation
+
+    conversation = asyncio.run(run())
+    assert len(conversation) == 3
+    assert questions(conversation) == ["question 2", "question 3", "question 4"]
+    assert [recent.question.strip() for recent in conversation.recent(2)] == ["question 3", "question 4"]
+    assert conversation.recent(0) == []
+    # Only the turns still in the buffer are counted.
+    assert memory._total_bytes == conversation._measure() == 3 * 2 * 10
+
+
+def test_idle_chats_expire_after_the_ttl(clock):
+    memory = ConversationMemory(idle_ttl=60)
+
+    async def run():
+        first = await memory.get(1, 10)
+        first.append(turn(1))
+        clock.now += 30
+        second = await memory.get(1, 11)
+        second.append(turn(2))
+        clock.now += 31
+        # The first chat has been idle for 61 seconds, the second for 31.
+        assert await memory.get(1, 11) is second
+        assert (1, 10) not in memory._chats
+        return await memory.get(1, 10)
+
+    conversation = asyncio.run(run())
+    assert len(conversation) == 0
+    stats = memory.stats()
+    assert stats["expirations"] == 1
+    assert stats["chats"] == 2
+    assert memory._total_bytes == 2 * 10
+
+
+def test_the_least_recently_used_chats_are_evicted_by_size(clock):
+    # Each chat holds one turn of 200 bytes; the memory has room for two.
+    memory = ConversationMemory(max_bytes=500)
+
+    async def run():
+        for chat_id in [10, 11]:
+            (await memory.get(1, chat_id)).append(turn(chat_id, length=100))
+        # Chat 10 is used again, so chat 11 makes room for chat 12.
+        await memory.get(1, 10)
+        (await memory.get(1, 12)).append(turn(12, length=100))
+
+    asyncio.run(run())
+    assert list(memory._chats) == [(1, 10), (1, 12)]
+    assert memory.stats()["evictions"] == 1
+    assert memory._total_bytes == 400
+
+
+def test_a_chat_missing_from_memory_is_read_back_from_the_database(clock, turns_table):
+    async def run():
+        memory = ConversationMemory(max_turns=3, client=ConversationClient())
+        conversation = await memory.get(1, 10)
+        for number in range(5):
+            conversation.append(turn(number))
+        (await memory.get(2, 10)).append(turn(100))
+        (await memory.get(None, 10)).append(turn(200))
+        await asyncio.gather(*memory._pending_writes)
+        assert memory.stats()["write_errors"] == 0
+
+        # After a restart, the chat comes back with its last turns, oldest first.
+        restarted = ConversationMemory(max_turns=3, client=ConversationClient())
+        conversation = await restarted.get(1, 10)
+        assert questions(conversation) == ["question 2", "question 3", "question 4"]
+        assert questions(await restarted.get(None, 10)) == ["question 200"]
+        # A chat already in memory is not read again.
+        reads = turns_table.reads
+        assert await restarted.get(1, 10) is conversation
+        assert turns_table.reads == reads
+        return restarted
+
+    restarted = asyncio.run(run())
+    assert restarted.stats()["backfills"] == 2
+    assert len(turns_table.rows) == 7
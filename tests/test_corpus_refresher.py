@@ -0,0 +1,173 @@
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+
+from supportbot.clients.crawl.dataclasses import ChunkAndEmbedding
+from supportbot.clients.openai.answer_cache import AnswerCache
+from supportbot.retrieval.corpus_refresher import CorpusRefresher
+from supportbot.retrieval.embedding_index import EmbeddingIndex
+
+
+def make_rows(rng, row_ids):
+    return [
+        ChunkAndEmbedding(chunk=f"chunk {row_id}", embedding=rng.standard_normal(8).tolist(), row_id=row_id, member_ids=[1])
+        for row_id in row_ids
+    ]
+
+
+def refresh_with(index, rows, bot_id):
+    live = {"index": index}
+    calls = []
+    refresher = CorpusRefresher(
+        "message_history_chunks",
+        get_index=lambda: live["index"],
+        set_index=lambda new_index: live.__setitem__("index", new_index),
+        on_refresh=lambda bot_id: calls.append(bot_id),
+        bot_id=bot_id
+    )
+    refresher._fetch_changed_rows = lambda index: rows
+    merged = asyncio.run(refresher.refresh())
+    return merged, live["index"], calls
+
+
+def test_refresh_reports_only_merges_that_change_content():
+    rng = np.random.default_rng(0)
+    rows = make_rows(rng, range(10))
+    index = EmbeddingIndex.from_chunks(rows)
+
+    # A new chat member moves updated_at, but the chunk and its embedding are unchanged.
+    member_change = [ChunkAndEmbedding(rows[3].chunk, rows[3].embedding, row_id=3, member_ids=[1, 2])]
+    merged, live_index, calls = refresh_with(index, member_change, bot_id=7)
+    assert merged == 1 and calls == []
+    np.testing.assert_array_equal(live_index.visible_rows(2), [len(live_index) - 1])
+
+    edited = [ChunkAndEmbedding("edited chunk", rows[3].embedding, row_id=3, member_ids=[1])]
+    assert refresh_with(index, edited, bot_id=7)[2] == [7]
+    reembedded = [ChunkAndEmbedding(rows[3].chunk, rng.standard_normal(8).tolist(), row_id=3, member_ids=[1])]
+    assert refresh_with(index, reembedded, bot_id=7)[2] == [7]
+    assert refresh_with(index, make_rows(rng, [10]), bot_id=None)[2] == [None]
+    assert refresh_with(index, [], bot_id=7)[2] == []
+
+
+def test_invalidating_a_bot_keeps_the_other_bots_answers():
+    cache = AnswerCache()
+    embedding = [1.0, 0.0]
+    for scope in [(1, 100), (1, 101), (2, 100)]:
+        cache.put(scope, embedding, "context", f"answer {scope}")
+    cache.invalidate(bot_id=1)
+    assert cache.get((1, 100), embedding, "context") is None
+    assert cache.get((1, 101), embedding, "context") is None
+    assert cache.get((2, 100), embedding, "context") == "answer (2, 100)"
+    cache.invalidate()
+    assert cache.get((2, 100), embedding, "context") is None
+
+
+class FakeQuery:
+    """
+    The subset of the PostgREST query builder CorpusRefresher uses, over an in-memory table.
+    """
+    def __init__(self, table: "FakeChunkTable") -> None:
+        self.table = table
+        self.filters = []
+        self.negate = False
+        self.ordering = None
+        self.row_limit = None
+        self.pages_ids = False
+
+    def select(self, columns, count=None):
+        return self
+
+    @property
+    def not_(self):
+        self.negate = True
+        return self
+
+    def _filter(self, predicate):
+        negate, self.negate = self.negate, False
+        self.filters.append((lambda row: not predicate(row)) if negate else predicate)
+        return self
+
+    def gt(self, column, value):
+        self.pages_ids = column == "id"
+        return self._filter(lambda row: row[column] > value)
+
+    def is_(self, column, value):
+        return self._filter(lambda row: row[column] is None)
+
+    def in_(self, column, values):
+        return self._filter(lambda row: row[column] in set(values))
+
+    def order(self, column, desc=False):
+        self.ordering = (column, desc)
+        return self
+
+    def limit(self, row_limit):
+        self.row_limit = row_limit
+        return self
+
+    def execute(self):
+        rows = [row for row in self.table.rows.values() if all(predicate(row) for predicate in self.filters)]
+        if self.ordering:
+            rows.sort(key=lambda row: row[self.ordering[0]], reverse=self.ordering[1])
+        rows = rows[:self.row_limit]
+        if self.pages_ids:
+            self.table.paged_ids += len(rows)
+        return SimpleNamespace(data=[dict(row) for row in rows])
+
+
+class FakeChunkTable:
+    def __init__(self) -> None:
+        self.rows: dict[int, dict] = {}
+        self.paged_ids = 0
+        self.rng = np.random.default_rng(0)
+
+    def insert(self, row_id: int, embedded: bool = True) -> None:
+        self.rows[row_id] = {"id": row_id, "chunk": f"chunk {row_id}", "chunk_embedding": None}
+        if embedded:
+            self.embed(row_id)
+
+    def embed(self, row_id: int) -> None:
+        self.rows[row_id]["chunk_embedding"] = self.rng.standard_normal(8).tolist()
+
+    def table(self, table_name: str) -> FakeQuery:
+        return FakeQuery(self)
+
+
+def test_a_row_that_never_gets_an_embedding_does_not_pin_the_watermark():
+    table = FakeChunkTable()
+    for row_id in range(1, 201):
+        # Row 50 failed to embed and stays without an embedding; row 120 is embedded late.
+        table.insert(row_id, embedded=row_id not in (50, 120))
+    loaded = [row for row in table.rows.values() if row["chunk_embedding"] is not None]
+    live = {"index": EmbeddingIndex.from_chunks([
+        ChunkAndEmbedding(row["chunk"], row["chunk_embedding"], row_id=row["id"]) for row in loaded
+    ])}
+    refresher = CorpusRefresher(
+        "crawled_url_chunks",
+        get_index=lambda: live["index"],
+        set_index=lambda new_index: live.__setitem__("index", new_index)
+    )
+    refresher.supabase_client = table
+    refresher.unembedded_ids = refresher._fetch_unembedded_ids()
+    assert sorted(refresher.unembedded_ids) == [50, 120]
+
+    def refresh():
+        table.paged_ids = 0
+        return asyncio.run(refresher.refresh())
+
+    assert refresh() == 0
+    # Only ids above the newest indexed row are paged, not every id above row 50.
+    assert table.paged_ids == 0
+    for row_id in range(201, 206):
+        table.insert(row_id)
+    assert refresh() == 5
+    assert table.paged_ids == 5
+
+    table.embed(120)
+    assert refresh() == 1
+    assert table.paged_ids == 0
+    assert 120 in live["index"].row_ids
+    assert refresher.unembedded_ids == [50]
+    assert refresher.stats()["unembedded_ids"] == 1
+    assert len(live["index"]) == 204
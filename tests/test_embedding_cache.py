@@ -0,0 +1,47 @@
+import asyncio
+
+import numpy as np
+
+from supportbot.clients.openai.embedding_cache import EmbeddingCache
+
+
+def test_get_returns_the_stored_array(tmp_path):
+    cache = EmbeddingCache(path=str(tmp_path / "cache.sqlite"), flush_interval=60)
+    stored = cache.put("question", "model", [1.0, 2.0, 3.0])
+    cached = cache.get("question", "model")
+    assert isinstance(cached, np.ndarray)
+    assert cached is stored
+    assert cache.get("question", "other model") is None
+
+
+def test_writes_are_committed_in_one_batch(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = EmbeddingCache(path=path, flush_interval=60)
+    for position in range(50):
+        cache.put(f"text {position}", "model", [float(position), 1.0])
+    assert cache.stats()["pending_writes"] == 50
+    cache.flush()
+    assert cache.stats()["disk_commits"] == 1
+    assert cache.stats()["disk_writes"] == 50
+
+    reopened = EmbeddingCache(path=path, flush_interval=60)
+    np.testing.assert_array_equal(reopened.get("text 7", "model"), np.array([7.0, 1.0], dtype=np.float32))
+
+
+def test_aget_many_reads_the_disk_tier_and_queued_writes(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = EmbeddingCache(path=path, flush_interval=60)
+    cache.put("written", "model", [1.0, 0.0])
+    cache.flush()
+    # An entry evicted from memory before its batch is written is read from the queue.
+    small = EmbeddingCache(max_entries=1, path=path, flush_interval=60)
+    small.put("queued", "model", [0.0, 1.0])
+    small.put("newest", "model", [1.0, 1.0])
+
+    embeddings = asyncio.run(small.aget_many(["written", "queued", "newest", "unknown"], "model"))
+    np.testing.assert_array_equal(embeddings[0], [1.0, 0.0])
+    np.testing.assert_array_equal(embeddings[1], [0.0, 1.0])
+    np.testing.assert_array_equal(embeddings[2], [1.0, 1.0])
+    assert embeddings[3] is None
+    assert small.stats()["disk_hits"] == 2
+    assert small.stats()["misses"] == 1
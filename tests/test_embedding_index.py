@@ -0,0 +1,154 @@
+import numpy as np
+import pytest
+
+from supportbot.retrieval.embedding_index import (TIE_TOLERANCE,
+                                                  EmbeddingIndex, search_many,
+                                                  top_k_rows)
+from supportbot.retrieval.two_stage_index import TwoStageIndex
+
+distance = pytest.importorskip("scipy.spatial.distance")
+
+
+def scipy_top_k(query, embeddings, k):
+    # The retrieval before EmbeddingIndex: one scipy cosine per chunk and a stable full sort.
+    similarities = [(row, 1 - distance.cosine(query, embedding)) for row, embedding in enumerate(embeddings)]
+    similarities.sort(key=lambda item: item[1], reverse=True)
+    # Scaled copies of a row only differ by float rounding, which ordered them arbitrarily;
+    # like the index, rank scores within TIE_TOLERANCE of the previous one by row.
+    group, groups = 0, []
+    for position, (_, similarity) in enumerate(similarities):
+        if position and similarities[position - 1][1] - similarity > TIE_TOLERANCE:
+            group += 1
+        groups.append(group)
+    ranked = sorted(zip(groups, similarities), key=lambda item: (item[0], item[1][0]))
+    return [similarity for _, similarity in ranked[:k]]
+
+
+def random_corpus(rng, rows=400, dimension=64):
+    embeddings = rng.standard_normal((rows, dimension)).astype(np.float32)
+    # Exact and scaled copies of a few rows, which tie with their originals.
+    embeddings[10] = embeddings[0]
+    embeddings[20] = embeddings[0] * 3
+    embeddings[30] = embeddings[5] * 0.25
+    return embeddings
+
+
+def test_search_matches_scipy_loop():
+    rng = np.random.default_rng(0)
+    embeddings = random_corpus(rng)
+    index = EmbeddingIndex([f"chunk {row}" for row in range(len(embeddings))], embeddings)
+    queries = np.concatenate([rng.standard_normal((200, embeddings.shape[1])), embeddings[[0, 5, 20]]])
+    for query in queries:
+        expected = scipy_top_k(query, embeddings, 5)
+        results = index.search(query, k=5)
+        assert [result.chunk for result in results] == [f"chunk {row}" for row, _ in expected]
+        np.testing.assert_allclose([result.score for result in results], [score for _, score in expected], atol=1e-5)
+
+
+def test_scaled_duplicates_rank_by_row():
+    rng = np.random.default_rng(1)
+    embeddings = random_corpus(rng)
+    index = EmbeddingIndex([f"chunk {row}" for row in range(len(embeddings))], embeddings)
+    results = index.search(embeddings[0] * 7, k=3)
+    assert [result.row for result in results] == [0, 10, 20]
+
+
+def test_top_k_rows_breaks_near_ties_by_row():
+    scores = np.array([0.5, 0.9, 0.9 + 1e-8, 0.2, 0.9 - 1e-8, 0.8], dtype=np.float64)
+    assert top_k_rows(scores, 3).tolist() == [1, 2, 4]
+    assert top_k_rows(scores, 4).tolist() == [1, 2, 4, 5]
+    assert top_k_rows(scores, 10).tolist() == [1, 2, 4, 5, 0, 3]
+    assert top_k_rows(scores[:0], 3).tolist() == []
+
+
+def test_allowed_rows_only_returns_those_rows():
+    rng = np.random.default_rng(2)
+    embeddings = random_corpus(rng)
+    index = EmbeddingIndex([f"chunk {row}" for row in range(len(embeddings))], embeddings)
+    allowed_rows = np.arange(1, len(embeddings), 2)
+    results = index.search(embeddings[0], k=5, allowed_rows=allowed_rows)
+    expected = scipy_top_k(embeddings[0], embeddings[allowed_rows], 5)
+    assert [result.row for result in results] == [int(allowed_rows[row]) for row, _ in expected]
+
+
+def clustered_corpus(rng, rows=4000, dimension=256, clusters=40):
+    # Embeddings of real chunks bunch around topics, so neighbours are close and quantization
+    # error is what decides between them.
+    centers = rng.standard_normal((clusters, dimension)).astype(np.float32)
+    embeddings = centers[rng.integers(clusters, size=rows)] + 0.6 * rng.standard_normal((rows, dimension)).astype(np.float32)
+    queries = embeddings[rng.choice(rows, size=200, replace=False)] + 0.3 * rng.standard_normal((200, dimension)).astype(np.float32)
+    return embeddings, queries
+
+
+def recall_at_k(index, reference, queries, k):
+    found = [{result.row for result in index.search(query, k=k)} for query in queries]
+    expected = [{result.row for result in reference.search(query, k=k)} for query in queries]
+    return np.mean([len(rows & expected_rows) / k for rows, expected_rows in zip(found, expected)])
+
+
+@pytest.mark.parametrize("storage, tolerance", [("float16", 0.01), ("int8", 0.05)])
+@pytest.mark.parametrize("index_type", ["exact", "two_stage"])
+def test_quantized_recall_stays_close_to_float32(storage, tolerance, index_type):
+    rng = np.random.default_rng(3)
+    embeddings, queries = clustered_corpus(rng)
+    chunks = [f"chunk {row}" for row in range(len(embeddings))]
+    reference = EmbeddingIndex(chunks, embeddings)
+    index = EmbeddingIndex(chunks, embeddings, storage=storage)
+    float32_index = reference
+    if index_type == "two_stage":
+        index = TwoStageIndex.from_index(index, prefix_dims=64, pool_size=100)
+        float32_index = TwoStageIndex.from_index(reference, prefix_dims=64, pool_size=100)
+        # The prefixes are kept in the index's storage type too.
+        assert index.prefix_matrix.dtype == index.matrix.dtype
+        assert index.nbytes <= float32_index.nbytes / (2 if storage == "float16" else 3)
+    for k in [5, 10]:
+        assert recall_at_k(index, reference, queries, k) >= recall_at_k(float32_index, reference, queries, k) - tolerance
+
+
+def test_search_many_fuses_the_question_and_history_in_one_pass(monkeypatch):
+    rng = np.random.default_rng(4)
+    corpora = [
+        EmbeddingIndex([f"{name} {row}" for row in range(200)], rng.standard_normal((200, 64)).astype(np.float32))
+        for name in ["doc", "message"]
+    ]
+    # Both queries lean towards rows 0 and 1 of every corpus, the history more towards row 1.
+    first_rows = [index.embeddings([0, 1]) for index in corpora]
+    question = sum(rows[0] + 0.5 * rows[1] for rows in first_rows)
+    history = sum(0.5 * rows[0] + rows[1] for rows in first_rows)
+
+    batches = []
+    search_batch = EmbeddingIndex.search_batch
+
+    def counting_search_batch(index, queries, *args, **kwargs):
+        batches.append(queries.shape[0])
+        return search_batch(index, queries, *args, **kwargs)
+
+    monkeypatch.setattr(EmbeddingIndex, "search_batch", counting_search_batch)
+    results = search_many([question, history], corpora, k=5)
+    # Each corpus is scanned once, for both queries together.
+    assert batches == [2, 2]
+    monkeypatch.undo()
+
+    for corpus_position, index in enumerate(corpora):
+        question_results = index.search(question, k=5)
+        history_results = index.search(history, k=5)
+        question_rows = {result.row for result in question_results}
+        assert {0, 1} <= question_rows & {result.row for result in history_results}
+        best_scores = {result.row: result.score for result in question_results}
+        for result in history_results:
+            best_scores[result.row] = max(best_scores.get(result.row, result.score), result.score)
+
+        fused_question, fused_history = results[0][corpus_position], results[1][corpus_position]
+        # The question keeps all of its chunks; the history only those the question did not retrieve.
+        assert [result.row for result in fused_question] == [result.row for result in question_results]
+        assert [result.row for result in fused_history] == [result.row for result in history_results if result.row not in question_rows]
+        # A chunk both retrieved keeps the best of its two scores.
+        for result in fused_question + fused_history:
+            assert result.score == pytest.approx(best_scores[result.row])
+        score_of = {result.row: result.score for result in fused_question}
+        assert score_of[1] == pytest.approx(max(result.score for result in history_results if result.row == 1))
+        assert score_of[1] > next(result.score for result in question_results if result.row == 1)
+
+    # Without deduplication every query keeps its own results.
+    undeduplicated = search_many([question, history], corpora, k=5, deduplicate=False)
+    assert [result.row for result in undeduplicated[1][0]] == [result.row for result in corpora[0].search(history, k=5)]
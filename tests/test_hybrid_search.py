@@ -0,0 +1,91 @@
+import re
+
+import numpy as np
+import pytest
+
+from supportbot.retrieval.embedding_index import (EmbeddingIndex,
+                                                  hybrid_dense_ranking,
+                                                  hybrid_search)
+from supportbot.retrieval.lexical_index import LexicalIndex, identifiers
+
+ROWS = 2000
+DIMENSION = 64
+K = 5
+POOL_SIZE = 50
+
+
+def word_tokenizer(text):
+    # Punctuation is split off the words, as cl100k_base does.
+    return [hash(word) % 50000 for word in re.findall(r"[\w/-]+", text.lower())]
+
+
+def make_corpus(rng):
+    # A plain word in 15 chunks that are not semantically related to the questions,
+    # and one chunk naming an error code.
+    webhook_rows = set(rng.choice(ROWS, size=15, replace=False).tolist())
+    chunks = [
+        f"chunk {row} about topic {row % 40}" + (" webhook" if row in webhook_rows else "") + (" ERR_4012" if row == 1234 else "")
+        for row in range(ROWS)
+    ]
+    index = EmbeddingIndex(chunks, rng.standard_normal((ROWS, DIMENSION)).astype(np.float32))
+    index.lexical = LexicalIndex.build(chunks, word_tokenizer)
+    return index
+
+
+def test_hybrid_search_keeps_the_dense_hits():
+    rng = np.random.default_rng(0)
+    index = make_corpus(rng)
+    targets = rng.choice(ROWS, size=200, replace=False)
+    dense_hits = hybrid_hits = 0
+    for target in targets:
+        query = index.embeddings([target])[0] + 0.08 * rng.standard_normal(DIMENSION).astype(np.float32)
+        query /= np.linalg.norm(query)
+        text = "how do I configure the webhook"
+        dense = [scored_chunk.row for scored_chunk in index.search(query, k=POOL_SIZE)]
+        ranking, _ = hybrid_dense_ranking(index, query, text, POOL_SIZE)
+        # The fused dense ranking is the exact dense pool, whatever the query text.
+        assert ranking.tolist() == dense
+        hybrid = [scored_chunk.row for scored_chunk in hybrid_search(index, query, text, k=K, pool_size=POOL_SIZE)]
+        assert dense[0] in hybrid
+        dense_hits += target in dense[:K]
+        hybrid_hits += target in hybrid
+    assert dense_hits == len(targets)
+    assert hybrid_hits >= dense_hits
+
+
+def test_identifiers_add_their_rows_to_the_dense_candidates():
+    rng = np.random.default_rng(1)
+    index = make_corpus(rng)
+    query = index.embeddings([7])[0]
+    text = "why does the export fail with ERR_4012"
+    assert identifiers(text) == ["ERR_4012"]
+    dense = [scored_chunk.row for scored_chunk in index.search(query, k=POOL_SIZE)]
+    assert 1234 not in dense
+    ranking, scores = hybrid_dense_ranking(index, query, text, POOL_SIZE)
+    assert ranking.tolist() == dense + [1234]
+    assert np.isclose(scores[-1], index.embeddings([1234])[0] @ query, atol=1e-5)
+    hybrid = [scored_chunk.row for scored_chunk in hybrid_search(index, query, text, k=K, pool_size=POOL_SIZE)]
+    assert hybrid[:2] == [7, 1234] or hybrid[:2] == [1234, 7]
+
+
+@pytest.mark.parametrize("question, target", [
+    ("the export fails with ERR_4012, what does it mean?", 1234),
+    ("any update on TCK-5521?", 777),
+])
+def test_an_identifier_only_match_is_ranked_into_the_top_k(question, target):
+    rng = np.random.default_rng(2)
+    chunks = [f"chunk {row} about topic {row % 40}" for row in range(ROWS)]
+    chunks[1234] += " the export job logs ERR_4012 when the bucket is full"
+    chunks[777] += " follow-up of ticket TCK-5521 was sent to the customer"
+    index = EmbeddingIndex(chunks, rng.standard_normal((ROWS, DIMENSION)).astype(np.float32))
+    index.lexical = LexicalIndex.build(chunks, word_tokenizer)
+    # The question embedding is unrelated to the chunk: only the identifier links them.
+    query = rng.standard_normal(DIMENSION).astype(np.float32)
+    query /= np.linalg.norm(query)
+    assert target not in [scored_chunk.row for scored_chunk in index.search(query, k=POOL_SIZE)]
+    assert target in [scored_chunk.row for scored_chunk in hybrid_search(index, query, question, k=K, pool_size=POOL_SIZE)]
+
+
+def test_plain_words_are_not_identifiers():
+    assert identifiers("How do I set up the webhook for my bot?") == []
+    assert identifiers("ticket TCK-1234 mentions /api/v2/users and retryPolicy") == ["TCK-1234", "api/v2/users", "retryPolicy"]
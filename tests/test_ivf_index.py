@@ -0,0 +1,82 @@
+import numpy as np
+
+from supportbot.retrieval.embedding_index import EmbeddingIndex
+from supportbot.retrieval.ivf_index import IVFIndex
+from supportbot.retrieval.lexical_index import LexicalIndex
+from supportbot.retrieval.membership_index import MembershipIndex
+
+
+def word_tokenizer(text):
+    return [hash(word) % 50000 for word in text.lower().split()]
+
+
+def make_index(rng, rows=300, dimension=32):
+    chunks = [f"chunk {row} about topic {row % 7}" for row in range(rows)]
+    index = EmbeddingIndex(
+        chunks,
+        rng.standard_normal((rows, dimension)).astype(np.float32),
+        row_ids=np.arange(100, 100 + rows),
+        members=MembershipIndex.from_members([[row % 3] for row in range(rows)])
+    )
+    index.lexical = LexicalIndex.build(chunks, word_tokenizer)
+    return index
+
+
+def test_fingerprint_ignores_row_order_but_not_content():
+    index = make_index(np.random.default_rng(0))
+    ivf_index = IVFIndex.build(index, n_lists=8)
+    assert ivf_index.fingerprint() == index.fingerprint()
+
+    changed_embedding = EmbeddingIndex(index.chunks, index.matrix.copy(), index.row_ids, normalized=True)
+    changed_embedding.matrix[5, 0] += 0.5
+    assert changed_embedding.fingerprint() != EmbeddingIndex(index.chunks, index.matrix, index.row_ids, normalized=True).fingerprint()
+
+    changed_text = EmbeddingIndex(index.chunks[:-1] + ["another text"], index.matrix, index.row_ids, normalized=True)
+    assert changed_text.fingerprint() != EmbeddingIndex(index.chunks, index.matrix, index.row_ids, normalized=True).fingerprint()
+
+    changed_ids = EmbeddingIndex(index.chunks, index.matrix, index.row_ids + 1, normalized=True)
+    assert changed_ids.fingerprint() != EmbeddingIndex(index.chunks, index.matrix, index.row_ids, normalized=True).fingerprint()
+
+
+def test_save_and_load_keep_members_and_lexical(tmp_path):
+    index = make_index(np.random.default_rng(1))
+    ivf_index = IVFIndex.build(index, n_lists=8)
+    ivf_index.save(str(tmp_path))
+    assert IVFIndex.saved_fingerprint(str(tmp_path)) == index.fingerprint()
+
+    loaded = IVFIndex.load(str(tmp_path), nprobe=3)
+    assert loaded.nprobe == 3
+    assert list(loaded.chunks) == list(ivf_index.chunks)
+    for member_id in range(3):
+        np.testing.assert_array_equal(loaded.visible_rows(member_id), ivf_index.visible_rows(member_id))
+    for loaded_array, array in zip(loaded.lexical.to_arrays(), ivf_index.lexical.to_arrays()):
+        np.testing.assert_array_equal(loaded_array, array)
+
+
+def test_saved_fingerprint_is_none_without_a_saved_index(tmp_path):
+    assert IVFIndex.saved_fingerprint(str(tmp_path / "missing")) is None
+
+
+def test_an_access_controlled_index_without_members_shows_no_rows():
+    index = make_index(np.random.default_rng(2))
+    index.members = None
+    assert index.visible_rows(1) is None
+    assert len(index.visible_rows(1, access_controlled=True)) == 0
+
+
+def test_build_index_refuses_a_saved_index_without_members_and_refreshes_them(tmp_path, monkeypatch):
+    import agent_utils
+    monkeypatch.setattr(agent_utils, "IVF_INDEX_DIR", str(tmp_path))
+    index = make_index(np.random.default_rng(3))
+    saved = agent_utils.build_index("chunks", index, retrieval_index="ivf")
+    saved.members = None
+    saved.save(str(tmp_path / "chunks"))
+    rebuilt = agent_utils.build_index("chunks", index, retrieval_index="ivf")
+    assert rebuilt.members is not None
+
+    # A member joined a chat: same fingerprint, so the saved clustering is reused with the new members.
+    joined = make_index(np.random.default_rng(3))
+    joined.members = MembershipIndex.from_members([[row % 3, 9] if row == 4 else [row % 3] for row in range(len(joined))])
+    monkeypatch.setattr(IVFIndex, "build", None)
+    reused = agent_utils.build_index("chunks", joined, retrieval_index="ivf")
+    assert list(reused.row_ids[reused.visible_rows(9)]) == [104]
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+import agent_utils
+from supportbot.clients.openai import openai_client
+
+LATENCY = 0.2
+QUESTIONS = 20
+
+
+class FakeOpenAI:
+    """
+    Local stand-in for the OpenAI API answering embeddings and chat completions after a fixed latency.
+    """
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.requests = 0
+        self.max_concurrent = 0
+        self._concurrent = 0
+        self._ready = threading.Event()
+        self.port = None
+
+    def start(self) -> str:
+        threading.Thread(target=lambda: asyncio.run(self._serve()), daemon=True).start()
+        self._ready.wait()
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    async def _serve(self) -> None:
+        # Runs on a daemon thread until the test session exits.
+        server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                head = (await reader.readuntil(b"\r\n\r\n")).decode()
+                content_length = 0
+                for line in head.split("\r\n"):
+                    if line.lower().startswith("content-length:"):
+                        content_length = int(line.split(":", 1)[1])
+                request = json.loads(await reader.readexactly(content_length))
+                self.requests += 1
+                self._concurrent += 1
+                self.max_concurrent = max(self.max_concurrent, self._concurrent)
+                await asyncio.sleep(self.latency)
+                self._concurrent -= 1
+                body = json.dumps(self._response(head.split(" ")[1], request)).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    def _response(self, path: str, request: dict) -> dict:
+        usage = {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+        if path.endswith("/embeddings"):
+            inputs = request["input"] if isinstance(request["input"], list) else [request["input"]]
+            return {
+                "object": "list",
+                "model": request["model"],
+                "data": [{"object": "embedding", "index": position, "embedding": [1.0, 0.0, 0.0]} for position in range(len(inputs))],
+                "usage": usage,
+            }
+        return {
+            "id": "chatcmpl-test",
+            "object": "chat.completion",
+            "created": 0,
+            "model": request["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "answer"}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    server = FakeOpenAI(LATENCY)
+    monkeypatch.setenv("OPENAI_BASE_URL", server.start())
+    # Each test loop gets its own pooled client, bound to that loop.
+    monkeypatch.setattr(openai_client, "_async_client", None)
+    return server
+
+
+async def ask(question: str) -> str:
+    # The OpenAI round trips of a question: the question embedding, then the completion.
+    await agent_utils.aget_embeddings([question])
+    return await agent_utils.complete(f"Answer: {question}")
+
+
+def test_concurrent_questions_take_about_as_long_as_one(fake_openai):
+    async def run():
+        assert await ask("warm up the client") == "answer"
+        started_at = time.monotonic()
+        await ask("one question")
+        single = time.monotonic() - started_at
+
+        started_at = time.monotonic()
+        answers = await asyncio.gather(*(ask(f"question {position}") for position in range(QUESTIONS)))
+        concurrent = time.monotonic() - started_at
+        return single, concurrent, answers
+
+    single, concurrent, answers = asyncio.run(run())
+    assert answers == ["answer"] * QUESTIONS
+    # Sequentially the questions would take QUESTIONS * single; overlapped they take about one.
+    assert concurrent < 2 * single, f"{QUESTIONS} concurrent questions took {concurrent:.2f}s, one took {single:.2f}s"
+    assert fake_openai.max_concurrent >= QUESTIONS
@@ -0,0 +1,132 @@
+import asyncio
+import threading
+
+import numpy as np
+
+from supportbot.clients.crawl.dataclasses import ChunkAndEmbedding
+from supportbot.retrieval.embedding_index import EmbeddingIndex
+from supportbot.retrieval.partitioned_index import (PartitionedIndexCache,
+                                                    index_nbytes)
+
+DIMENSION = 16
+
+
+def make_rows(bot_id: int, count: int, first_row_id: int = 0) -> list[ChunkAndEmbedding]:
+    rng = np.random.default_rng(bot_id)
+    return [
+        ChunkAndEmbedding(
+            chunk=f"bot {bot_id} chunk {first_row_id + position}",
+            embedding=rng.standard_normal(DIMENSION).tolist(),
+            row_id=first_row_id + position
+        )
+        for position in range(count)
+    ]
+
+
+class FakeTable:
+    """
+    Loads a partition of `chunks_per_bot[bot_id]` chunks; `release`, when set, holds every load until it is set.
+    """
+    def __init__(self, chunks_per_bot: dict[int, int]) -> None:
+        self.chunks_per_bot = chunks_per_bot
+        self.loads: list[int] = []
+        self.release: threading.Event | None = None
+
+    def load_partition(self, bot_id: int) -> EmbeddingIndex:
+        self.loads.append(bot_id)
+        if self.release is not None:
+            assert self.release.wait(timeout=5)
+        return EmbeddingIndex.from_chunks(make_rows(bot_id, self.chunks_per_bot[bot_id]))
+
+    def nbytes(self, bot_id: int) -> int:
+        return index_nbytes(EmbeddingIndex.from_chunks(make_rows(bot_id, self.chunks_per_bot[bot_id])))
+
+
+def test_the_least_recently_used_partitions_are_evicted_by_size():
+    table = FakeTable({1: 100, 2: 100, 3: 100, 4: 300})
+    # Room for two of the small partitions, not three.
+    cache = PartitionedIndexCache("message_history_chunks", table.load_partition, max_bytes=table.nbytes(1) * 5 // 2)
+
+    async def run():
+        await cache.get(1)
+        await cache.get(2)
+        await cache.get(1)
+        # Bot 2 was used least recently, so it makes room for bot 3.
+        await cache.get(3)
+        assert list(cache._partitions) == [1, 3]
+        # A partition larger than the budget stays loaded on its own.
+        await cache.get(4)
+        assert list(cache._partitions) == [4]
+        await cache.get(1)
+
+    asyncio.run(run())
+    assert table.loads == [1, 2, 3, 4, 1]
+    stats = cache.stats()
+    assert stats["evictions"] == 4
+    assert stats["hits"] == 1
+    assert stats["misses"] == 5
+    assert cache._total_bytes() <= cache.max_bytes
+
+
+def test_concurrent_first_questions_share_one_load():
+    table = FakeTable({1: 100})
+    table.release = threading.Event()
+    cache = PartitionedIndexCache("message_history_chunks", table.load_partition, max_bytes=2**30)
+
+    async def run():
+        questions = [asyncio.create_task(cache.get(1)) for _ in range(5)]
+        await asyncio.sleep(0.05)
+        # A cancelled question leaves the shared load running for the others.
+        questions[0].cancel()
+        table.release.set()
+        return await asyncio.gather(*questions[1:])
+
+    indexes = asyncio.run(run())
+    assert table.loads == [1]
+    assert all(index is indexes[0] for index in indexes)
+    assert cache.stats()["loads"] == 1
+    assert cache._loading == {}
+
+
+def test_an_evicted_partition_is_reloaded_and_refreshed_again():
+    table = FakeTable({1: 100, 2: 100})
+    cache = PartitionedIndexCache(
+        "message_history_chunks",
+        table.load_partition,
+        max_bytes=table.nbytes(1) * 3 // 2,
+        refresh_options={}
+    )
+
+    async def run():
+        await cache.get(1)
+        evicted_refresher = cache._partitions[1].refresher
+        await cache.get(2)
+        assert list(cache._partitions) == [2]
+
+        # A refresh of the evicted partition that was already running when it was evicted
+        # does not bring it back or evict the loaded one.
+        evicted_refresher._fetch_changed_rows = lambda index: make_rows(1, 1, first_row_id=100)
+        await evicted_refresher.refresh()
+        assert list(cache._partitions) == [2]
+
+        # Only loaded partitions are refreshed.
+        def must_not_fetch(index):
+            raise AssertionError("refreshed an evicted partition")
+
+        evicted_refresher._fetch_changed_rows = must_not_fetch
+        cache._partitions[2].refresher._fetch_changed_rows = lambda index: make_rows(2, 1, first_row_id=100)
+        refreshing = asyncio.create_task(cache.run(0))
+        while cache._partitions[2].refresher.refreshes == 0:
+            await asyncio.sleep(0.01)
+        refreshing.cancel()
+        assert len(await cache.get(2)) == 101
+
+        # The next question for bot 1 loads it again, with a refresher of its own.
+        index = await cache.get(1)
+        return evicted_refresher, index
+
+    evicted_refresher, index = asyncio.run(run())
+    assert table.loads == [1, 2, 1]
+    assert len(index) == 100
+    assert cache._partitions[1].refresher is not evicted_refresher
+    assert cache._partitions[1].refresher.get_index() is index
@@ -0,0 +1,181 @@
+import inspect
+import re
+
+import numpy as np
+import pytest
+import tiktoken
+
+from supportbot.clients.messages.dataclasses import Message
+from supportbot.clients.openai import prompt_builder
+from supportbot.clients.openai.prompt_builder import build_prompt
+from supportbot.retrieval.dataclasses import ScoredChunk
+
+VOCABULARY = """
+apple river table window garden yellow market silver doctor winter summer engine basket pillow
+forest bridge castle dinner letter mirror orange pencil rocket saddle temple valley wallet anchor
+butter candle dragon finger ginger hammer island jacket kettle ladder magnet needle parrot rabbit
+sister tunnel violin wizard bottle camera desert farmer guitar helmet insect jungle kitten lemon
+monkey number office planet quartz remote shadow ticket uncle velvet wagon barrel canvas donkey
+elbow falcon goose harbor igloo jelly koala lizard meadow noodle oyster pepper quiver radio salad
+tiger umbrella vessel walrus yogurt zebra acorn bacon cabin daisy eagle fabric glove hotel icicle
+jewel kayak lantern muffin nectar olive puppy quilt robin spider tomato unicorn vacuum whistle
+coffee branch carpet cloud crystal cricket dolphin feather fossil glacier hornet jigsaw lobster
+marble mushroom nickel pebble pickle pirate potato puzzle raisin ribbon saucer scarf shovel sponge
+squirrel statue sugar tablet teapot thunder tractor trumpet turtle vanilla volcano waffle walnut
+weasel willow badge beacon blanket bucket cactus cherry chimney clover cobweb cookie cotton cradle
+crayon cupboard curtain cushion dagger diamond domino drawer eraser ferret fiddle flannel fountain
+gadget gazelle goblet gravel hamster hazel hedgehog jasmine kernel lagoon locket mango mitten mosaic
+napkin nutmeg orchid paddle
+""".split()
+
+
+def word_level_encoding() -> tiktoken.Encoding:
+    # Offline, cl100k_base cannot be downloaded. This encoding has a token for every prefix of the
+    # test words and of the words of the prompt template, so BPE turns each of them into one token,
+    # as cl100k_base does for common English words.
+    cl100k_pattern = r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]++[\r\n]*|\s*[\r\n]|\s+(?!\S)|\s+"""
+    ranks = {bytes([value]): value for value in range(256)}
+    template_words = re.findall(r"[A-Za-z]+", inspect.getsource(prompt_builder))
+    for word in VOCABULARY + template_words:
+        for text in (word, f" {word}"):
+            for end in range(2, len(text) + 1):
+                ranks.setdefault(text[:end].encode(), len(ranks))
+    return tiktoken.Encoding("test_words", pat_str=cl100k_pattern, mergeable_ranks=ranks, special_tokens={})
+
+
+@pytest.fixture(scope="module")
+def encoding():
+    try:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        encoding = word_level_encoding()
+    saved, prompt_builder._encoding = prompt_builder._encoding, encoding
+    yield encoding
+    prompt_builder._encoding = saved
+
+
+def words(*numbers: int) -> str:
+    return " ".join(VOCABULARY[number] for number in numbers)
+
+
+def chunk(text: str, score: float, row: int = 0) -> ScoredChunk:
+    return ScoredChunk(row=row, chunk=text, score=score)
+
+
+def message(text: str, number: int) -> Message:
+    return Message(message=text, chat_id="1", chat_name="Group", username=f"user{number}", update_id=str(number), created_at="2026-01-01")
+
+
+def jaccard(encoding: tiktoken.Encoding, text: str, other: str) -> float:
+    tokens, other_tokens = set(encoding.encode_ordinary(text)), set(encoding.encode_ordinary(other))
+    return len(tokens & other_tokens) / len(tokens | other_tokens)
+
+
+def many_chunks(rng, count: int, length: int) -> list[ScoredChunk]:
+    return [
+        chunk(words(*rng.choice(len(VOCABULARY), size=length, replace=False)), score=1 - position / count, row=position)
+        for position in range(count)
+    ]
+
+
+@pytest.mark.parametrize("token_budget", [400, 800, 1600, 3000])
+def test_the_prompt_stays_within_the_token_budget(encoding, token_budget):
+    rng = np.random.default_rng(0)
+    chat_messages = [message(words(*rng.choice(len(VOCABULARY), size=15)), number) for number in range(10)]
+    user_messages = [message(words(*rng.choice(len(VOCABULARY), size=15)), number) for number in range(10, 30)]
+    documentation, message_chunks = many_chunks(rng, 40, 40), many_chunks(rng, 40, 40)
+    prompt, stats = build_prompt(
+        "how do I configure the webhook?",
+        "Q: what is a bot?\nA: a program",
+        [documentation],
+        [message_chunks],
+        chat_messages,
+        user_messages,
+        token_budget=token_budget,
+        message_token_budget=200
+    )
+    assert len(encoding.encode_ordinary(prompt)) <= token_budget
+    # The reported count is the count of the prompt that is sent.
+    assert stats.tokens == len(encoding.encode_ordinary(prompt))
+    assert stats.chunks == sum(scored_chunk.chunk in prompt for scored_chunk in documentation + message_chunks)
+    assert stats.chunks_over_budget == len(documentation + message_chunks) - stats.chunks
+
+
+def test_exact_and_near_duplicate_chunks_are_dropped(encoding):
+    original = words(*range(0, 30))
+    near_duplicate = words(*range(0, 29), 150)
+    distinct = words(*range(60, 90))
+    similarity = jaccard(encoding, original, near_duplicate)
+    assert 0.8 <= similarity < 1
+
+    def build(duplicate_threshold):
+        return build_prompt(
+            "question",
+            "",
+            [[chunk(original, 0.9), chunk(near_duplicate, 0.85)], [chunk(distinct, 0.5)]],
+            [[chunk(original, 0.8)]],
+            duplicate_threshold=duplicate_threshold
+        )
+
+    # A chunk exactly at the threshold is a near-duplicate.
+    prompt, stats = build(similarity)
+    assert prompt.count(original) == 1
+    assert near_duplicate not in prompt
+    assert distinct in prompt
+    assert stats.duplicate_chunks == 2
+    assert stats.chunks == 2
+
+    # Just above its similarity, only the exact copy is dropped.
+    prompt, stats = build(similarity + 1e-6)
+    assert near_duplicate in prompt
+    assert stats.duplicate_chunks == 1
+
+
+@pytest.mark.parametrize("relevance_weight, expected_order", [(1.0, ["best", "similar", "other"]), (0.5, ["best", "other", "similar"])])
+def test_chunks_are_picked_by_relevance_then_redundancy(encoding, relevance_weight, expected_order):
+    texts = {
+        "best": words(*range(0, 20)),
+        # Shares half of its words with the best chunk: redundant, but not a near-duplicate.
+        "similar": words(*range(0, 10), *range(120, 130)),
+        "other": words(*range(40, 60)),
+    }
+    assert 0.2 < jaccard(encoding, texts["best"], texts["similar"]) < 0.5
+    prompt, stats = build_prompt(
+        "question",
+        "",
+        [[chunk(texts["best"], 0.9), chunk(texts["similar"], 0.85), chunk(texts["other"], 0.6)]],
+        [],
+        relevance_weight=relevance_weight
+    )
+    assert stats.chunks == 3
+    assert sorted(texts, key=lambda name: prompt.index(texts[name])) == expected_order
+
+
+def test_messages_are_trimmed_to_their_budget(encoding):
+    rng = np.random.default_rng(1)
+    chat_messages = [message(words(*rng.choice(len(VOCABULARY), size=20)), number) for number in range(20)]
+    user_messages = [message(words(*rng.choice(len(VOCABULARY), size=20)), number) for number in range(20, 40)]
+    message_token_budget = 150
+
+    documentation = many_chunks(rng, 60, 40)
+    prompt, stats = build_prompt(
+        "question",
+        "",
+        [documentation],
+        [],
+        chat_messages,
+        user_messages,
+        token_budget=2000,
+        message_token_budget=message_token_budget
+    )
+    kept = [chat_message for chat_message in chat_messages + user_messages if chat_message.message in prompt]
+    kept_tokens = sum(len(encoding.encode_ordinary(chat_message.message)) for chat_message in kept)
+    largest_chunk = max(len(encoding.encode_ordinary(scored_chunk.chunk)) for scored_chunk in documentation)
+    # Messages keep their reserved tokens even though the chunks could fill the whole budget,
+    # plus at most what the chunks left over.
+    assert 0 < stats.messages == len(kept) < len(chat_messages + user_messages)
+    assert stats.messages_over_budget == len(chat_messages + user_messages) - len(kept)
+    assert kept_tokens <= message_token_budget + largest_chunk
+    # The newest chat messages are kept first.
+    assert kept[0] is chat_messages[0]
+    assert stats.tokens <= 2000
@@ -0,0 +1,77 @@
+import asyncio
+
+from supportbot.clients.messages.dataclasses import Message
+from supportbot.clients.messages.recent_messages import RecentMessageIndex
+
+
+def make_message(update_id: int, chat_id: str = "chat", username: str = "user") -> Message:
+    return Message(message=f"message {update_id}", chat_id=chat_id, chat_name="Chat", username=username, update_id=str(update_id))
+
+
+class FakeMessageClient:
+    """
+    Serves the rows of the `messages` table, newest first; while `paused` is set, a read
+    waits for `release` after taking its rows, so messages can be added during the backfill.
+    """
+    def __init__(self, rows: list[Message]) -> None:
+        self.rows = rows
+        self.error: Exception | None = None
+        self.reads = 0
+        self.paused = False
+        self.release = asyncio.Event()
+
+    async def latest_messages(self, column: str, value: str, limit: int) -> list[Message]:
+        self.reads += 1
+        if self.error is not None:
+            raise self.error
+        rows = [message for message in self.rows if getattr(message, column) == value][:limit]
+        if self.paused:
+            await self.release.wait()
+        return rows
+
+
+def test_a_failed_backfill_is_not_cached():
+    client = FakeMessageClient([make_message(2), make_message(1)])
+    index = RecentMessageIndex(client=client)
+
+    async def run():
+        client.error = ConnectionError("database unavailable")
+        assert await index.get_chat_history("chat") is None
+        client.error = None
+        return await index.get_chat_history("chat")
+
+    assert [message.update_id for message in asyncio.run(run())] == ["2", "1"]
+    assert client.reads == 2
+    assert index.stats()["errors"] == 1
+
+
+def test_a_chat_without_messages_is_cached():
+    client = FakeMessageClient([])
+    index = RecentMessageIndex(client=client)
+
+    async def run():
+        assert await index.get_chat_history("chat") is None
+        index.add(make_message(1))
+        return await index.get_chat_history("chat")
+
+    assert [message.update_id for message in asyncio.run(run())] == ["1"]
+    assert client.reads == 1
+
+
+def test_messages_added_during_the_backfill_are_merged():
+    client = FakeMessageClient([make_message(2), make_message(1)])
+    index = RecentMessageIndex(client=client)
+
+    async def run():
+        client.paused = True
+        backfill = asyncio.create_task(index.get_chat_history("chat"))
+        await asyncio.sleep(0)
+        # Message 2 was inserted before the table was read, message 3 after.
+        index.add(client.rows[0])
+        index.add(make_message(3))
+        client.release.set()
+        await backfill
+        return await index.get_chat_history("chat")
+
+    assert [message.update_id for message in asyncio.run(run())] == ["3", "2", "1"]
+    assert client.reads == 1
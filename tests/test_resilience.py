@@ -0,0 +1,215 @@
+import asyncio
+import time
+
+import httpx
+import openai
+import pytest
+
+from supportbot.clients.openai.resilience import (MIN_LATENCY_SAMPLES,
+                                                  CircuitBreaker,
+                                                  ResilientCall,
+                                                  UpstreamUnavailable,
+                                                  is_upstream_failure)
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/embeddings")
+
+
+def status_error(status_code: int) -> openai.APIStatusError:
+    response = httpx.Response(status_code, request=REQUEST)
+    return openai.APIStatusError(f"status {status_code}", response=response, body=None)
+
+
+def failing(error: Exception):
+    async def fn():
+        raise error
+    return fn
+
+
+@pytest.mark.parametrize("error, counts", [
+    (openai.APITimeoutError(request=REQUEST), True),
+    (openai.APIConnectionError(request=REQUEST), True),
+    (httpx.ConnectError("refused", request=REQUEST), True),
+    (status_error(500), True),
+    (status_error(503), True),
+    (status_error(429), True),
+    (status_error(400), False),
+    (status_error(401), False),
+    (status_error(404), False),
+    (ValueError("bad input"), False),
+])
+def test_only_upstream_failures_count(error, counts):
+    assert is_upstream_failure(error) == counts
+
+
+def test_client_errors_do_not_open_the_breaker():
+    call = ResilientCall("embeddings", deadline=1, hedge=False, breaker=CircuitBreaker(failure_threshold=2))
+
+    async def run():
+        for _ in range(5):
+            with pytest.raises(openai.APIStatusError):
+                await call.call(failing(status_error(400)))
+        assert call.breaker.state == "closed"
+        for _ in range(2):
+            with pytest.raises(openai.APIStatusError):
+                await call.call(failing(status_error(503)))
+        with pytest.raises(UpstreamUnavailable):
+            await call.call(failing(status_error(503)))
+
+    asyncio.run(run())
+    assert call.errors == 7
+    assert call.breaker.opens == 1
+
+
+def test_a_client_error_of_the_trial_call_keeps_the_breaker_half_open():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    call = ResilientCall("embeddings", deadline=1, hedge=False, breaker=breaker)
+
+    async def succeed():
+        return "ok"
+
+    async def run():
+        with pytest.raises(openai.APIStatusError):
+            await call.call(failing(status_error(500)))
+        assert breaker.state == "half_open"
+        with pytest.raises(openai.APIStatusError):
+            await call.call(failing(status_error(400)))
+        assert breaker.state == "half_open"
+        return await call.call(succeed)
+
+    assert asyncio.run(run()) == "ok"
+    assert breaker.state == "closed"
+
+
+class SlowBackend:
+    """
+    A fake upstream; each attempt takes the next of `delays` seconds, or the last one once they run out.
+    """
+    def __init__(self, *delays: float) -> None:
+        self.delays = list(delays)
+        self.started = 0
+        self.finished: list[int] = []
+        self.cancelled: list[int] = []
+
+    async def request(self) -> str:
+        attempt = self.started
+        self.started += 1
+        delay = self.delays[min(attempt, len(self.delays) - 1)]
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled.append(attempt)
+            raise
+        self.finished.append(attempt)
+        return f"answer {attempt}"
+
+
+def primed_call(**options) -> ResilientCall:
+    # Enough fast calls for the hedge delay to come from the observed latencies.
+    call = ResilientCall("completions", **options)
+    call.latencies.extend([0.001] * MIN_LATENCY_SAMPLES)
+    return call
+
+
+def test_a_call_past_its_deadline_is_cancelled_and_counts_as_a_failure():
+    backend = SlowBackend(10)
+    call = ResilientCall("completions", deadline=0.05, hedge=False, breaker=CircuitBreaker(failure_threshold=1))
+
+    async def run():
+        started_at = time.monotonic()
+        with pytest.raises(UpstreamUnavailable):
+            await call.call(backend.request)
+        return time.monotonic() - started_at
+
+    assert asyncio.run(run()) < 1
+    assert backend.cancelled == [0]
+    assert call.timeouts == 1
+    assert call.breaker.state == "open"
+
+
+def test_a_slow_attempt_is_hedged_and_the_loser_cancelled():
+    backend = SlowBackend(10, 0.01)
+    call = primed_call(deadline=5, min_hedge_delay=0.05)
+
+    async def run():
+        started_at = time.monotonic()
+        result = await call.call(backend.request)
+        return result, time.monotonic() - started_at
+
+    result, elapsed = asyncio.run(run())
+    assert result == "answer 1"
+    # The hedge starts after the percentile delay, not after the slow attempt.
+    assert 0.05 <= elapsed < 1
+    assert backend.cancelled == [0]
+    assert call.hedged == 1
+    assert call.hedge_wins == 1
+
+
+def test_a_fast_attempt_is_not_hedged():
+    backend = SlowBackend(0.01)
+    call = primed_call(deadline=5, min_hedge_delay=0.5)
+    assert asyncio.run(call.call(backend.request)) == "answer 0"
+    assert backend.started == 1
+    assert call.hedged == 0
+
+
+def test_streamed_latencies_do_not_raise_the_hedge_delay():
+    call = primed_call(deadline=5)
+    fast_delay = call.hedge_delay()
+
+    async def run():
+        for _ in range(MIN_LATENCY_SAMPLES):
+            await call.call(SlowBackend(0.02).request, hedge=False)
+
+    asyncio.run(run())
+    assert call.hedge_delay() == fast_delay
+    assert call.hedged == 0
+    stats = call.stats()
+    assert stats["p50_ms"] == 1
+    assert stats["unhedged_p50_ms"] >= 20
+
+
+def test_an_open_breaker_lets_one_trial_through_once_the_timeout_passes():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    call = ResilientCall("completions", deadline=5, hedge=False, breaker=breaker)
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(openai.APIStatusError):
+                await call.call(failing(status_error(503)))
+        assert breaker.state == "open"
+        backend = SlowBackend(0.02)
+        with pytest.raises(UpstreamUnavailable):
+            await call.call(backend.request)
+        assert backend.started == 0
+
+        await asyncio.sleep(0.05)
+        assert breaker.state == "half_open"
+        # Only one trial runs; the calls made meanwhile are refused.
+        trial = asyncio.create_task(call.call(backend.request))
+        await asyncio.sleep(0)
+        with pytest.raises(UpstreamUnavailable):
+            await call.call(backend.request)
+        assert await trial == "answer 0"
+        return backend
+
+    backend = asyncio.run(run())
+    assert backend.started == 1
+    assert breaker.state == "closed"
+    assert breaker.opens == 1
+    assert breaker.rejected == 2
+
+
+def test_a_failed_trial_opens_the_breaker_again():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    call = ResilientCall("completions", deadline=5, hedge=False, breaker=breaker)
+
+    async def run():
+        with pytest.raises(openai.APIStatusError):
+            await call.call(failing(status_error(503)))
+        await asyncio.sleep(0.05)
+        with pytest.raises(openai.APIStatusError):
+            await call.call(failing(status_error(503)))
+        assert breaker.state == "open"
+
+    asyncio.run(run())
+    assert breaker.opens == 2
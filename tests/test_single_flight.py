@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+from supportbot.clients.openai.single_flight import (SingleFlight,
+                                                     normalize_text)
+
+
+class FakeUpstream:
+    """
+    Counts calls; each call waits for `release` so concurrent callers overlap.
+    """
+    def __init__(self, error: Exception | None = None) -> None:
+        self.calls: list[list[str]] = []
+        self.error = error
+        self.release = asyncio.Event()
+
+    async def embed(self, keys: list[str]) -> list[str]:
+        self.calls.append(list(keys))
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return [f"embedding of {key}" for key in keys]
+
+
+def test_concurrent_identical_keys_share_one_call():
+    flight = SingleFlight()
+
+    async def run():
+        upstream = FakeUpstream()
+        waiters = [asyncio.create_task(flight.do("question", lambda: upstream.embed(["question"]))) for _ in range(5)]
+        await asyncio.sleep(0)
+        upstream.release.set()
+        return upstream, await asyncio.gather(*waiters)
+
+    upstream, results = asyncio.run(run())
+    assert upstream.calls == [["question"]]
+    assert results == [["embedding of question"]] * 5
+    assert flight.stats() == {"upstream_calls": 1, "upstream_keys": 1, "saved": 4}
+
+
+def test_do_many_only_calls_for_the_keys_not_in_flight():
+    flight = SingleFlight()
+
+    async def run():
+        upstream = FakeUpstream()
+        first = asyncio.create_task(flight.do_many(["a", "b"], upstream.embed))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(flight.do_many(["b", "c", "c"], upstream.embed))
+        await asyncio.sleep(0)
+        upstream.release.set()
+        return upstream, await first, await second
+
+    upstream, first, second = asyncio.run(run())
+    assert upstream.calls == [["a", "b"], ["c"]]
+    assert first == ["embedding of a", "embedding of b"]
+    assert second == ["embedding of b", "embedding of c", "embedding of c"]
+
+
+def test_an_error_reaches_every_waiter_and_is_not_kept():
+    flight = SingleFlight()
+
+    async def run():
+        failing = FakeUpstream(error=ConnectionError("upstream down"))
+        waiters = [asyncio.create_task(flight.do("question", lambda: failing.embed(["question"]))) for _ in range(3)]
+        await asyncio.sleep(0)
+        failing.release.set()
+        errors = await asyncio.gather(*waiters, return_exceptions=True)
+        # The next call for the key starts a new upstream call instead of reusing the failure.
+        upstream = FakeUpstream()
+        upstream.release.set()
+        return failing, errors, await flight.do("question", lambda: upstream.embed(["question"]))
+
+    failing, errors, result = asyncio.run(run())
+    assert len(failing.calls) == 1
+    assert all(isinstance(error, ConnectionError) for error in errors)
+    assert result == ["embedding of question"]
+    assert flight.stats()["upstream_calls"] == 2
+
+
+def test_the_key_is_freed_once_the_call_finishes():
+    flight = SingleFlight()
+
+    async def run():
+        upstream = FakeUpstream()
+        upstream.release.set()
+        await flight.do("question", lambda: upstream.embed(["question"]))
+        assert flight._flights == {}
+        await flight.do("question", lambda: upstream.embed(["question"]))
+        return upstream
+
+    assert len(asyncio.run(run()).calls) == 2
+
+
+def test_a_cancelled_caller_does_not_cancel_the_shared_call():
+    flight = SingleFlight()
+
+    async def run():
+        upstream = FakeUpstream()
+        first = asyncio.create_task(flight.do("question", lambda: upstream.embed(["question"])))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(flight.do("question", lambda: upstream.embed(["question"])))
+        await asyncio.sleep(0)
+        first.cancel()
+        upstream.release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return upstream, await second
+
+    upstream, result = asyncio.run(run())
+    assert upstream.calls == [["question"]]
+    assert result == ["embedding of question"]
+
+
+def test_texts_differing_only_in_spacing_share_a_key():
+    assert normalize_text("  how do I\n reset   it? ") == normalize_text("how do I reset it?")
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+import agent_utils
+from supportbot.retrieval.embedding_index import EmbeddingIndex
+from supportbot.retrieval.ivf_index import IVFIndex
+from supportbot.retrieval.snapshot import (index_params, load_snapshot,
+                                           save_snapshot)
+from supportbot.retrieval.two_stage_index import TwoStageIndex
+
+
+def make_index(rows=400, dimension=300):
+    rng = np.random.default_rng(0)
+    return EmbeddingIndex([f"chunk {row}" for row in range(rows)], rng.standard_normal((rows, dimension)).astype(np.float32), row_ids=np.arange(rows))
+
+
+def test_save_snapshot_keeps_the_nprobe_of_the_index(tmp_path):
+    ivf_index = IVFIndex.build(make_index(), n_lists=10, nprobe=3)
+    saved = save_snapshot(ivf_index, str(tmp_path), "crawled_url_chunks")
+    assert isinstance(saved, IVFIndex)
+    assert saved.nprobe == 3
+    assert index_params(saved) == {"index_type": "ivf", "n_lists": 10, "nprobe": 3}
+    # The configured nprobe still wins when the bot maps the snapshot at start.
+    assert load_snapshot(str(tmp_path), "crawled_url_chunks", nprobe=5).nprobe == 5
+
+
+def test_a_quantized_two_stage_snapshot_keeps_its_quantized_prefixes(tmp_path):
+    index = TwoStageIndex.from_index(make_index().quantized("int8"), prefix_dims=64)
+    saved = save_snapshot(index, str(tmp_path), "crawled_url_chunks")
+    assert isinstance(saved, TwoStageIndex)
+    assert saved.prefix_matrix.dtype == np.int8
+    np.testing.assert_array_equal(saved.prefix_matrix, index.prefix_matrix)
+    np.testing.assert_array_equal(saved.prefix_scales, index.prefix_scales)
+    query = make_index().embeddings([7])[0]
+    assert [result.row for result in saved.search(query)] == [result.row for result in index.search(query)]
+
+
+@pytest.mark.parametrize("retrieval_index", ["exact", "ivf", "auto", "two_stage"])
+@pytest.mark.parametrize("rows", [0, 400])
+def test_expected_index_params_match_what_build_index_builds(monkeypatch, retrieval_index, rows):
+    monkeypatch.setattr(agent_utils, "ANN_MIN_CORPUS_SIZE", 200)
+    index = make_index(rows=rows) if rows else EmbeddingIndex([], np.empty((0, 0), dtype=np.float32))
+    built = agent_utils.build_index("crawled_url_chunks", index, retrieval_index=retrieval_index)
+    expected = agent_utils.expected_index_params(retrieval_index, len(index), index.dimension)
+    assert {key: index_params(built).get(key) for key in expected} == expected
+
+
+def test_a_snapshot_of_another_index_kind_is_rebuilt(tmp_path, monkeypatch):
+    saved = save_snapshot(make_index(), str(tmp_path), "crawled_url_chunks")
+    assert agent_utils._snapshot_usable("crawled_url_chunks", saved, "crawled_url_chunks", "float32", "exact")
+    assert not agent_utils._snapshot_usable("crawled_url_chunks", saved, "crawled_url_chunks", "float32", "two_stage")
+    assert not agent_utils._snapshot_usable("crawled_url_chunks", saved, "crawled_url_chunks", "int8", "exact")
+    # The exact snapshot outgrew the auto threshold.
+    monkeypatch.setattr(agent_utils, "ANN_MIN_CORPUS_SIZE", 100)
+    assert not agent_utils._snapshot_usable("crawled_url_chunks", saved, "crawled_url_chunks", "float32", "auto")
+
+    two_stage = save_snapshot(agent_utils.build_index("crawled_url_chunks", make_index(), retrieval_index="two_stage"), str(tmp_path), "two_stage")
+    assert agent_utils._snapshot_usable("two_stage", two_stage, "crawled_url_chunks", "float32", "two_stage")
+    monkeypatch.setattr(agent_utils, "TWO_STAGE_PREFIX_DIMS", 128)
+    assert not agent_utils._snapshot_usable("two_stage", two_stage, "crawled_url_chunks", "float32", "two_stage")
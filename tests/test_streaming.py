@@ -0,0 +1,186 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import BadRequest, RetryAfter
+
+import agent_utils
+from config import STREAM_EDIT_INTERVAL, STREAM_GROUP_EDIT_INTERVAL
+from supportbot.handlers import streaming
+from supportbot.handlers.streaming import (PLACEHOLDER_TEXT, StreamingReply,
+                                           streaming_stats)
+
+
+class FakeClock:
+    """
+    Time as seen by StreamingReply; sleeping advances it instantly.
+    """
+    def __init__(self) -> None:
+        self.now = 100.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float) -> None:
+        self.now += max(seconds, 0)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(streaming, "time", SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(streaming, "asyncio", SimpleNamespace(sleep=clock.sleep))
+    return clock
+
+
+class FakeReply:
+    """
+    The placeholder message; `errors` are raised by the next edits, in order.
+    """
+    def __init__(self, clock: FakeClock, text: str) -> None:
+        self.clock = clock
+        self.texts = [text]
+        self.edits: list[tuple[float, str, str | None]] = []
+        self.errors: list[Exception] = []
+
+    async def edit_text(self, text: str, parse_mode: str | None = None) -> "FakeReply":
+        if self.errors:
+            raise self.errors.pop(0)
+        self.edits.append((self.clock.now, text, parse_mode))
+        self.texts.append(text)
+        return self
+
+
+class FakeMessage:
+    def __init__(self, clock: FakeClock) -> None:
+        self.clock = clock
+        self.replies: list[FakeReply] = []
+
+    async def reply_text(self, text: str, parse_mode: str | None = None) -> FakeReply:
+        reply = FakeReply(self.clock, text)
+        self.replies.append(reply)
+        return reply
+
+
+class FakeStreamingClient:
+    """
+    Stands in for the OpenAI client: a streamed completion yields `tokens`, the first one after
+    `first_token_delay` seconds and the others every `token_interval` seconds.
+    """
+    def __init__(self, clock: FakeClock, tokens: list[str], first_token_delay: float, token_interval: float) -> None:
+        self.clock = clock
+        self.tokens = tokens
+        self.first_token_delay = first_token_delay
+        self.token_interval = token_interval
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model: str, messages: list[dict], stream: bool = False):
+        assert stream
+        return self._stream()
+
+    async def _stream(self):
+        self.clock.now += self.first_token_delay
+        for position, token in enumerate(self.tokens):
+            if position:
+                self.clock.now += self.token_interval
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))])
+
+
+def test_the_placeholder_is_sent_before_the_first_token(clock):
+    message = FakeMessage(clock)
+    reply = StreamingReply(message, edit_interval=STREAM_EDIT_INTERVAL)
+    client = FakeStreamingClient(clock, ["Restart", " the", " webhook."], first_token_delay=0.8, token_interval=0.05)
+
+    async def run():
+        await reply.start()
+        assert message.replies[0].texts == [PLACEHOLDER_TEXT]
+        answer = await agent_utils.stream_completion(client, "prompt", reply.update)
+        await reply.finish(answer)
+
+    asyncio.run(run())
+    [placeholder] = message.replies
+    assert placeholder.texts[0] == PLACEHOLDER_TEXT
+    assert placeholder.texts[1] == "Restart"
+    assert placeholder.texts[-1] == "Restart the webhook."
+    assert reply.time_to_first_token == pytest.approx(0.8)
+    assert streaming_stats()["ttft_p50_ms"] is not None
+
+
+@pytest.mark.parametrize("edit_interval", [STREAM_EDIT_INTERVAL, STREAM_GROUP_EDIT_INTERVAL])
+def test_edits_are_throttled_to_the_edit_interval(clock, edit_interval):
+    message = FakeMessage(clock)
+    reply = StreamingReply(message, edit_interval=edit_interval)
+    tokens = [f" token{position}" for position in range(100)]
+    client = FakeStreamingClient(clock, tokens, first_token_delay=0.2, token_interval=0.1)
+
+    async def run():
+        await reply.start()
+        answer = await agent_utils.stream_completion(client, "prompt", reply.update)
+        await reply.finish(answer)
+
+    asyncio.run(run())
+    [placeholder] = message.replies
+    edit_times = [edited_at for edited_at, _, _ in placeholder.edits]
+    # Every edit, the final one included, waits out the interval since the previous one.
+    assert all(later - earlier >= edit_interval - 1e-9 for earlier, later in zip(edit_times, edit_times[1:]))
+    # 10 seconds of tokens: about one edit per interval, not one per token.
+    assert len(edit_times) <= 10 / edit_interval + 2
+    assert placeholder.texts[-1] == "".join(tokens).strip()
+
+
+def test_retry_after_postpones_the_next_edit(clock):
+    message = FakeMessage(clock)
+    reply = StreamingReply(message, edit_interval=1.0)
+
+    async def run():
+        await reply.start()
+        message.replies[0].errors.append(RetryAfter(5))
+        await reply.update("Restart")
+        clock.now += 2
+        await reply.update("Restart the")
+        assert message.replies[0].edits == []
+        clock.now += 4
+        await reply.update("Restart the webhook")
+        message.replies[0].errors.append(RetryAfter(3))
+        await reply.finish("Restart the webhook.")
+
+    started_at = clock.now
+    asyncio.run(run())
+    edits = message.replies[0].edits
+    assert [text for _, text, _ in edits] == ["Restart the webhook", "Restart the webhook."]
+    assert edits[0][0] == pytest.approx(started_at + 6)
+    # The rate-limited final edit is retried once the limit is over instead of being dropped.
+    assert edits[1][0] >= started_at + 6 + 3
+
+
+def test_an_unchanged_final_answer_is_not_an_error(clock):
+    message = FakeMessage(clock)
+    reply = StreamingReply(message, edit_interval=0)
+
+    async def run():
+        await reply.start()
+        await reply.update("Restart the webhook.")
+        message.replies[0].errors.append(BadRequest("Message is not modified: specified new message content is the same"))
+        return await reply.finish("Restart the webhook.")
+
+    assert asyncio.run(run()) is message.replies[0]
+    assert message.replies[0].texts == [PLACEHOLDER_TEXT, "Restart the webhook."]
+
+
+def test_finish_falls_back_to_plain_text_when_markdown_fails(clock):
+    message = FakeMessage(clock)
+    reply = StreamingReply(message, edit_interval=0)
+
+    async def run():
+        await reply.start()
+        message.replies[0].errors.append(BadRequest("Can't parse entities: can't find end of the entity"))
+        await reply.finish("Use the *bold_flag option")
+
+    asyncio.run(run())
+    assert message.replies[0].edits == [(clock.now, "Use the *bold_flag option", None)]
+
+
+def test_finish_without_start_sends_a_new_reply(clock):
+    message = FakeMessage(clock)
+    asyncio.run(StreamingReply(message).finish("Restart the webhook."))
+    assert [reply.texts for reply in message.replies] == [["Restart the webhook."]]
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from supportbot.clients.crawl.dataclasses import ChunkAndEmbedding
+from supportbot.retrieval.embedding_index import EmbeddingIndex
+from supportbot.retrieval.two_stage_index import TwoStageIndex
+
+DIMENSION = 256
+PREFIX_DIMS = 64
+
+
+def matryoshka_rows(rng, count: int, first_row_id: int = 0) -> list[ChunkAndEmbedding]:
+    # Like text-embedding-3 vectors, the leading dimensions carry most of the signal, so a
+    # prefix ranks nearly like the full vector.
+    weights = np.exp(-np.arange(DIMENSION) / PREFIX_DIMS).astype(np.float32)
+    centers = rng.standard_normal((20, DIMENSION)).astype(np.float32)
+    embeddings = (centers[rng.integers(len(centers), size=count)] + 0.5 * rng.standard_normal((count, DIMENSION))) * weights
+    return [
+        ChunkAndEmbedding(chunk=f"chunk {first_row_id + position}", embedding=embedding.tolist(), row_id=first_row_id + position)
+        for position, embedding in enumerate(embeddings)
+    ]
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    rng = np.random.default_rng(0)
+    rows = matryoshka_rows(rng, 3000)
+    queries = np.asarray([rows[row].embedding for row in rng.choice(len(rows), size=100, replace=False)], dtype=np.float32)
+    queries += 0.05 * rng.standard_normal(queries.shape).astype(np.float32)
+    return rows, queries
+
+
+def top_rows(index: EmbeddingIndex, queries: np.ndarray, k: int, allowed_rows=None) -> list[list[int]]:
+    return [[result.row for result in index.search(query, k=k, allowed_rows=allowed_rows)] for query in queries]
+
+
+@pytest.mark.parametrize("k", [1, 5, 10])
+def test_two_stage_top_k_matches_exact_top_k(corpus, k):
+    rows, queries = corpus
+    exact = EmbeddingIndex.from_chunks(rows)
+    two_stage = TwoStageIndex.from_index(exact, prefix_dims=PREFIX_DIMS, pool_size=100)
+    assert top_rows(two_stage, queries, k) == top_rows(exact, queries, k)
+    # Restricted to a subset of rows, such as the chats a user is in, it still matches.
+    allowed_rows = np.arange(0, len(rows), 3)
+    assert top_rows(two_stage, queries, k, allowed_rows) == top_rows(exact, queries, k, allowed_rows)
+    for query in queries[:5]:
+        expected_scores = [result.score for result in exact.search(query, k=k)]
+        np.testing.assert_allclose([result.score for result in two_stage.search(query, k=k)], expected_scores, atol=1e-6)
+
+
+def test_a_merged_index_matches_one_built_from_scratch(corpus, monkeypatch):
+    rows, queries = corpus
+    index = TwoStageIndex.from_index(EmbeddingIndex.from_chunks(rows[:2500]), prefix_dims=PREFIX_DIMS, pool_size=100)
+    # Row 10 changed and rows 2500 onwards are new.
+    changed = ChunkAndEmbedding(chunk="chunk 10 edited", embedding=rows[11].embedding, row_id=10)
+    update = [changed] + rows[2500:]
+
+    built = []
+    from_chunks = EmbeddingIndex.from_chunks.__func__
+    monkeypatch.setattr(EmbeddingIndex, "from_chunks", classmethod(lambda cls, *args, **kwargs: built.append(args) or from_chunks(cls, *args, **kwargs)))
+    merged = index.merged(update)
+    monkeypatch.undo()
+    # The rows of the update are decoded and normalized once.
+    assert len(built) == 1
+
+    expected_rows = rows[:10] + rows[11:2500] + update
+    expected = TwoStageIndex.from_index(EmbeddingIndex.from_chunks(expected_rows), prefix_dims=PREFIX_DIMS, pool_size=100)
+    assert isinstance(merged, TwoStageIndex)
+    assert list(merged.chunks) == list(expected.chunks)
+    np.testing.assert_array_equal(merged.row_ids, expected.row_ids)
+    np.testing.assert_allclose(merged.prefix_matrix, expected.prefix_matrix, atol=1e-6)
+    assert top_rows(merged, queries, 5) == top_rows(expected, queries, 5)
@@ -0,0 +1,133 @@
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from supportbot.clients.openai.prompt_builder import build_prompt
+from supportbot.workers import WorkerPool
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+def busy_loop(seconds: float) -> int:
+    # Pure-Python work that holds the GIL for `seconds`.
+    iterations = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        iterations += 1
+    return iterations
+
+
+def worker_identity() -> tuple[int, str]:
+    return os.getpid(), threading.current_thread().name
+
+
+def loaded_modules(*names: str) -> list[str]:
+    return [name for name in names if name in sys.modules]
+
+
+def test_thread_pools_run_work_in_their_threads():
+    pool = WorkerPool("test", 2)
+
+    async def run():
+        return await asyncio.gather(*(pool.run(worker_identity) for _ in range(4)))
+
+    identities = asyncio.run(run())
+    assert {pid for pid, _ in identities} == {os.getpid()}
+    assert all(thread_name.startswith("test") for _, thread_name in identities)
+    stats = pool.stats()
+    assert stats["kind"] == "threads"
+    assert stats["completed"] == 4
+    assert stats["in_flight"] == 0
+    pool.shutdown()
+
+
+def test_process_pools_start_and_shut_down():
+    pool = WorkerPool("test", 2, processes=True)
+
+    async def run():
+        await pool.start()
+        return await pool.run(worker_identity)
+
+    try:
+        pid, _ = asyncio.run(run())
+        assert pid != os.getpid()
+        assert pool.stats()["kind"] == "processes"
+        assert pool.stats()["completed"] == 1
+        pool.shutdown()
+        assert pool._executor is None
+        # A pool that was shut down starts new workers on its next run.
+        assert asyncio.run(pool.run(busy_loop, 0.01)) > 0
+    finally:
+        pool.shutdown()
+
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_the_event_loop_keeps_running_while_workers_are_busy(processes):
+    pool = WorkerPool("test", 2, processes=processes)
+
+    async def run():
+        if processes:
+            await pool.start()
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        if processes:
+            # Pure-Python work would hold the GIL in a thread; in a process it cannot.
+            await asyncio.gather(pool.run(busy_loop, 0.5), pool.run(busy_loop, 0.5))
+        else:
+            await asyncio.gather(pool.run(time.sleep, 0.5), pool.run(time.sleep, 0.5))
+        ticker.cancel()
+        return ticks
+
+    try:
+        # About 50 ticks fit in the half second the work takes; a blocked loop would manage one.
+        assert asyncio.run(run()) >= 20
+    finally:
+        pool.shutdown()
+
+
+def test_prompt_workers_do_not_import_agent_utils():
+    # A worker receives build_prompt by reference, which only imports the prompt builder.
+    assert build_prompt.__module__ == "supportbot.clients.openai.prompt_builder"
+    pool = WorkerPool("test", 1, processes=True)
+    try:
+        modules = asyncio.run(pool.run(
+            loaded_modules,
+            "supportbot.clients.openai.prompt_builder",
+            "agent_utils",
+            "supportbot.clients.openai.embedding_cache"
+        ))
+    finally:
+        pool.shutdown()
+    assert modules == ["supportbot.clients.openai.prompt_builder"]
+
+
+def test_importing_the_bot_creates_no_caches_or_pools(tmp_path):
+    # Spawned workers import main again; that must not open the embedding cache or start threads.
+    cache_path = tmp_path / "embeddings.sqlite"
+    script = (
+        "import threading, agent_utils, main\n"
+        "print(threading.active_count(), agent_utils._embedding_cache, agent_utils._prompt_pool, agent_utils._retrieval_pool)\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=REPO_ROOT,
+        env={**os.environ, "EMBEDDING_CACHE_PATH": str(cache_path), "PROMPT_WORKERS": "2"},
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    assert result.stdout.split() == ["1", "None", "None", "None"]
+    assert not cache_path.exists()